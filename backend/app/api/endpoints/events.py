@@ -0,0 +1,93 @@
+from fastapi import APIRouter, Depends, HTTPException, Header, status
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from typing import Optional
+from app.database import SessionLocal
+from app.models.user import User
+from app.services.auth import verify_token
+from app.services.event_stream import event_stream_hub, user_stream, company_stream
+
+router = APIRouter()
+# EventSource cannot set headers, so the token may also come as ?token=
+security = HTTPBearer(auto_error=False)
+
+def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
+                     token: Optional[str] = None):
+    """Get current authenticated user"""
+    token = credentials.credentials if credentials else token
+    payload = verify_token(token) if token else None
+
+    if not payload:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials"
+        )
+
+    # Short-lived session: a stream stays open far longer than a pooled connection should
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == payload.get("sub")).first()
+        if user:
+            db.expunge(user)
+    finally:
+        db.close()
+
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found"
+        )
+
+    return user
+
+def parse_last_event_id(header: Optional[str], query: Optional[int]) -> Optional[int]:
+    """Last-Event-ID header (sent by EventSource on reconnect), else the last_event_id query param"""
+    if header:
+        try:
+            return int(header)
+        except ValueError:
+            return None
+    return query
+
+def event_stream_response(stream: str, last_event_id: Optional[int]) -> StreamingResponse:
+    subscription = event_stream_hub.subscribe(stream, last_event_id)
+    return StreamingResponse(
+        event_stream_hub.iterate(subscription),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Stop nginx from buffering the stream
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+@router.get("/stream")
+async def stream_my_events(last_event_id: Optional[int] = None,
+                           last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+                           current_user: User = Depends(get_current_user)):
+    """Server-Sent Events for the rides and requests the current user takes part in"""
+    return event_stream_response(
+        user_stream(current_user.id), parse_last_event_id(last_event_id_header, last_event_id)
+    )
+
+@router.get("/company/stream")
+async def stream_company_events(company_id: Optional[str] = None,
+                                last_event_id: Optional[int] = None,
+                                last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+                                current_user: User = Depends(get_current_user)):
+    """Server-Sent Events for every ride and request of a company (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    return event_stream_response(
+        company_stream(company_id or current_user.company_id),
+        parse_last_event_id(last_event_id_header, last_event_id)
+    )
+
+@router.get("/stats")
+async def get_event_stream_stats():
+    """Open SSE connections, buffered events and resume counts"""
+    return event_stream_hub.get_stats()
@@ -5,11 +5,13 @@ from typing import List, Optional
 from app.database import get_database
 from app.models.user import User
 from app.services.auth import verify_token
-from app.services.notification_service import notification_service, NotificationType
+from app.services.notification_service import notification_service, NotificationType, NotificationPriority
 from app.schemas.notification import (
     NotificationResponse, 
     PushTokenRequest, 
-    NotificationStats
+    NotificationStats,
+    AnnouncementRequest,
+    BulkDeliveryReport
 )
 
 router = APIRouter()
@@ -42,20 +44,16 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
 async def get_notifications(
     current_user: User = Depends(get_current_user),
     limit: int = 50,
-    unread_only: bool = False
+    unread_only: bool = False,
+    before: Optional[str] = None
 ):
-    """Get notifications for current user"""
-    notifications = notification_service.get_user_notifications(current_user.id, limit)
-    
-    if unread_only:
-        notifications = [n for n in notifications if not n["read"]]
-    
-    return notifications
+    """Get notifications for current user; pass the last id received as `before` for the next page"""
+    return await notification_service.get_user_notifications(current_user.id, limit, unread_only, before)
 
 @router.get("/stats", response_model=NotificationStats)
 async def get_notification_stats(current_user: User = Depends(get_current_user)):
     """Get notification statistics for current user"""
-    return notification_service.get_notification_stats(current_user.id)
+    return await notification_service.get_notification_stats(current_user.id)
 
 @router.post("/mark-read/{notification_id}")
 async def mark_notification_read(
@@ -63,7 +61,7 @@ async def mark_notification_read(
     current_user: User = Depends(get_current_user)
 ):
     """Mark a specific notification as read"""
-    success = notification_service.mark_notification_read(current_user.id, notification_id)
+    success = await notification_service.mark_notification_read(current_user.id, notification_id)
     
     if not success:
         raise HTTPException(
@@ -76,7 +74,7 @@ async def mark_notification_read(
 @router.post("/mark-all-read")
 async def mark_all_notifications_read(current_user: User = Depends(get_current_user)):
     """Mark all notifications as read for current user"""
-    success = notification_service.mark_all_notifications_read(current_user.id)
+    success = await notification_service.mark_all_notifications_read(current_user.id)
     
     if not success:
         raise HTTPException(
@@ -135,15 +133,101 @@ async def send_test_notification(current_user: User = Depends(get_current_user))
     
     return {"message": "Test notification sent successfully"}
 
+@router.post("/announcements", response_model=BulkDeliveryReport)
+async def send_announcement(
+    announcement: AnnouncementRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_database)
+):
+    """Notify every active user of a company (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    try:
+        priority = NotificationPriority(announcement.priority)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown priority: {announcement.priority}"
+        )
+
+    company_id = announcement.company_id or current_user.company_id
+    user_ids = [user.id for user in db.query(User.id).filter(
+        User.company_id == company_id,
+        User.is_active == True
+    ).all()]
+
+    return await notification_service.send_bulk_notifications(
+        user_ids,
+        NotificationType.ANNOUNCEMENT,
+        announcement.title,
+        announcement.message,
+        data={"company_id": company_id, **(announcement.data or {})},
+        priority=priority
+    )
+
+@router.get("/push/stats")
+async def get_push_delivery_stats(current_user: User = Depends(get_current_user)):
+    """Push queue depth, retries and dead letters (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    return await notification_service.push.get_stats()
+
+@router.get("/coalescing/stats")
+async def get_coalescing_stats(current_user: User = Depends(get_current_user)):
+    """Notifications merged into summaries and digests (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    return notification_service.coalescer.get_stats()
+
+@router.get("/retention/stats")
+async def get_retention_stats(current_user: User = Depends(get_current_user)):
+    """Retention policy and what compaction has reclaimed (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    return notification_service.compactor.get_stats()
+
+@router.post("/retention/compact")
+async def compact_notifications(current_user: User = Depends(get_current_user)):
+    """Run compaction now instead of waiting for the next scheduled run (admin only)"""
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
+    return await notification_service.compactor.compact()
+
 @router.delete("/{notification_id}")
 async def delete_notification(
     notification_id: str,
     current_user: User = Depends(get_current_user)
 ):
     """Delete a specific notification"""
-    # This would need to be implemented in the notification service
-    # For now, just return a message
-    return {"message": "Notification deletion not yet implemented"}
+    success = await notification_service.delete_notification(current_user.id, notification_id)
+    
+    if not success:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Notification not found"
+        )
+    
+    return {"message": "Notification deleted"}
 
 @router.get("/types")
 async def get_notification_types():
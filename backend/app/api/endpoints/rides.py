@@ -1,3 +1,4 @@
+import math
 from fastapi import APIRouter, Depends, HTTPException, status, Body
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
@@ -10,11 +11,16 @@ from app.models.user import User
 from app.schemas.ride import (
     RideBase, RideCreate, RideUpdate, RideResponse, RideRequestBase, 
     RideRequestCreate, RideRequestResponse, RideLocationUpdate, 
-    RideLocationResponse, RideProgressUpdate, RidePaymentUpdate, RideRating
+    RideLocationResponse, RideProgressUpdate, RidePaymentUpdate, RideRating,
+    NearbyDriverResponse
 )
 from app.services.auth import verify_token
 
 from app.services.location import location_service
+from app.services.websocket_service import manager
+from app.services.geofence_service import geofence_engine
+from app.services.outbox import record_ride_event, outbox_dispatcher
+from app.services.ride_stats import record_ride_completed, record_driver_rating
 
 router = APIRouter()
 security = HTTPBearer()
@@ -63,6 +69,21 @@ def convert_ride_to_dict(ride: Ride, driver_name: str = None, driver_email: str
     
     return ride_dict
 
+def accepted_rider_ids(db: Session, ride_id: str) -> List[str]:
+    """Users holding an accepted seat on a ride"""
+    return [request.user_id for request in db.query(RideRequest.user_id).filter(
+        RideRequest.ride_id == ride_id,
+        RideRequest.status == "accepted"
+    ).all()]
+
+def record_accepted_event(db: Session, ride: Ride, ride_request: RideRequest):
+    """Queue the ride_request_accepted event for the rider"""
+    record_ride_event(db, ride, "ride_request_accepted", [ride_request.user_id], {
+        "request_id": ride_request.id,
+        "driver_id": ride.driver_id,
+        "confirmed_passengers": ride.confirmed_passengers
+    })
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), 
                     db: Session = Depends(get_database)):
     """Get current authenticated user"""
@@ -121,8 +142,18 @@ async def create_ride(ride: RideCreate, current_user: User = Depends(get_current
     )
 
     db.add(db_ride)
+    db.flush()  # Assigns the ride id carried by the event
+    record_ride_event(db, db_ride, "ride_created", [], {
+        "driver_id": db_ride.driver_id,
+        "pickup_location": db_ride.pickup_location,
+        "destination": db_ride.destination,
+        "scheduled_time": db_ride.scheduled_time.isoformat() if db_ride.scheduled_time else None,
+        "vehicle_capacity": db_ride.vehicle_capacity,
+        "fare": db_ride.fare
+    })
     db.commit()
     db.refresh(db_ride)
+    outbox_dispatcher.wake()
 
     return convert_ride_to_dict(db_ride)
 
@@ -228,6 +259,30 @@ async def get_rides_available_for_drivers(
         detail="This endpoint is deprecated. Drivers now create rides directly."
     )
 
+@router.get("/drivers/nearby", response_model=List[NearbyDriverResponse])
+async def get_nearby_drivers(
+    latitude: float,
+    longitude: float,
+    radius_km: float = 5.0,
+    limit: int = 20,
+    current_user: User = Depends(get_current_user)
+):
+    """Available drivers of the user's company within radius_km, nearest first"""
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid coordinates"
+        )
+    if not (0 < radius_km <= 50) or not (0 < limit <= 100):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="radius_km must be in (0, 50] and limit in (0, 100]"
+        )
+    
+    return await manager.driver_presence.nearby(
+        current_user.company_id, latitude, longitude, radius_km=radius_km, limit=limit
+    )
+
 @router.post("/{ride_id}/offer-driving")
 async def offer_to_drive_ride(
     ride_id: str,
@@ -505,8 +560,15 @@ async def request_ride(ride_id: str, request_data: RideRequestCreate,
     )
 
     db.add(ride_request)
+    db.flush()  # Assigns the request id carried by the event
+    record_ride_event(db, ride, "ride_requested", [ride.driver_id], {
+        "request_id": ride_request.id,
+        "user_id": current_user.id,
+        "message": ride_request.message
+    })
     db.commit()
     db.refresh(ride_request)
+    outbox_dispatcher.wake()
 
     return ride_request
 
@@ -570,7 +632,19 @@ async def accept_ride_request(ride_id: str,
     if ride.confirmed_passengers == 1:
         ride.status = "confirmed"
     
+    record_accepted_event(db, ride, ride_request)
     db.commit()
+    outbox_dispatcher.wake()
+
+    # Driver now heads for the pickup point
+    geofence_engine.register_ride(
+        ride.driver_id, ride.id, ride.status,
+        ride.pickup_latitude, ride.pickup_longitude,
+        ride.destination_latitude, ride.destination_longitude,
+        rider_ids=[ride_request.user_id]
+    )
+    manager.ride_rooms.add_rider(ride.id, ride_request.user_id)
+    await manager.publish_ride_change(ride.id, "rider_added", ride.driver_id, rider_id=ride_request.user_id)
 
     return {"message": "Ride request accepted"}
 
@@ -616,7 +690,15 @@ async def reject_ride_request(ride_id: str,
 
     # Reject the request
     ride_request.status = "declined"
+    record_ride_event(db, ride, "ride_request_declined", [ride_request.user_id], {
+        "request_id": ride_request.id
+    })
     db.commit()
+    outbox_dispatcher.wake()
+
+    geofence_engine.remove_rider(ride.driver_id, ride_id, ride_request.user_id)
+    manager.ride_rooms.remove_rider(ride_id, ride_request.user_id)
+    await manager.publish_ride_change(ride_id, "rider_removed", ride.driver_id, rider_id=ride_request.user_id)
 
     return {"message": "Ride request rejected"}
 
@@ -644,8 +726,20 @@ async def cancel_ride_request(request_id: str,
         )
 
     # Delete the request
+    ride = db.query(Ride).filter(Ride.id == ride_request.ride_id).first()
+    if ride:
+        record_ride_event(db, ride, "ride_request_cancelled", [ride.driver_id], {
+            "request_id": ride_request.id,
+            "user_id": current_user.id
+        })
     db.delete(ride_request)
     db.commit()
+    outbox_dispatcher.wake()
+
+    manager.ride_rooms.remove_rider(ride_request.ride_id, current_user.id)
+    if ride:
+        geofence_engine.remove_rider(ride.driver_id, ride.id, current_user.id)
+        await manager.publish_ride_change(ride.id, "rider_removed", ride.driver_id, rider_id=current_user.id)
 
     return {"message": "Ride request cancelled successfully"}
 
@@ -688,7 +782,19 @@ async def accept_passenger_request(ride_id: str,
     # Accept the passenger request
     ride_request.status = "accepted"
     ride.confirmed_passengers += 1
+    record_accepted_event(db, ride, ride_request)
     db.commit()
+    outbox_dispatcher.wake()
+
+    # Driver now heads for the pickup point
+    geofence_engine.register_ride(
+        ride.driver_id, ride.id, ride.status,
+        ride.pickup_latitude, ride.pickup_longitude,
+        ride.destination_latitude, ride.destination_longitude,
+        rider_ids=[ride_request.user_id]
+    )
+    manager.ride_rooms.add_rider(ride_id, ride_request.user_id)
+    await manager.publish_ride_change(ride_id, "rider_added", ride.driver_id, rider_id=ride_request.user_id)
 
     return {"message": "Passenger request accepted"}
 
@@ -734,7 +840,15 @@ async def reject_passenger_request(ride_id: str,
 
     # Reject the request
     ride_request.status = "declined"
+    record_ride_event(db, ride, "ride_request_declined", [ride_request.user_id], {
+        "request_id": ride_request.id
+    })
     db.commit()
+    outbox_dispatcher.wake()
+
+    geofence_engine.remove_rider(ride.driver_id, ride_id, ride_request.user_id)
+    manager.ride_rooms.remove_rider(ride_id, ride_request.user_id)
+    await manager.publish_ride_change(ride_id, "rider_removed", ride.driver_id, rider_id=ride_request.user_id)
 
     return {"message": "Passenger request rejected"}
 
@@ -773,8 +887,24 @@ async def start_ride(
     ride.actual_start_time = datetime.now(timezone.utc)
     ride.ride_progress = 0.0
     
+    rider_ids = accepted_rider_ids(db, ride_id)
+    record_ride_event(db, ride, "ride_started", rider_ids, {
+        "driver_id": ride.driver_id,
+        "started_at": ride.actual_start_time.isoformat()
+    })
     db.commit()
     db.refresh(ride)
+    outbox_dispatcher.wake()
+    
+    geofence_engine.register_ride(
+        ride.driver_id, ride.id, ride.status,
+        ride.pickup_latitude, ride.pickup_longitude,
+        ride.destination_latitude, ride.destination_longitude,
+        rider_ids=rider_ids
+    )
+    # Riders follow the driver's live location from now on
+    manager.ride_rooms.open_room(ride.id, ride.driver_id, rider_ids)
+    await manager.publish_ride_change(ride.id, "started", ride.driver_id, rider_ids=rider_ids)
     
     return convert_ride_to_dict(ride)
 
@@ -838,8 +968,17 @@ async def pickup_passenger(
     ride.pickup_time = datetime.now(timezone.utc)
     ride.ride_progress = 0.5  # 50% complete after pickup
     
+    record_ride_event(db, ride, "passenger_picked_up", accepted_rider_ids(db, ride_id), {
+        "pickup_time": ride.pickup_time.isoformat(),
+        "ride_progress": ride.ride_progress
+    })
     db.commit()
     db.refresh(ride)
+    outbox_dispatcher.wake()
+    
+    # Next fence is the drop-off point
+    geofence_engine.mark_picked_up(ride.driver_id, ride.id)
+    await manager.publish_ride_change(ride.id, "picked_up", ride.driver_id)
     
     return convert_ride_to_dict(ride)
 
@@ -850,7 +989,8 @@ async def complete_ride(
     db: Session = Depends(get_database)
 ):
     """Complete a ride (Driver only) - Follows flow: in_progress → completed"""
-    ride = db.query(Ride).filter(Ride.id == ride_id).first()
+    # Row lock: a repeated request waits, then sees the ride completed and is not counted twice
+    ride = db.query(Ride).filter(Ride.id == ride_id).with_for_update().first()
     if not ride:
         raise HTTPException(status_code=404, detail="Ride not found")
     
@@ -875,8 +1015,20 @@ async def complete_ride(
     ride.dropoff_time = datetime.now(timezone.utc)
     ride.ride_progress = 1.0  # 100% complete
     
+    passenger_ids = accepted_rider_ids(db, ride_id)
+    record_ride_completed(db, ride.driver_id, passenger_ids)
+    record_ride_event(db, ride, "ride_completed", passenger_ids, {
+        "completed_at": ride.actual_end_time.isoformat(),
+        "duration": ride.duration,
+        "fare": ride.fare
+    })
     db.commit()
     db.refresh(ride)
+    outbox_dispatcher.wake()
+    
+    geofence_engine.remove_ride(ride.driver_id, ride.id)
+    manager.ride_rooms.close_room(ride.id)
+    await manager.publish_ride_change(ride.id, "closed", ride.driver_id)
     
     return convert_ride_to_dict(ride)
 
@@ -899,6 +1051,12 @@ async def cancel_ride(
     if ride.status in ["completed", "cancelled"]:
         raise HTTPException(status_code=400, detail="Ride cannot be cancelled in current status")
     
+    # Everyone riding in or still waiting on this ride hears about it
+    affected_ids = [request.user_id for request in db.query(RideRequest.user_id).filter(
+        RideRequest.ride_id == ride_id,
+        RideRequest.status.in_(["pending", "accepted"])
+    ).all()]
+    
     # If ride has confirmed passengers, reject all pending requests
     if ride.confirmed_passengers > 0:
         pending_requests = db.query(RideRequest).filter(
@@ -910,8 +1068,14 @@ async def cancel_ride(
             request.status = "cancelled"
     
     ride.status = "cancelled"
+    record_ride_event(db, ride, "ride_cancelled", affected_ids, {"cancelled_by": current_user.id})
     db.commit()
     db.refresh(ride)
+    outbox_dispatcher.wake()
+    
+    geofence_engine.remove_ride(ride.driver_id, ride.id)
+    manager.ride_rooms.close_room(ride.id)
+    await manager.publish_ride_change(ride.id, "closed", ride.driver_id)
     
     return convert_ride_to_dict(ride)
 
@@ -939,6 +1103,15 @@ async def update_ride_location(
         if not confirmed_request:
             raise HTTPException(status_code=403, detail="Only ride participants can update location")
     
+    # Reject pings sent faster than the server-recommended interval
+    if not manager.ping_rate.allow(current_user.id):
+        retry_after = manager.ping_rate.retry_after(current_user.id)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Location updates limited to one every {manager.ping_rate.get_interval(current_user.id)} seconds",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
     # Create new location record
     ride_location = RideLocation(
         ride_id=ride_id,
@@ -955,6 +1128,33 @@ async def update_ride_location(
     db.commit()
     db.refresh(ride_location)
     
+    if ride.driver_id == current_user.id:
+        if current_user.id not in geofence_engine.driver_fences:
+            manager.load_ride_fences(current_user.id)
+        await geofence_engine.process_driver_location(
+            current_user.id, location_update.latitude, location_update.longitude
+        )
+        await manager.notify_riders_about_driver(current_user.id, {
+            "latitude": location_update.latitude,
+            "longitude": location_update.longitude,
+            "speed": location_update.speed,
+            "heading": location_update.heading
+        })
+    
+    # Aim at the pickup until the passenger is on board, then at the drop-off
+    if ride.pickup_time is None:
+        target = {"latitude": ride.pickup_latitude, "longitude": ride.pickup_longitude}
+    else:
+        target = {"latitude": ride.destination_latitude, "longitude": ride.destination_longitude}
+    await manager.refresh_ping_interval(
+        current_user.id,
+        location_update.latitude,
+        location_update.longitude,
+        location_update.speed,
+        ride_status=ride.status,
+        target=target
+    )
+    
     return ride_location
 
 @router.get("/{ride_id}/location", response_model=List[RideLocationResponse])
@@ -1033,7 +1233,8 @@ async def rate_ride(
     db: Session = Depends(get_database)
 ):
     """Rate a completed ride (Employee only) - Only after completion"""
-    ride = db.query(Ride).filter(Ride.id == ride_id).first()
+    # Row lock: two passengers rating at once cannot both pass the "already rated" check
+    ride = db.query(Ride).filter(Ride.id == ride_id).with_for_update().first()
     if not ride:
         raise HTTPException(status_code=404, detail="Ride not found")
     
@@ -1071,6 +1272,7 @@ async def rate_ride(
     # Update ride with rating
     ride.ride_rating = rating_data.rating
     ride.ride_feedback = rating_data.feedback
+    record_driver_rating(db, ride.driver_id, rating_data.rating)
     
     db.commit()
     db.refresh(ride)
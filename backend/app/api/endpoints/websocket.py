@@ -1,5 +1,10 @@
+from typing import Optional
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
 from app.services.websocket_service import manager
+from app.services.frame_protocol import BINARY_SUBPROTOCOL, FrameProtocolError
+from app.services.admission import admission_controller, ADMISSION_CLOSE_CODE
+from app.services.outbox import outbox_dispatcher
+from app.services.ride_expiry import stale_ride_sweeper
 import json
 import logging
 
@@ -7,24 +12,40 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 @router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
+async def websocket_endpoint(websocket: WebSocket, user_id: str,
+                             stream: Optional[str] = None, last_seq: Optional[int] = None):
     """WebSocket endpoint for real-time communication"""
-    await manager.connect(websocket, user_id)
+    # Clients opt in to the compact binary protocol via Sec-WebSocket-Protocol
+    subprotocol = BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in websocket.scope.get("subprotocols", []) else None
+    
+    # Rate-limit handshakes so reconnect storms ramp up instead of spiking
+    retry_after = await admission_controller.admit()
+    if retry_after is not None:
+        # Accept first: a close before accept is an HTTP 403 and carries no code or reason
+        await websocket.accept(subprotocol=subprotocol)
+        await websocket.close(code=ADMISSION_CLOSE_CODE, reason=f"retry_after={retry_after}")
+        return
+    
+    # Reconnecting clients pass ?stream=<stream_id>&last_seq=<n> to resume
+    await manager.connect(websocket, user_id, subprotocol, stream_id=stream, last_seq=last_seq)
     
     try:
         while True:
             # Receive message from client
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            try:
+                message = await manager.receive_message(websocket, user_id)
+            except FrameProtocolError as e:
+                logger.warning(f"Dropping malformed frame from user {user_id}: {e}")
+                continue
             
             # Handle different message types
             await handle_websocket_message(user_id, message)
             
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, websocket)
     except Exception as e:
         logger.error(f"WebSocket error for user {user_id}: {e}")
-        manager.disconnect(user_id)
+        manager.disconnect(user_id, websocket)
 
 async def handle_websocket_message(user_id: str, message: dict):
     """Handle incoming WebSocket messages"""
@@ -38,6 +59,8 @@ async def handle_websocket_message(user_id: str, message: dict):
         await handle_ride_response(user_id, message)
     elif message_type == "driver_status":
         await handle_driver_status(user_id, message)
+    elif message_type == "heartbeat_ack":
+        pass  # Activity is recorded when the frame is received
     else:
         logger.warning(f"Unknown message type: {message_type}")
 
@@ -46,12 +69,15 @@ async def handle_location_update(user_id: str, message: dict):
     location_data = message.get("data", {})
     location_data["user_id"] = user_id
     
-    await manager.update_user_location(user_id, location_data)
+    # Updates sent faster than the recommended interval are dropped
+    if not await manager.ingest_location_update(user_id, location_data):
+        return
     
     # Send confirmation back to user
     await manager.send_personal_message({
         "type": "location_updated",
         "status": "success",
+        "interval_seconds": manager.ping_rate.get_interval(user_id),
         "timestamp": message.get("timestamp")
     }, user_id)
 
@@ -60,8 +86,9 @@ async def handle_ride_request(user_id: str, message: dict):
     ride_data = message.get("data", {})
     ride_data["rider_id"] = user_id
     
-    # Process the ride request
-    await manager.handle_ride_request(ride_data)
+    # Process the ride request; refused requests were already answered
+    if not await manager.handle_ride_request(ride_data):
+        return
     
     # Send confirmation to rider
     await manager.send_personal_message({
@@ -73,67 +100,8 @@ async def handle_ride_request(user_id: str, message: dict):
 
 async def handle_ride_response(user_id: str, message: dict):
     """Handle driver's response to ride request"""
-    response_data = message.get("data", {})
-    ride_id = response_data.get("ride_id")
-    response_type = response_data.get("response")  # "accept" or "decline"
-    
-    if response_type == "accept":
-        # Update ride status and notify rider
-        await handle_ride_accepted(user_id, ride_id, response_data)
-    elif response_type == "decline":
-        # Notify rider that ride was declined
-        await handle_ride_declined(user_id, ride_id, response_data)
-
-async def handle_ride_accepted(user_id: str, ride_id: str, response_data: dict):
-    """Handle when a driver accepts a ride"""
-    # Get ride details from pending rides
-    if ride_id in manager.pending_rides:
-        ride_data = manager.pending_rides[ride_id]
-        rider_id = ride_data.get("rider_id")
-        
-        # Remove from pending rides
-        del manager.pending_rides[ride_id]
-        
-        # Notify rider that ride was accepted
-        await manager.send_personal_message({
-            "type": "ride_accepted",
-            "data": {
-                "ride_id": ride_id,
-                "driver_id": user_id,
-                "driver_name": response_data.get("driver_name"),
-                "estimated_arrival": response_data.get("estimated_arrival")
-            },
-            "timestamp": response_data.get("timestamp")
-        }, rider_id)
-        
-        # Notify driver
-        await manager.send_personal_message({
-            "type": "ride_confirmed",
-            "data": {
-                "ride_id": ride_id,
-                "rider_id": rider_id,
-                "pickup_location": ride_data.get("pickup_location"),
-                "destination": ride_data.get("destination")
-            },
-            "timestamp": response_data.get("timestamp")
-        }, user_id)
-
-async def handle_ride_declined(user_id: str, ride_id: str, response_data: dict):
-    """Handle when a driver declines a ride"""
-    if ride_id in manager.pending_rides:
-        ride_data = manager.pending_rides[ride_id]
-        rider_id = ride_data.get("rider_id")
-        
-        # Notify rider that ride was declined
-        await manager.send_personal_message({
-            "type": "ride_declined",
-            "data": {
-                "ride_id": ride_id,
-                "driver_id": user_id,
-                "reason": response_data.get("reason", "Driver unavailable")
-            },
-            "timestamp": response_data.get("timestamp")
-        }, rider_id)
+    # Answered by the worker running the ride's dispatch, wherever the driver is connected
+    await manager.handle_ride_response(user_id, message.get("data", {}))
 
 async def handle_driver_status(user_id: str, message: dict):
     """Handle driver availability status updates"""
@@ -141,9 +109,7 @@ async def handle_driver_status(user_id: str, message: dict):
     is_available = status_data.get("is_available", False)
     
     # Update driver status in location data
-    if user_id in manager.user_locations:
-        manager.user_locations[user_id]["is_available"] = is_available
-        
+    if await manager.set_driver_availability(user_id, is_available):
         # Send confirmation
         await manager.send_personal_message({
             "type": "driver_status_updated",
@@ -171,5 +137,11 @@ async def get_active_connections():
     return {
         "active_connections": len(manager.active_connections),
         "users_with_location": len(manager.user_locations),
-        "pending_rides": len(manager.pending_rides)
+        "pending_rides": manager.pending_rides.get_stats(),
+        "location_pings": manager.ping_rate.get_stats(),
+        "send_queues": manager.get_send_queue_stats(),
+        "heartbeats": manager.heartbeats.get_stats(),
+        "admission": admission_controller.get_stats(),
+        "outbox": outbox_dispatcher.get_stats(),
+        "stale_rides": stale_ride_sweeper.get_stats()
     }
@@ -1,5 +1,7 @@
 from .company import Company
 from .user import User
 from .ride import Ride, RideRequest
+from .outbox import OutboxEvent
+from .notification import Notification, NotificationCounter
 
-__all__ = ["Company", "User", "Ride", "RideRequest"]
+__all__ = ["Company", "User", "Ride", "RideRequest", "OutboxEvent", "Notification", "NotificationCounter"]
@@ -0,0 +1,32 @@
+from sqlalchemy import Column, String, Boolean, DateTime, Integer, JSON, Index
+from sqlalchemy.sql import func
+from app.database import Base
+
+class Notification(Base):
+    __tablename__ = "notifications"
+
+    id = Column(String, primary_key=True)
+    user_id = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    title = Column(String, nullable=False)
+    message = Column(String, nullable=False)
+    data = Column(JSON, nullable=True)
+    priority = Column(String, nullable=False, default="normal")
+    read = Column(Boolean, nullable=False, default=False)
+    timestamp = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        # Serves "latest N" and "latest N unread" pages for a user
+        Index("idx_notifications_user_read_timestamp", "user_id", "read", timestamp.desc()),
+        # Serves the retention sweep: oldest read notifications first
+        Index("idx_notifications_read_timestamp", "timestamp", postgresql_where=read.is_(True)),
+    )
+
+class NotificationCounter(Base):
+    """Per-user totals maintained on write, so unread badges never count rows"""
+    __tablename__ = "notification_counters"
+
+    user_id = Column(String, primary_key=True)
+    total_count = Column(Integer, nullable=False, default=0)
+    unread_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, String, DateTime, Integer, JSON, Index
+from sqlalchemy.sql import func
+from app.database import Base
+
+class OutboxEvent(Base):
+    """Ride lifecycle event written in the same transaction as the state change"""
+    __tablename__ = "outbox_events"
+
+    # Monotonic id doubles as the dispatcher's cursor
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_type = Column(String, nullable=False)  # ride_requested, ride_request_accepted, ride_started, ...
+    ride_id = Column(String, nullable=False)
+    company_id = Column(String, nullable=True)
+    recipient_ids = Column(JSON, nullable=False, default=list)
+    payload = Column(JSON, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    dispatched_at = Column(DateTime(timezone=True), nullable=True)
+    # Set when a dispatcher takes the event; a stale claim is taken over after a timeout
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Only undelivered events are scanned
+        Index("idx_outbox_events_undispatched", "id", postgresql_where=dispatched_at.is_(None)),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, Boolean, DateTime, ForeignKey, Text, Integer, JSON
+from sqlalchemy import Column, String, Float, Boolean, DateTime, ForeignKey, Text, Integer, JSON, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -57,6 +57,11 @@ class Ride(Base):
     ride_requests = relationship("RideRequest", back_populates="ride")
     ride_locations = relationship("RideLocation", back_populates="ride")
 
+    __table_args__ = (
+        # Serves the stale ride sweep: available rides by scheduled time
+        Index("idx_rides_available_scheduled_time", "scheduled_time", postgresql_where=status == "available"),
+    )
+
 class RideRequest(Base):
     __tablename__ = "ride_requests"
 
@@ -20,8 +20,10 @@ class User(Base):
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
     profile_picture = Column(String, nullable=True)
-    rating = Column(Float, default=0.0)
-    total_rides = Column(Integer, default=0)
+    rating = Column(Float, default=0.0)  # rating_sum / rating_count, kept in step on every rating
+    rating_sum = Column(Float, nullable=False, default=0.0, server_default="0")
+    rating_count = Column(Integer, nullable=False, default=0, server_default="0")
+    total_rides = Column(Integer, default=0)  # Completed rides, as driver or passenger
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -39,3 +39,23 @@ class NotificationUpdate(BaseModel):
     """Update notification request"""
     read: Optional[bool] = None
     data: Optional[Dict[str, Any]] = None
+
+class AnnouncementRequest(BaseModel):
+    """Company-wide announcement (admin only)"""
+    title: str
+    message: str
+    company_id: Optional[str] = None  # Defaults to the admin's company
+    priority: str = "normal"
+    data: Optional[Dict[str, Any]] = None
+
+class BulkDeliveryReport(BaseModel):
+    """Aggregated outcome of a bulk notification"""
+    recipients: int
+    stored: int
+    websocket_delivered: int  # Queued on a connection of the worker that handled the request
+    websocket_published: int  # Handed to the broker for users not connected to that worker
+    websocket_failed: int
+    push_queued: int
+    push_failed: int
+    without_push_token: int
+    duration_ms: float
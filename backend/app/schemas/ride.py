@@ -111,6 +111,13 @@ class RideLocationResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class NearbyDriverResponse(BaseModel):
+    driver_id: str
+    latitude: float
+    longitude: float
+    distance_km: Optional[float] = None
+    last_seen_seconds: Optional[float] = None
+
 class RideProgressUpdate(BaseModel):
     ride_id: str
     status: str  # Must follow: available → confirmed → in_progress → completed
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import random
+import time
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# New WebSocket connections admitted per second on this worker
+WS_ADMISSION_RATE = float(os.getenv("WS_ADMISSION_RATE", "50"))
+# Connections admitted back-to-back before the rate applies
+WS_ADMISSION_BURST = int(os.getenv("WS_ADMISSION_BURST", "100"))
+# Longest a handshake may wait for a token before being turned away (seconds)
+WS_ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("WS_ADMISSION_MAX_WAIT_SECONDS", "2"))
+# Handshakes allowed to wait at the same time
+WS_ADMISSION_MAX_QUEUE = int(os.getenv("WS_ADMISSION_MAX_QUEUE", "200"))
+# Upper bound of the retry hint given to rejected clients (seconds)
+WS_ADMISSION_MAX_RETRY_SECONDS = float(os.getenv("WS_ADMISSION_MAX_RETRY_SECONDS", "30"))
+
+# Close code for rejected handshakes; the reason carries "retry_after=<seconds>"
+ADMISSION_CLOSE_CODE = 1013  # Try Again Later
+
+class TokenBucket:
+    """Token bucket that lets callers reserve future tokens"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float = None) -> float:
+        """Take a token and return how long to wait until it is actually available"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait_time(self, now: float = None) -> float:
+        """How long a reservation made now would have to wait"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class AdmissionController:
+    """Smooths WebSocket connect storms: admit, queue briefly, or reject with a jittered retry hint"""
+
+    def __init__(self, rate: float = WS_ADMISSION_RATE, burst: int = WS_ADMISSION_BURST,
+                 max_wait: float = WS_ADMISSION_MAX_WAIT_SECONDS, max_queue: int = WS_ADMISSION_MAX_QUEUE,
+                 max_retry: float = WS_ADMISSION_MAX_RETRY_SECONDS):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.max_retry = max_retry
+        self.queue_depth = 0
+        self.stats = {"admitted": 0, "admitted_immediately": 0, "queued": 0, "rejected": 0}
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._next_retry_at = 0.0
+
+    def retry_after(self, wait: float, now: float = None) -> float:
+        """Retry hint that spreads rejected clients out at the admission rate, plus jitter"""
+        now = time.monotonic() if now is None else now
+        # Each rejection is handed the next free future slot
+        slot = max(now + max(wait, self.max_wait), self._next_retry_at)
+        self._next_retry_at = slot + 1 / self.bucket.rate
+        delay = slot - now
+        return round(min(self.max_retry, delay + random.uniform(0, 0.25 * delay + 0.5)), 1)
+
+    async def admit(self) -> Optional[float]:
+        """Wait for a connection slot; returns None when admitted, else seconds to wait before retrying"""
+        wait = self.bucket.wait_time()
+        if wait > 0 and (wait > self.max_wait or self.queue_depth >= self.max_queue):
+            self.stats["rejected"] += 1
+            return self.retry_after(wait)
+
+        wait = self.bucket.reserve()
+        self.stats["admitted"] += 1
+        if wait <= 0:
+            self.stats["admitted_immediately"] += 1
+            return None
+
+        self.stats["queued"] += 1
+        self.queue_depth += 1
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.queue_depth -= 1
+        self._queue_wait_total += wait
+        self._queue_wait_max = max(self._queue_wait_max, wait)
+        return None
+
+    def get_stats(self) -> Dict:
+        queued = self.stats["queued"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth,
+            "avg_queue_wait_ms": round(self._queue_wait_total / queued * 1000, 1) if queued else 0.0,
+            "max_queue_wait_ms": round(self._queue_wait_max * 1000, 1),
+            "tokens_available": round(max(0.0, self.bucket.tokens), 1),
+            "rate_per_second": self.bucket.rate,
+            "burst": self.bucket.burst
+        }
+
+# Global instance
+admission_controller = AdmissionController()
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Set
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# "memory" (single worker / tests) or "redis" (multiple workers or nodes)
+WS_BROKER = os.getenv("WS_BROKER", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+CHANNEL_PREFIX = "ws"
+
+def user_channel(user_id: str) -> str:
+    return f"{CHANNEL_PREFIX}:user:{user_id}"
+
+def company_channel(company_id: str) -> str:
+    return f"{CHANNEL_PREFIX}:company:{company_id}"
+
+# Ride membership changes, received by every worker
+RIDES_CHANNEL = f"{CHANNEL_PREFIX}:rides"
+# Which worker runs the dispatch of each ride request, received by every worker
+DISPATCH_CHANNEL = f"{CHANNEL_PREFIX}:dispatch"
+
+def worker_channel(worker_id: str) -> str:
+    return f"{CHANNEL_PREFIX}:worker:{worker_id}"
+
+MessageHandler = Callable[[str, Dict], Awaitable[None]]
+
+class Broker(ABC):
+    """Pub/sub transport that carries WebSocket fan-out between workers"""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.handler: Optional[MessageHandler] = None
+        self.channels: Set[str] = set()
+        # Publish-to-deliver latency samples in milliseconds
+        self.latencies = deque(maxlen=1024)
+        self.stats = {"published": 0, "received": 0}
+
+    def set_handler(self, handler: MessageHandler):
+        self.handler = handler
+
+    async def start(self):
+        """Connect and start listening"""
+
+    async def stop(self):
+        """Stop listening and disconnect"""
+
+    def subscribe(self, channel: str):
+        """Start receiving a channel on this worker"""
+        self.channels.add(channel)
+
+    def unsubscribe(self, channel: str):
+        """Stop receiving a channel on this worker"""
+        self.channels.discard(channel)
+
+    @abstractmethod
+    async def publish(self, channel: str, envelope: Dict):
+        """Publish to every worker subscribed to a channel"""
+
+    def wrap(self, kind: str, target: str, message: Dict) -> Dict:
+        """Build the envelope carried over the broker"""
+        return {
+            "origin": self.worker_id,
+            "kind": kind,
+            "target": target,
+            "message": message,
+            "published_at": time.time()
+        }
+
+    async def deliver(self, channel: str, envelope: Dict):
+        """Hand a received envelope to the local handler"""
+        self.stats["received"] += 1
+        published_at = envelope.get("published_at")
+        if published_at:
+            self.latencies.append((time.time() - published_at) * 1000)
+        if self.handler:
+            try:
+                await self.handler(channel, envelope)
+            except Exception as e:
+                logger.error(f"Broker handler failed for channel {channel}: {e}")
+
+    def get_stats(self) -> Dict:
+        """Publish/receive counts and publish-to-deliver latency"""
+        samples = sorted(self.latencies)
+        latency = {}
+        if samples:
+            latency = {
+                "avg_ms": round(sum(samples) / len(samples), 3),
+                "p50_ms": round(samples[len(samples) // 2], 3),
+                "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+                "max_ms": round(samples[-1], 3)
+            }
+        return {
+            "backend": self.__class__.__name__,
+            "worker_id": self.worker_id,
+            "subscribed_channels": len(self.channels),
+            **self.stats,
+            "latency": latency
+        }
+
+class InMemoryBroker(Broker):
+    """In-process broker; brokers sharing a hub behave like separate workers"""
+
+    def __init__(self, hub: Dict[str, Set["InMemoryBroker"]] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else {}
+
+    def subscribe(self, channel: str):
+        super().subscribe(channel)
+        self.hub.setdefault(channel, set()).add(self)
+
+    def unsubscribe(self, channel: str):
+        super().unsubscribe(channel)
+        subscribers = self.hub.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.hub[channel]
+
+    async def publish(self, channel: str, envelope: Dict):
+        self.stats["published"] += 1
+        for broker in list(self.hub.get(channel, ())):
+            await broker.deliver(channel, envelope)
+
+class RedisBroker(Broker):
+    """Redis pub/sub broker; each worker subscribes only to channels it has local sockets for"""
+
+    def __init__(self, url: str = REDIS_URL):
+        super().__init__()
+        self.url = url
+        self.redis = None
+        self.pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        # Subscription changes are applied by the listener between reads
+        self._pending_subscribe: Set[str] = set()
+        self._pending_unsubscribe: Set[str] = set()
+
+    async def start(self):
+        self.redis = aioredis.from_url(self.url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # Always hold one subscription so the pubsub connection stays open
+        await self.pubsub.subscribe(worker_channel(self.worker_id), *self.channels)
+        self._pending_subscribe.clear()
+        self._listener = asyncio.create_task(self._listen())
+        logger.info(f"Redis broker started for worker {self.worker_id}")
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self.pubsub:
+            await self.pubsub.close()
+        if self.redis:
+            await self.redis.close()
+
+    def subscribe(self, channel: str):
+        if channel in self.channels:
+            return
+        super().subscribe(channel)
+        self._pending_unsubscribe.discard(channel)
+        self._pending_subscribe.add(channel)
+
+    def unsubscribe(self, channel: str):
+        if channel not in self.channels:
+            return
+        super().unsubscribe(channel)
+        self._pending_subscribe.discard(channel)
+        self._pending_unsubscribe.add(channel)
+
+    async def publish(self, channel: str, envelope: Dict):
+        self.stats["published"] += 1
+        try:
+            await self.redis.publish(channel, json.dumps(envelope))
+        except Exception as e:
+            logger.error(f"Failed to publish to {channel}: {e}")
+
+    async def _apply_subscriptions(self):
+        if self._pending_subscribe:
+            channels, self._pending_subscribe = self._pending_subscribe, set()
+            await self.pubsub.subscribe(*channels)
+        if self._pending_unsubscribe:
+            channels, self._pending_unsubscribe = self._pending_unsubscribe, set()
+            await self.pubsub.unsubscribe(*channels)
+
+    async def _listen(self):
+        while True:
+            try:
+                await self._apply_subscriptions()
+                message = await self.pubsub.get_message(timeout=0.1)
+                if message is None or message.get("type") != "message":
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                await self.deliver(channel, json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis broker listener error: {e}")
+                await asyncio.sleep(1)
+
+def create_broker() -> Broker:
+    """Build the broker selected by WS_BROKER"""
+    if WS_BROKER == "redis":
+        return RedisBroker()
+    return InMemoryBroker()
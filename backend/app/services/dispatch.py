@@ -0,0 +1,169 @@
+import asyncio
+import os
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from app.services.driver_presence import DriverPresenceService
+
+logger = logging.getLogger(__name__)
+
+# Drivers offered a ride per wave
+DISPATCH_WAVE_SIZE = int(os.getenv("DISPATCH_WAVE_SIZE", "3"))
+# Search radius of each successive wave (km)
+DISPATCH_WAVE_RADII_KM = tuple(float(radius) for radius in os.getenv("DISPATCH_WAVE_RADII_KM", "2,5,10").split(","))
+# How long drivers of a wave have to answer before the next wave goes out (seconds)
+DISPATCH_WAVE_TIMEOUT_SECONDS = float(os.getenv("DISPATCH_WAVE_TIMEOUT_SECONDS", "15"))
+
+SendFunction = Callable[[dict, str], Awaitable[None]]
+FinishFunction = Callable[[str], Awaitable[None]]
+
+class DispatchJob:
+    """Offer state of one ride request"""
+
+    def __init__(self, ride_id: str, ride_data: Dict):
+        self.ride_id = ride_id
+        self.ride_data = ride_data
+        self.wave = 0
+        self.offered: Set[str] = set()
+        self.declined: Set[str] = set()
+        self.accepted_by: Optional[str] = None
+        # Set when every driver of the current wave declined, to skip the wait
+        self.wave_answered = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+class DispatchEngine:
+    """
+    Offers ride requests to the nearest drivers in expanding waves instead of
+    broadcasting them. The first driver to accept wins and every other open
+    offer is withdrawn. Jobs live on the worker that received the request;
+    answers reaching other workers are forwarded to it over the broker.
+    """
+
+    def __init__(self, presence: DriverPresenceService, send: SendFunction,
+                 wave_size: int = DISPATCH_WAVE_SIZE, radii_km: tuple = DISPATCH_WAVE_RADII_KM,
+                 wave_timeout: float = DISPATCH_WAVE_TIMEOUT_SECONDS,
+                 on_finish: Optional[FinishFunction] = None):
+        self.presence = presence
+        self.send = send
+        # Called with the ride id once a job ends and no newer job replaced it
+        self.on_finish = on_finish
+        self.wave_size = wave_size
+        self.radii_km = radii_km
+        self.wave_timeout = wave_timeout
+        self.jobs: Dict[str, DispatchJob] = {}
+        self.stats = {"dispatched": 0, "waves": 0, "offers_sent": 0, "accepted": 0,
+                      "exhausted": 0, "cancelled": 0, "offers_withdrawn": 0}
+
+    def start(self, ride_id: str, ride_data: Dict) -> DispatchJob:
+        """Begin offering a ride request; runs in the background"""
+        self.cancel(ride_id, reason="replaced")
+        job = DispatchJob(ride_id, ride_data)
+        self.jobs[ride_id] = job
+        job.task = asyncio.create_task(self._run(job))
+        self.stats["dispatched"] += 1
+        return job
+
+    async def _run(self, job: DispatchJob):
+        ride_data = job.ride_data
+        company_id = ride_data.get("company_id")
+        latitude = ride_data.get("pickup_latitude")
+        longitude = ride_data.get("pickup_longitude")
+        try:
+            for wave, radius_km in enumerate(self.radii_km, start=1):
+                drivers = await self._next_drivers(job, company_id, latitude, longitude, radius_km)
+                if not drivers:
+                    continue  # Nobody new in this radius; widen straight away
+                job.wave = wave
+                job.wave_answered.clear()
+                self.stats["waves"] += 1
+                for driver in drivers:
+                    job.offered.add(driver["driver_id"])
+                    self.stats["offers_sent"] += 1
+                    await self.send({
+                        "type": "ride_request",
+                        "data": ride_data,
+                        "offer": {
+                            "wave": wave,
+                            "distance_km": driver.get("distance_km"),
+                            "expires_in_seconds": self.wave_timeout
+                        },
+                        "timestamp": datetime.now(timezone.utc).isoformat()
+                    }, driver["driver_id"])
+                try:
+                    await asyncio.wait_for(job.wave_answered.wait(), timeout=self.wave_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            # Offers stay open; the pending ride TTL tells the rider when to give up
+            self.stats["exhausted"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Dispatch of ride {job.ride_id} failed: {e}")
+
+    async def _next_drivers(self, job: DispatchJob, company_id: str, latitude: float, longitude: float,
+                            radius_km: float) -> List[Dict]:
+        if not company_id or latitude is None or longitude is None:
+            return []
+        excluded = job.offered | {job.ride_data.get("rider_id")}
+        candidates = await self.presence.nearby(
+            company_id, latitude, longitude, radius_km=radius_km, limit=self.wave_size + len(excluded)
+        )
+        return [driver for driver in candidates if driver["driver_id"] not in excluded][:self.wave_size]
+
+    async def accept(self, ride_id: str, driver_id: str) -> bool:
+        """Claim a ride for a driver; False if it was already taken or never offered to them"""
+        job = self.jobs.get(ride_id)
+        if job is None or job.accepted_by is not None or driver_id not in job.offered:
+            return False
+        job.accepted_by = driver_id
+        self.stats["accepted"] += 1
+        await self._finish(job, reason="accepted")
+        return True
+
+    def decline(self, ride_id: str, driver_id: str):
+        """Record a decline; once a whole wave has declined, the next wave goes out"""
+        job = self.jobs.get(ride_id)
+        if job is None or driver_id not in job.offered:
+            return
+        job.declined.add(driver_id)
+        if job.offered <= job.declined:
+            job.wave_answered.set()
+
+    def cancel(self, ride_id: str, reason: str = "cancelled") -> Optional[DispatchJob]:
+        """Stop dispatching a request (rider cancelled or request expired)"""
+        job = self.jobs.get(ride_id)
+        if job is None:
+            return None
+        self.stats["cancelled"] += 1
+        asyncio.create_task(self._finish(job, reason=reason))
+        return job
+
+    async def _finish(self, job: DispatchJob, reason: str):
+        if self.jobs.get(job.ride_id) is job:
+            del self.jobs[job.ride_id]
+        if job.task and job.task is not asyncio.current_task():
+            job.task.cancel()
+        if self.on_finish and job.ride_id not in self.jobs:
+            try:
+                await self.on_finish(job.ride_id)
+            except Exception as e:
+                logger.error(f"Dispatch finish hook failed for ride {job.ride_id}: {e}")
+
+        # Withdraw the offers nobody answered
+        for driver_id in job.offered - job.declined - {job.accepted_by}:
+            self.stats["offers_withdrawn"] += 1
+            await self.send({
+                "type": "ride_offer_cancelled",
+                "data": {"ride_id": job.ride_id, "reason": reason},
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            }, driver_id)
+
+    def get_stats(self) -> Dict:
+        accepted = self.stats["accepted"]
+        return {
+            **self.stats,
+            "active": len(self.jobs),
+            "offers_per_accepted_ride": round(self.stats["offers_sent"] / accepted, 2) if accepted else None,
+            "wave_size": self.wave_size,
+            "wave_radii_km": list(self.radii_km)
+        }
@@ -0,0 +1,323 @@
+import heapq
+import math
+import os
+import time
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple
+import redis
+import redis.asyncio as aioredis
+from app.services.location_service import LocationService
+
+logger = logging.getLogger(__name__)
+
+# "memory" (single worker) or "redis" (shared across workers via Redis GEO)
+DRIVER_PRESENCE_BACKEND = os.getenv("DRIVER_PRESENCE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+# A driver without a location heartbeat for this long is no longer available (seconds)
+DRIVER_PRESENCE_TTL_SECONDS = float(os.getenv("DRIVER_PRESENCE_TTL_SECONDS", "90"))
+# Grid cell size of the in-process spatial index (degrees, ~1.1 km of latitude)
+DRIVER_GRID_CELL_DEGREES = float(os.getenv("DRIVER_GRID_CELL_DEGREES", "0.01"))
+
+KM_PER_DEGREE = 111.32
+
+class DriverPresence:
+    """Last known position and availability of one driver"""
+    __slots__ = ("driver_id", "company_id", "latitude", "longitude", "is_available", "last_seen", "cell")
+
+    def __init__(self, driver_id: str, company_id: str):
+        self.driver_id = driver_id
+        self.company_id = company_id
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.is_available = False
+        self.last_seen = 0.0
+        # Grid cell the driver is indexed under (None when not indexed)
+        self.cell: Optional[Tuple[str, int, int]] = None
+
+    def to_dict(self, distance_km: float = None) -> Dict:
+        return {
+            "driver_id": self.driver_id,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "distance_km": round(distance_km, 3) if distance_km is not None else None,
+            "last_seen_seconds": round(max(0.0, time.time() - self.last_seen), 1)
+        }
+
+class DriverPresenceService(ABC):
+    """Driver availability with a heartbeat TTL and radius lookups"""
+
+    def __init__(self, ttl_seconds: float = DRIVER_PRESENCE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"heartbeats": 0, "expired": 0, "queries": 0, "candidates_checked": 0, "errors": 0}
+
+    @abstractmethod
+    async def heartbeat(self, driver_id: str, company_id: str, latitude: float, longitude: float,
+                        is_available: bool):
+        """Record a driver's position and availability, renewing its TTL"""
+
+    @abstractmethod
+    async def set_available(self, driver_id: str, is_available: bool):
+        """Change availability without a new position"""
+
+    @abstractmethod
+    async def remove(self, driver_id: str):
+        """Forget a driver"""
+
+    @abstractmethod
+    async def nearby(self, company_id: str, latitude: float, longitude: float,
+                     radius_km: float = 5.0, limit: int = 20) -> List[Dict]:
+        """Available drivers of a company within radius_km, nearest first"""
+
+    async def get_stats(self) -> Dict:
+        return {"backend": self.__class__.__name__, "ttl_seconds": self.ttl_seconds, **self.stats}
+
+class InMemoryDriverPresence(DriverPresenceService):
+    """
+    In-process presence with a uniform grid index per company. Moving a driver
+    touches at most two cells; a radius query only reads the cells overlapping
+    the search box. Expiry pops a heap of (expires_at, driver_id).
+    """
+
+    def __init__(self, ttl_seconds: float = DRIVER_PRESENCE_TTL_SECONDS,
+                 cell_degrees: float = DRIVER_GRID_CELL_DEGREES):
+        super().__init__(ttl_seconds)
+        self.cell_degrees = cell_degrees
+        self.drivers: Dict[str, DriverPresence] = {}
+        # (company_id, cell_x, cell_y) -> available driver ids
+        self.grid: Dict[Tuple[str, int, int], Set[str]] = {}
+        self._expires_at: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    def _cell(self, company_id: str, latitude: float, longitude: float) -> Tuple[str, int, int]:
+        return (company_id, math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def _reindex(self, presence: DriverPresence):
+        cell = self._cell(presence.company_id, presence.latitude, presence.longitude) if presence.is_available else None
+        if cell == presence.cell:
+            return
+        if presence.cell is not None:
+            members = self.grid.get(presence.cell)
+            if members is not None:
+                members.discard(presence.driver_id)
+                if not members:
+                    del self.grid[presence.cell]
+        if cell is not None:
+            self.grid.setdefault(cell, set()).add(presence.driver_id)
+        presence.cell = cell
+
+    def _expire(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, driver_id = heapq.heappop(self._heap)
+            if self._expires_at.get(driver_id) != expires_at:
+                continue  # Renewed since
+            self._drop(driver_id)
+            self.stats["expired"] += 1
+        # Renewals leave one stale heap entry each; rebuild when they dominate
+        if len(self._heap) > 2 * len(self._expires_at) + 64:
+            self._heap = [(expires_at, driver_id) for driver_id, expires_at in self._expires_at.items()]
+            heapq.heapify(self._heap)
+
+    def _drop(self, driver_id: str):
+        presence = self.drivers.pop(driver_id, None)
+        self._expires_at.pop(driver_id, None)
+        if presence:
+            presence.is_available = False
+            self._reindex(presence)
+
+    async def heartbeat(self, driver_id: str, company_id: str, latitude: float, longitude: float,
+                        is_available: bool):
+        now = time.monotonic()
+        self._expire(now)
+        presence = self.drivers.get(driver_id)
+        if presence is None or presence.company_id != company_id:
+            if presence is not None:
+                self._drop(driver_id)
+            presence = DriverPresence(driver_id, company_id)
+            self.drivers[driver_id] = presence
+        presence.latitude = latitude
+        presence.longitude = longitude
+        presence.is_available = bool(is_available)
+        presence.last_seen = time.time()
+        self._reindex(presence)
+
+        expires_at = now + self.ttl_seconds
+        self._expires_at[driver_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, driver_id))
+        self.stats["heartbeats"] += 1
+
+    async def set_available(self, driver_id: str, is_available: bool):
+        presence = self.drivers.get(driver_id)
+        if presence:
+            presence.is_available = bool(is_available)
+            self._reindex(presence)
+
+    async def remove(self, driver_id: str):
+        self._drop(driver_id)
+
+    async def nearby(self, company_id: str, latitude: float, longitude: float,
+                     radius_km: float = 5.0, limit: int = 20) -> List[Dict]:
+        self._expire(time.monotonic())
+        self.stats["queries"] += 1
+
+        # Bounding box of the search circle, in cells
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        min_x = math.floor((latitude - dlat) / self.cell_degrees)
+        max_x = math.floor((latitude + dlat) / self.cell_degrees)
+        min_y = math.floor((longitude - dlon) / self.cell_degrees)
+        max_y = math.floor((longitude + dlon) / self.cell_degrees)
+
+        results = []
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.grid):
+            # Huge radius: scanning the occupied cells is cheaper than the box
+            cells = [cell for cell in self.grid if cell[0] == company_id
+                     and min_x <= cell[1] <= max_x and min_y <= cell[2] <= max_y]
+        else:
+            cells = [(company_id, x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+        for cell in cells:
+            for driver_id in self.grid.get(cell, ()):
+                presence = self.drivers[driver_id]
+                self.stats["candidates_checked"] += 1
+                distance = LocationService.calculate_distance(latitude, longitude, presence.latitude, presence.longitude)
+                if distance <= radius_km:
+                    results.append((distance, presence))
+
+        results.sort(key=lambda item: item[0])
+        return [presence.to_dict(distance) for distance, presence in results[:limit]]
+
+    async def get_stats(self) -> Dict:
+        stats = await super().get_stats()
+        stats.update(
+            tracked_drivers=len(self.drivers),
+            available_drivers=sum(len(members) for members in self.grid.values()),
+            grid_cells=len(self.grid)
+        )
+        return stats
+
+class RedisDriverPresence(DriverPresenceService):
+    """
+    Presence shared by all workers. Available drivers live in a GEO set per
+    company; a sorted set of expiry times per company drops silent drivers.
+    A Redis outage is logged and degrades lookups to empty results; it never
+    fails the location update or WebSocket message that triggered it.
+    """
+
+    def __init__(self, url: str = REDIS_URL, ttl_seconds: float = DRIVER_PRESENCE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def _geo_key(company_id: str) -> str:
+        return f"drivers:geo:{company_id}"
+
+    @staticmethod
+    def _expiry_key(company_id: str) -> str:
+        return f"drivers:expires:{company_id}"
+
+    @staticmethod
+    def _driver_key(driver_id: str) -> str:
+        return f"drivers:presence:{driver_id}"
+
+    async def heartbeat(self, driver_id: str, company_id: str, latitude: float, longitude: float,
+                        is_available: bool):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.hset(self._driver_key(driver_id), mapping={
+            "company_id": company_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "is_available": int(bool(is_available)),
+            "last_seen": now
+        })
+        pipe.expire(self._driver_key(driver_id), int(self.ttl_seconds) + 1)
+        if is_available:
+            pipe.geoadd(self._geo_key(company_id), (longitude, latitude, driver_id))
+            pipe.zadd(self._expiry_key(company_id), {driver_id: now + self.ttl_seconds})
+        else:
+            pipe.zrem(self._geo_key(company_id), driver_id)
+            pipe.zrem(self._expiry_key(company_id), driver_id)
+        try:
+            await pipe.execute()
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            logger.error(f"Redis driver presence heartbeat failed for driver {driver_id}: {e}")
+            return
+        self.stats["heartbeats"] += 1
+
+    async def set_available(self, driver_id: str, is_available: bool):
+        try:
+            state = await self.redis.hgetall(self._driver_key(driver_id))
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            logger.error(f"Redis driver presence lookup failed for driver {driver_id}: {e}")
+            return
+        if state:
+            await self.heartbeat(driver_id, state["company_id"], float(state["latitude"]),
+                                 float(state["longitude"]), is_available)
+
+    async def remove(self, driver_id: str):
+        try:
+            state = await self.redis.hgetall(self._driver_key(driver_id))
+            pipe = self.redis.pipeline()
+            if state:
+                pipe.zrem(self._geo_key(state["company_id"]), driver_id)
+                pipe.zrem(self._expiry_key(state["company_id"]), driver_id)
+            pipe.delete(self._driver_key(driver_id))
+            await pipe.execute()
+        except redis.RedisError as e:
+            # The key's TTL still removes the driver once heartbeats stop
+            self.stats["errors"] += 1
+            logger.error(f"Redis driver presence removal failed for driver {driver_id}: {e}")
+
+    async def _expire(self, company_id: str):
+        expired = await self.redis.zrangebyscore(self._expiry_key(company_id), "-inf", time.time())
+        if expired:
+            pipe = self.redis.pipeline()
+            pipe.zrem(self._geo_key(company_id), *expired)
+            pipe.zrem(self._expiry_key(company_id), *expired)
+            await pipe.execute()
+            self.stats["expired"] += len(expired)
+
+    async def nearby(self, company_id: str, latitude: float, longitude: float,
+                     radius_km: float = 5.0, limit: int = 20) -> List[Dict]:
+        self.stats["queries"] += 1
+        try:
+            await self._expire(company_id)
+            matches = await self.redis.geosearch(
+                self._geo_key(company_id), longitude=longitude, latitude=latitude,
+                radius=radius_km, unit="km", sort="ASC", count=limit,
+                withdist=True, withcoord=True
+            )
+            # Expiry scores are last_seen + TTL
+            expiries = await self.redis.zmscore(
+                self._expiry_key(company_id), [match[0] for match in matches]
+            ) if matches else []
+        except redis.RedisError as e:
+            self.stats["errors"] += 1
+            logger.error(f"Redis driver presence query failed: {e}")
+            return []
+
+        self.stats["candidates_checked"] += len(matches)
+        if not matches:
+            return []
+        now = time.time()
+        results = []
+        for (driver_id, distance, (driver_lon, driver_lat)), expires_at in zip(matches, expiries):
+            last_seen = expires_at - self.ttl_seconds if expires_at is not None else now
+            results.append({
+                "driver_id": driver_id,
+                "latitude": driver_lat,
+                "longitude": driver_lon,
+                "distance_km": round(float(distance), 3),
+                "last_seen_seconds": round(max(0.0, now - last_seen), 1)
+            })
+        return results
+
+def create_driver_presence() -> DriverPresenceService:
+    """Build the presence backend selected by DRIVER_PRESENCE_BACKEND"""
+    if DRIVER_PRESENCE_BACKEND == "redis":
+        return RedisDriverPresence()
+    return InMemoryDriverPresence()
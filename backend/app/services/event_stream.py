@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import logging
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, List, Optional, Set
+from app.services.broker import Broker, create_broker
+
+logger = logging.getLogger(__name__)
+
+# Events kept per stream for Last-Event-ID resume
+SSE_BUFFER_SIZE = int(os.getenv("SSE_BUFFER_SIZE", "200"))
+# Streams buffered per worker; the least recently used idle ones are dropped
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "10000"))
+# Comment line sent on quiet streams so proxies keep the connection open (seconds)
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# Unsent bytes allowed per connection before it is closed; the client resumes from Last-Event-ID
+SSE_MAX_QUEUED_BYTES = int(os.getenv("SSE_MAX_QUEUED_BYTES", str(256 * 1024)))
+# Reconnect delay suggested to EventSource clients (milliseconds)
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+
+# Broker channel every worker listens on, so each one can resume any stream
+EVENTS_CHANNEL = "sse:events"
+
+def user_stream(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def company_stream(company_id: str) -> str:
+    return f"company:{company_id}"
+
+def format_event(event_id: int, event: str, data: Dict) -> str:
+    """Encode one event in the text/event-stream wire format"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+
+class StreamBuffer:
+    """Recent encoded events of one stream"""
+    __slots__ = ("events", "evicted_up_to", "subscribers")
+
+    def __init__(self, size: int):
+        self.events = deque(maxlen=size)
+        # Highest event id pushed out of the buffer; older resumes are impossible
+        self.evicted_up_to = 0
+        self.subscribers: Set["StreamSubscription"] = set()
+
+    def append(self, event_id: int, text: str):
+        if len(self.events) == self.events.maxlen:
+            self.evicted_up_to = max(self.evicted_up_to, self.events[0][0])
+        self.events.append((event_id, text))
+
+class StreamSubscription:
+    """One open SSE connection with a byte-capped queue of encoded events"""
+
+    def __init__(self, stream: str, max_bytes: int):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.overflowed = False
+        self.ready = asyncio.Event()
+
+    def push(self, text: str) -> bool:
+        if self.overflowed:
+            return False
+        if self.queued_bytes + len(text) > self.max_bytes:
+            # Too slow a reader; drop the queue and let the client resume from its last id
+            self.overflowed = True
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.ready.set()
+            return False
+        self.queue.append(text)
+        self.queued_bytes += len(text)
+        self.ready.set()
+        return True
+
+    def drain(self) -> str:
+        chunk = "".join(self.queue)
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.ready.clear()
+        return chunk
+
+class EventStreamHub:
+    """
+    Server-Sent Events fan-out for read-only clients. Ride events from the
+    outbox are published over the broker so every worker buffers every stream;
+    an SSE connection on any worker can resume from its Last-Event-ID.
+    """
+
+    def __init__(self, broker: Broker = None, buffer_size: int = SSE_BUFFER_SIZE,
+                 max_streams: int = SSE_MAX_STREAMS, max_queued_bytes: int = SSE_MAX_QUEUED_BYTES,
+                 heartbeat_seconds: float = SSE_HEARTBEAT_SECONDS):
+        self.broker = broker or create_broker()
+        self.broker.set_handler(self._on_broker_message)
+        self.buffer_size = buffer_size
+        self.max_streams = max_streams
+        self.max_queued_bytes = max_queued_bytes
+        self.heartbeat_seconds = heartbeat_seconds
+        self.streams: "OrderedDict[str, StreamBuffer]" = OrderedDict()
+        # Highest event id lost when an idle stream was dropped
+        self.dropped_streams_up_to = 0
+        # First event id this worker received; earlier events never reached its buffers
+        self.first_event_id: Optional[int] = None
+        self.stats = {"events": 0, "subscriptions": 0, "resumed": 0, "resets": 0,
+                      "overflows": 0, "heartbeats": 0, "streams_dropped": 0}
+
+    async def start(self):
+        await self.broker.start()
+        self.broker.subscribe(EVENTS_CHANNEL)
+
+    async def stop(self):
+        await self.broker.stop()
+
+    async def publish(self, event_id: int, event: str, company_id: Optional[str],
+                      recipient_ids: List[str], data: Dict):
+        """Send an event to its recipients' streams and its company's stream on every worker"""
+        await self.broker.publish(EVENTS_CHANNEL, self.broker.wrap("sse", EVENTS_CHANNEL, {
+            "id": event_id,
+            "event": event,
+            "company_id": company_id,
+            "recipient_ids": recipient_ids,
+            "data": data
+        }))
+
+    async def _on_broker_message(self, channel: str, envelope: Dict):
+        message = envelope.get("message", {})
+        streams = [user_stream(user_id) for user_id in message.get("recipient_ids") or []]
+        if message.get("company_id"):
+            streams.append(company_stream(message["company_id"]))
+        self.record(message["id"], message["event"], message.get("data") or {}, streams)
+
+    def record(self, event_id: int, event: str, data: Dict, streams: List[str]):
+        """Buffer an event and queue it for the open connections of each stream"""
+        # Encoded once, shared by every stream and subscriber
+        text = format_event(event_id, event, data)
+        self.stats["events"] += 1
+        if self.first_event_id is None:
+            self.first_event_id = event_id
+        for stream in streams:
+            buffer = self._buffer(stream)
+            buffer.append(event_id, text)
+            for subscription in list(buffer.subscribers):
+                if not subscription.push(text):
+                    self.stats["overflows"] += 1
+                    buffer.subscribers.discard(subscription)
+
+    def _buffer(self, stream: str) -> StreamBuffer:
+        buffer = self.streams.get(stream)
+        if buffer is None:
+            buffer = self.streams[stream] = StreamBuffer(self.buffer_size)
+            self._drop_idle_streams()
+        else:
+            self.streams.move_to_end(stream)
+        return buffer
+
+    def _drop_idle_streams(self):
+        excess = len(self.streams) - self.max_streams
+        for stream in list(self.streams):
+            if excess <= 0:
+                break
+            buffer = self.streams[stream]
+            if buffer.subscribers:
+                continue
+            if buffer.events:
+                self.dropped_streams_up_to = max(self.dropped_streams_up_to, buffer.events[-1][0])
+            del self.streams[stream]
+            self.stats["streams_dropped"] += 1
+            excess -= 1
+
+    def subscribe(self, stream: str, last_event_id: Optional[int] = None) -> StreamSubscription:
+        """Open a stream; events after last_event_id are queued first, or a reset if they are gone"""
+        subscription = StreamSubscription(stream, self.max_queued_bytes)
+        buffer = self._buffer(stream)
+        buffer.subscribers.add(subscription)
+        self.stats["subscriptions"] += 1
+
+        if last_event_id is not None:
+            # Resumable only if every event after last_event_id passed through this worker: a fresh
+            # worker, or a client that was last served by another one, may have missed some
+            if self.first_event_id is None or last_event_id < max(
+                self.first_event_id - 1, buffer.evicted_up_to, self.dropped_streams_up_to
+            ):
+                # Missed events are gone; the client reloads its view over REST
+                self.stats["resets"] += 1
+                subscription.push(f"event: reset\ndata: {json.dumps({'last_event_id': last_event_id})}\n\n")
+            else:
+                self.stats["resumed"] += 1
+                for event_id, text in buffer.events:
+                    if event_id > last_event_id:
+                        subscription.push(text)
+        return subscription
+
+    def unsubscribe(self, subscription: StreamSubscription):
+        buffer = self.streams.get(subscription.stream)
+        if buffer is not None:
+            buffer.subscribers.discard(subscription)
+
+    async def iterate(self, subscription: StreamSubscription) -> AsyncIterator[str]:
+        """Body of a text/event-stream response"""
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                if not subscription.queue and not subscription.overflowed:
+                    try:
+                        await asyncio.wait_for(subscription.ready.wait(), timeout=self.heartbeat_seconds)
+                    except asyncio.TimeoutError:
+                        self.stats["heartbeats"] += 1
+                        yield ": heartbeat\n\n"
+                        continue
+                if subscription.overflowed:
+                    return  # Closing makes EventSource reconnect with Last-Event-ID
+                yield subscription.drain()
+        finally:
+            self.unsubscribe(subscription)
+
+    def get_stats(self) -> Dict:
+        connections = sum(len(buffer.subscribers) for buffer in self.streams.values())
+        return {
+            **self.stats,
+            "streams": len(self.streams),
+            "open_connections": connections,
+            "first_event_id": self.first_event_id,
+            "buffered_events": sum(len(buffer.events) for buffer in self.streams.values()),
+            "buffer_size": self.buffer_size,
+            "max_queued_bytes": self.max_queued_bytes
+        }
+
+# Global instance
+event_stream_hub = EventStreamHub()
@@ -0,0 +1,340 @@
+import json
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+import msgpack
+
+# WebSocket subprotocol negotiated at the /ws/{user_id} handshake
+BINARY_SUBPROTOCOL = "rideshare.bin.v1"
+
+# Frame type (first byte of every binary frame)
+FRAME_LOCATION_FULL = 0x01
+FRAME_LOCATION_DELTA = 0x02
+FRAME_DRIVER_LOCATION_FULL = 0x03
+FRAME_DRIVER_LOCATION_DELTA = 0x04
+FRAME_MSGPACK = 0x10
+FRAME_MSGPACK_DEFLATE = 0x11
+FRAME_SEQUENCED = 0x12
+
+# Binary frames larger than this many bytes are deflate-compressed (0 disables)
+WS_COMPRESSION_THRESHOLD = int(os.getenv("WS_COMPRESSION_THRESHOLD", "1024"))
+WS_COMPRESSION_LEVEL = int(os.getenv("WS_COMPRESSION_LEVEL", "6"))
+# Largest MessagePack payload a compressed inbound frame may inflate to (bytes)
+MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", "1048576"))
+
+# Coordinates are quantized to 1e-6 degrees (~11 cm)
+COORDINATE_SCALE = 1_000_000
+SPEED_SCALE = 10       # km/h -> 0.1 km/h units
+HEADING_SCALE = 100    # degrees -> 0.01 degree units
+MISSING_U16 = 0xFFFF
+
+# type, flags, lat, lon, speed, heading, timestamp (ms since epoch)
+LOCATION_FULL = struct.Struct("<BBiiHHQ")
+# type, flags, dlat, dlon, speed, heading, dt (ms)
+LOCATION_DELTA = struct.Struct("<BBhhHHH")
+# type, sequence number; followed by the frame it applies to
+SEQUENCE_HEADER = struct.Struct("<BQ")
+# Length prefix of the ride_id and driver_id strings after a full driver location
+ID_LENGTH = struct.Struct("<B")
+
+INT16_MIN, INT16_MAX = -32768, 32767
+
+# Flag bits
+FLAG_HAS_DRIVER = 0x01
+FLAG_IS_DRIVER = 0x02
+FLAG_HAS_AVAILABLE = 0x04
+FLAG_IS_AVAILABLE = 0x08
+
+# Location messages that fit the fixed layout
+LOCATION_MESSAGE_TYPE = "location_update"
+LOCATION_FIELDS = frozenset({"latitude", "longitude", "speed", "heading", "is_driver", "is_available", "timestamp"})
+LOCATION_ENVELOPE = frozenset({"type", "data", "timestamp"})
+# Driver positions pushed to a ride's riders, with the ride and driver ids
+DRIVER_LOCATION_MESSAGE_TYPE = "driver_location"
+DRIVER_LOCATION_FIELDS = frozenset({"ride_id", "driver_id", "latitude", "longitude", "speed", "heading"})
+# Frames whose encoding depends on the previous one sent on the connection
+DELTA_MESSAGE_TYPES = frozenset({LOCATION_MESSAGE_TYPE, DRIVER_LOCATION_MESSAGE_TYPE})
+
+class FrameProtocolError(ValueError):
+    """Raised when a binary frame cannot be decoded"""
+
+def _timestamp_ms(value) -> int:
+    """Convert an ISO timestamp (or None) to milliseconds since epoch"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value:
+        try:
+            parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return int(parsed.timestamp() * 1000)
+        except ValueError:
+            pass
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+def _iso(timestamp_ms: int) -> str:
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).isoformat()
+
+def _pack_u16(value, scale: int, modulo: Optional[int] = None) -> int:
+    if value is None:
+        return MISSING_U16
+    scaled = int(round(float(value) * scale))
+    if modulo is not None:
+        scaled %= modulo
+    return max(0, min(MISSING_U16 - 1, scaled))
+
+def _unpack_u16(value: int, scale: int) -> Optional[float]:
+    return None if value == MISSING_U16 else value / scale
+
+def sequenced_text(text: str, seq: int) -> str:
+    """Add a "seq" key to an already serialized JSON object without re-encoding it"""
+    if text == "{}":
+        return f'{{"seq": {seq}}}'
+    return f'{{"seq": {seq}, ' + text[1:]
+
+def pack_message(message: Dict, threshold: int = WS_COMPRESSION_THRESHOLD) -> bytes:
+    """MessagePack frame, deflate-compressed when larger than the threshold"""
+    packed = msgpack.packb(message, use_bin_type=True)
+    if threshold and len(packed) > threshold:
+        # Raw deflate stream, same format as permessage-deflate
+        compressor = zlib.compressobj(WS_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(packed) + compressor.flush()
+        if len(compressed) < len(packed):
+            return bytes((FRAME_MSGPACK_DEFLATE,)) + compressed
+    return bytes((FRAME_MSGPACK,)) + packed
+
+class SharedFrame:
+    """
+    A message sent to many connections, encoded at most once per wire format.
+    Treat it as immutable: every recipient's queue holds the same instance.
+    """
+    __slots__ = ("message", "message_type", "_text", "_binary")
+
+    def __init__(self, message: Dict):
+        self.message = message
+        self.message_type = message.get("type")
+        self._text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message)
+        return self._text
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = pack_message(self.message)
+        return self._binary
+
+def inflate(payload: bytes, limit: int = MAX_FRAME_BYTES) -> bytes:
+    """Decompress a raw deflate payload, refusing to inflate past the limit"""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(payload, limit)
+    if decompressor.unconsumed_tail:
+        raise FrameProtocolError(f"Compressed frame inflates past {limit} bytes")
+    return data
+
+def _is_location(message: Dict, fields: frozenset) -> bool:
+    data = message.get("data")
+    return (isinstance(data, dict) and LOCATION_ENVELOPE.issuperset(message)
+            and fields.issuperset(data)
+            and data.get("latitude") is not None and data.get("longitude") is not None)
+
+class FrameCodec:
+    """
+    Per-connection encoder/decoder for the binary subprotocol.
+    Location updates (inbound) and driver locations (outbound) use fixed-layout
+    structs with delta encoding against the previous frame of the same kind
+    in the same direction; other messages use MessagePack.
+    """
+
+    def __init__(self):
+        # Last (lat, lon, timestamp_ms) sent and received on this connection
+        self._sent: Optional[Tuple[int, int, int]] = None
+        self._received: Optional[Tuple[int, int, int]] = None
+        # Last (lat, lon, timestamp_ms, ride_id, driver_id) of a driver location
+        self._sent_driver: Optional[Tuple[int, int, int, str, str]] = None
+        self._received_driver: Optional[Tuple[int, int, int, str, str]] = None
+
+    def encode(self, message: Dict, seq: Optional[int] = None) -> bytes:
+        """Encode an outgoing message (a dict or a SharedFrame), optionally tagged with a sequence number"""
+        if seq is not None:
+            return SEQUENCE_HEADER.pack(FRAME_SEQUENCED, seq) + self.encode(message)
+        if isinstance(message, SharedFrame):
+            # Location frames are delta-encoded per connection and cannot be shared
+            if message.message_type not in DELTA_MESSAGE_TYPES:
+                return message.binary()
+            message = message.message
+        message_type = message.get("type")
+        if message_type == LOCATION_MESSAGE_TYPE and _is_location(message, LOCATION_FIELDS):
+            data = message["data"]
+            return self._encode_location(data, message.get("timestamp") or data.get("timestamp"))
+        if message_type == DRIVER_LOCATION_MESSAGE_TYPE and _is_location(message, DRIVER_LOCATION_FIELDS):
+            return self._encode_driver_location(message["data"], message.get("timestamp"))
+        return pack_message(message)
+
+    def decode(self, frame: bytes) -> Dict:
+        """Decode an incoming frame into the same dict the JSON path produces"""
+        if not frame:
+            raise FrameProtocolError("Empty frame")
+
+        if frame[0] == FRAME_SEQUENCED:
+            try:
+                _, seq = SEQUENCE_HEADER.unpack_from(frame)
+            except struct.error as e:
+                raise FrameProtocolError(f"Malformed frame: {e}")
+            frame = frame[SEQUENCE_HEADER.size:]
+            # Exactly one sequence header; a nested one is malformed
+            if frame[:1] == bytes((FRAME_SEQUENCED,)):
+                raise FrameProtocolError("Nested sequenced frame")
+            message = self._decode_frame(frame)
+            message["seq"] = seq
+            return message
+        return self._decode_frame(frame)
+
+    def _decode_frame(self, frame: bytes) -> Dict:
+        if not frame:
+            raise FrameProtocolError("Empty frame")
+
+        frame_type = frame[0]
+        try:
+            if frame_type in (FRAME_MSGPACK, FRAME_MSGPACK_DEFLATE):
+                payload = frame[1:]
+                if frame_type == FRAME_MSGPACK_DEFLATE:
+                    payload = inflate(payload)
+                message = msgpack.unpackb(payload, raw=False)
+                if not isinstance(message, dict):
+                    raise FrameProtocolError("MessagePack frame must contain a map")
+                return message
+            if frame_type in (FRAME_DRIVER_LOCATION_FULL, FRAME_DRIVER_LOCATION_DELTA):
+                return self._decode_driver_location(frame)
+            if frame_type == FRAME_LOCATION_FULL:
+                _, flags, lat, lon, speed, heading, ts = LOCATION_FULL.unpack(frame)
+            elif frame_type == FRAME_LOCATION_DELTA:
+                if self._received is None:
+                    raise FrameProtocolError("Delta frame without a preceding full frame")
+                _, flags, dlat, dlon, speed, heading, dt = LOCATION_DELTA.unpack(frame)
+                lat = self._received[0] + dlat
+                lon = self._received[1] + dlon
+                ts = self._received[2] + dt
+            else:
+                raise FrameProtocolError(f"Unknown frame type: {frame_type}")
+            # Out-of-range timestamps are malformed frames too, not connection errors
+            timestamp = _iso(ts)
+        except (struct.error, ValueError, OverflowError, OSError, zlib.error, msgpack.UnpackException) as e:
+            if isinstance(e, FrameProtocolError):
+                raise
+            raise FrameProtocolError(f"Malformed frame: {e}")
+
+        self._received = (lat, lon, ts)
+        return {
+            "type": LOCATION_MESSAGE_TYPE,
+            "data": self._location_data(flags, lat, lon, speed, heading, timestamp),
+            "timestamp": timestamp
+        }
+
+    def _decode_driver_location(self, frame: bytes) -> Dict:
+        """Driver location frame; ids follow a full frame and carry over to deltas"""
+        if frame[0] == FRAME_DRIVER_LOCATION_FULL:
+            _, flags, lat, lon, speed, heading, ts = LOCATION_FULL.unpack_from(frame)
+            offset = LOCATION_FULL.size
+            ids = []
+            for _ in range(2):
+                (length,) = ID_LENGTH.unpack_from(frame, offset)
+                offset += ID_LENGTH.size
+                value = frame[offset:offset + length]
+                if len(value) != length:
+                    raise FrameProtocolError("Truncated driver location ids")
+                ids.append(value.decode())
+                offset += length
+            if offset != len(frame):
+                raise FrameProtocolError("Trailing bytes after driver location")
+            ride_id, driver_id = ids
+        else:
+            if self._received_driver is None:
+                raise FrameProtocolError("Delta frame without a preceding full frame")
+            _, flags, dlat, dlon, speed, heading, dt = LOCATION_DELTA.unpack(frame)
+            previous_lat, previous_lon, previous_ts, ride_id, driver_id = self._received_driver
+            lat, lon, ts = previous_lat + dlat, previous_lon + dlon, previous_ts + dt
+
+        self._received_driver = (lat, lon, ts, ride_id, driver_id)
+        data = {"ride_id": ride_id, "driver_id": driver_id}
+        data.update(self._location_data(flags, lat, lon, speed, heading, None))
+        return {"type": DRIVER_LOCATION_MESSAGE_TYPE, "data": data, "timestamp": _iso(ts)}
+
+    def _encode_location(self, data: Dict, timestamp) -> bytes:
+        flags = 0
+        if data.get("is_driver") is not None:
+            flags |= FLAG_HAS_DRIVER | (FLAG_IS_DRIVER if data["is_driver"] else 0)
+        if data.get("is_available") is not None:
+            flags |= FLAG_HAS_AVAILABLE | (FLAG_IS_AVAILABLE if data["is_available"] else 0)
+        fields = self._pack_fields(data, timestamp)
+
+        previous = self._sent
+        self._sent = (fields[0], fields[1], fields[4])
+        delta = self._delta(fields, previous)
+        if delta is not None:
+            return LOCATION_DELTA.pack(FRAME_LOCATION_DELTA, flags, *delta)
+        return LOCATION_FULL.pack(FRAME_LOCATION_FULL, flags, *fields)
+
+    def _encode_driver_location(self, data: Dict, timestamp) -> bytes:
+        ride_id, driver_id = str(data.get("ride_id") or ""), str(data.get("driver_id") or "")
+        ids = [value.encode() for value in (ride_id, driver_id)]
+        if any(len(value) > 0xFF for value in ids):
+            return pack_message({"type": DRIVER_LOCATION_MESSAGE_TYPE, "data": data, "timestamp": timestamp})
+        fields = self._pack_fields(data, timestamp)
+
+        previous = self._sent_driver
+        self._sent_driver = (fields[0], fields[1], fields[4], ride_id, driver_id)
+        # Deltas only continue the same ride's track
+        if previous is not None and previous[3:] == (ride_id, driver_id):
+            delta = self._delta(fields, previous)
+            if delta is not None:
+                return LOCATION_DELTA.pack(FRAME_DRIVER_LOCATION_DELTA, 0, *delta)
+        frame = LOCATION_FULL.pack(FRAME_DRIVER_LOCATION_FULL, 0, *fields)
+        return frame + b"".join(ID_LENGTH.pack(len(value)) + value for value in ids)
+
+    @staticmethod
+    def _pack_fields(data: Dict, timestamp) -> Tuple[int, int, int, int, int]:
+        """(lat, lon, speed, heading, timestamp_ms) in wire units"""
+        return (
+            int(round(float(data["latitude"]) * COORDINATE_SCALE)),
+            int(round(float(data["longitude"]) * COORDINATE_SCALE)),
+            _pack_u16(data.get("speed"), SPEED_SCALE),
+            _pack_u16(data.get("heading"), HEADING_SCALE, modulo=360 * HEADING_SCALE),
+            _timestamp_ms(timestamp)
+        )
+
+    @staticmethod
+    def _delta(fields: Tuple, previous: Optional[Tuple]) -> Optional[Tuple[int, int, int, int, int]]:
+        """(dlat, dlon, speed, heading, dt) when the move fits a delta frame"""
+        if previous is None:
+            return None
+        lat, lon, speed, heading, ts = fields
+        dlat, dlon, dt = lat - previous[0], lon - previous[1], ts - previous[2]
+        if INT16_MIN <= dlat <= INT16_MAX and INT16_MIN <= dlon <= INT16_MAX and 0 <= dt < MISSING_U16:
+            return dlat, dlon, speed, heading, dt
+        return None
+
+    @staticmethod
+    def _location_data(flags: int, lat: int, lon: int, speed: int, heading: int,
+                       timestamp: Optional[str]) -> Dict:
+        data = {
+            "latitude": lat / COORDINATE_SCALE,
+            "longitude": lon / COORDINATE_SCALE
+        }
+        if timestamp is not None:
+            data["timestamp"] = timestamp
+        speed_value = _unpack_u16(speed, SPEED_SCALE)
+        if speed_value is not None:
+            data["speed"] = speed_value
+        heading_value = _unpack_u16(heading, HEADING_SCALE)
+        if heading_value is not None:
+            data["heading"] = heading_value
+        if flags & FLAG_HAS_DRIVER:
+            data["is_driver"] = bool(flags & FLAG_IS_DRIVER)
+        if flags & FLAG_HAS_AVAILABLE:
+            data["is_available"] = bool(flags & FLAG_IS_AVAILABLE)
+        return data
@@ -0,0 +1,255 @@
+import math
+import os
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from app.services.notification_service import notification_service, NotificationType
+
+logger = logging.getLogger(__name__)
+
+# Fence radii in kilometers
+PICKUP_FENCE_RADIUS_KM = float(os.getenv("PICKUP_FENCE_RADIUS_KM", "0.3"))
+DROPOFF_FENCE_RADIUS_KM = float(os.getenv("DROPOFF_FENCE_RADIUS_KM", "0.2"))
+
+# A fence is only left once the driver is this many radii away (hysteresis)
+FENCE_EXIT_FACTOR = 1.5
+# Minimum seconds between two entry events on the same fence
+FENCE_REENTRY_COOLDOWN = 120.0
+# How long a "driver has no active ride" lookup is trusted (seconds), and how many are kept
+FENCE_MISS_TTL = float(os.getenv("FENCE_MISS_TTL", "30"))
+FENCE_MAX_MISSES = 10000
+
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LON = 111.320
+
+class Geofence:
+    """Circular fence with precomputed projection constants"""
+
+    __slots__ = ("kind", "latitude", "longitude", "radius_km", "exit_radius_km",
+                 "_km_per_degree_lon", "inside", "last_entered")
+
+    def __init__(self, kind: str, latitude: float, longitude: float, radius_km: float):
+        self.kind = kind  # "pickup" or "dropoff"
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_km = radius_km
+        self.exit_radius_km = radius_km * FENCE_EXIT_FACTOR
+        self._km_per_degree_lon = KM_PER_DEGREE_LON * math.cos(math.radians(latitude))
+        self.inside = False
+        self.last_entered: Optional[float] = None
+
+    def distance_km(self, latitude: float, longitude: float) -> float:
+        """Equirectangular distance to the fence center (accurate at fence scale)"""
+        dy = (latitude - self.latitude) * KM_PER_DEGREE_LAT
+        dx = (longitude - self.longitude) * self._km_per_degree_lon
+        return math.sqrt(dx * dx + dy * dy)
+
+    def update(self, latitude: float, longitude: float, now: float) -> bool:
+        """Update inside/outside state. Returns True on a new entry"""
+        distance = self.distance_km(latitude, longitude)
+        if self.inside:
+            if distance > self.exit_radius_km:
+                self.inside = False
+            return False
+
+        if distance > self.radius_km:
+            return False
+
+        self.inside = True
+        if self.last_entered is not None and now - self.last_entered < FENCE_REENTRY_COOLDOWN:
+            return False
+        self.last_entered = now
+        return True
+
+class RideFences:
+    """Pickup and drop-off fences of one active ride"""
+
+    def __init__(self, ride_id: str, status: str, pickup: Geofence, dropoff: Geofence):
+        self.ride_id = ride_id
+        self.status = status
+        self.pickup = pickup
+        self.dropoff = dropoff
+        self.picked_up = False
+        self.rider_ids: set = set()
+
+    @property
+    def next_fence(self) -> Geofence:
+        return self.dropoff if self.picked_up else self.pickup
+
+class GeofenceEngine:
+    """Detect driver arrivals at pickup and drop-off points of active rides"""
+
+    def __init__(self, pickup_radius_km: float = PICKUP_FENCE_RADIUS_KM,
+                 dropoff_radius_km: float = DROPOFF_FENCE_RADIUS_KM):
+        self.pickup_radius_km = pickup_radius_km
+        self.dropoff_radius_km = dropoff_radius_km
+        # driver_id -> fences of the driver's active ride
+        self.driver_fences: Dict[str, RideFences] = {}
+        # driver_id -> monotonic time until which "no active ride" is cached, oldest first
+        self._misses: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = {"checks": 0, "arrivals": 0, "dropoffs": 0, "loaded": 0}
+
+    def register_ride(self, driver_id: str, ride_id: str, status: str,
+                      pickup_latitude: float, pickup_longitude: float,
+                      destination_latitude: float, destination_longitude: float,
+                      rider_ids: List[str] = None, picked_up: bool = False):
+        """Create or refresh the fences of a driver's ride"""
+        self._misses.pop(driver_id, None)
+        fences = self.driver_fences.get(driver_id)
+
+        if fences is None or fences.ride_id != ride_id:
+            # Never let a later confirmed ride displace the ride being driven
+            if fences is not None and fences.status == "in_progress" and status != "in_progress":
+                return
+            fences = RideFences(
+                ride_id,
+                status,
+                Geofence("pickup", pickup_latitude, pickup_longitude, self.pickup_radius_km),
+                Geofence("dropoff", destination_latitude, destination_longitude, self.dropoff_radius_km)
+            )
+            self.driver_fences[driver_id] = fences
+
+        fences.status = status
+        fences.picked_up = fences.picked_up or picked_up
+        if rider_ids:
+            fences.rider_ids.update(rider_ids)
+
+    def add_rider(self, driver_id: str, ride_id: str, rider_id: str):
+        """Add a confirmed rider to a registered ride"""
+        fences = self.driver_fences.get(driver_id)
+        if fences and fences.ride_id == ride_id:
+            fences.rider_ids.add(rider_id)
+
+    def update_ride(self, driver_id: str, ride_id: str, status: str, rider_ids: List[str] = None) -> bool:
+        """Update the status and riders of a registered ride; False if it is not registered"""
+        fences = self.driver_fences.get(driver_id)
+        if fences is None or fences.ride_id != ride_id:
+            return False
+        fences.status = status
+        if rider_ids:
+            fences.rider_ids.update(rider_ids)
+        return True
+
+    def remove_rider(self, driver_id: str, ride_id: str, rider_id: str):
+        """Stop notifying a rider whose request was declined or cancelled"""
+        fences = self.driver_fences.get(driver_id)
+        if fences and fences.ride_id == ride_id:
+            fences.rider_ids.discard(rider_id)
+
+    def mark_picked_up(self, driver_id: str, ride_id: str):
+        """Switch a ride's next fence from pickup to drop-off"""
+        fences = self.driver_fences.get(driver_id)
+        if fences and fences.ride_id == ride_id:
+            fences.picked_up = True
+
+    def remove_ride(self, driver_id: str, ride_id: str = None):
+        """Drop the fences of a finished or cancelled ride"""
+        fences = self.driver_fences.get(driver_id)
+        if fences and (ride_id is None or fences.ride_id == ride_id):
+            del self.driver_fences[driver_id]
+
+    def is_known_miss(self, driver_id: str, now: float = None) -> bool:
+        """True if the driver was recently found to have no active ride"""
+        now = time.monotonic() if now is None else now
+        expires = self._misses.get(driver_id)
+        if expires is None:
+            return False
+        if expires <= now:
+            del self._misses[driver_id]
+            return False
+        return True
+
+    def record_miss(self, driver_id: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        self._misses[driver_id] = now + FENCE_MISS_TTL
+        self._misses.move_to_end(driver_id)
+        # Oldest entries go first; a dropped miss only costs one extra lookup
+        while len(self._misses) > FENCE_MAX_MISSES:
+            self._misses.popitem(last=False)
+
+    def forget_driver(self, driver_id: str):
+        self._misses.pop(driver_id, None)
+
+    def next_target(self, driver_id: str) -> Optional[Dict]:
+        """Next fence the driver is heading for, if any"""
+        fences = self.driver_fences.get(driver_id)
+        if fences is None:
+            return None
+        fence = fences.next_fence
+        return {
+            "ride_id": fences.ride_id,
+            "status": fences.status,
+            "kind": fence.kind,
+            "latitude": fence.latitude,
+            "longitude": fence.longitude,
+            "radius_km": fence.radius_km
+        }
+
+    def check(self, driver_id: str, latitude: float, longitude: float, now: float = None) -> List[Dict]:
+        """Test a driver position against that driver's fences only"""
+        fences = self.driver_fences.get(driver_id)
+        if fences is None or latitude is None or longitude is None:
+            return []
+
+        now = time.monotonic() if now is None else now
+        self.stats["checks"] += 1
+        events = []
+
+        if not fences.picked_up and fences.pickup.update(latitude, longitude, now):
+            self.stats["arrivals"] += 1
+            events.append(self._event(driver_id, fences, fences.pickup))
+
+        if fences.status == "in_progress" and fences.dropoff.update(latitude, longitude, now):
+            self.stats["dropoffs"] += 1
+            events.append(self._event(driver_id, fences, fences.dropoff))
+
+        return events
+
+    async def process_driver_location(self, driver_id: str, latitude: float, longitude: float) -> List[Dict]:
+        """Check a driver position and notify riders of fence entries"""
+        events = self.check(driver_id, latitude, longitude)
+        for event in events:
+            await self.emit(event)
+        return events
+
+    async def emit(self, event: Dict):
+        """Deliver a fence event to the ride's riders and driver"""
+        if event["kind"] == "pickup":
+            notification_type = NotificationType.DRIVER_ARRIVING
+        else:
+            notification_type = NotificationType.ARRIVED_AT_DESTINATION
+
+        data = {
+            "driver_id": event["driver_id"],
+            "latitude": event["latitude"],
+            "longitude": event["longitude"]
+        }
+        for rider_id in event["rider_ids"]:
+            await notification_service.send_ride_notification(
+                rider_id, event["ride_id"], notification_type, data
+            )
+
+        if event["kind"] == "dropoff":
+            await notification_service.send_ride_notification(
+                event["driver_id"], event["ride_id"], notification_type, data
+            )
+
+        logger.info(f"Driver {event['driver_id']} entered {event['kind']} fence of ride {event['ride_id']}")
+
+    def _event(self, driver_id: str, fences: RideFences, fence: Geofence) -> Dict:
+        return {
+            "kind": fence.kind,
+            "ride_id": fences.ride_id,
+            "driver_id": driver_id,
+            "rider_ids": list(fences.rider_ids),
+            "latitude": fence.latitude,
+            "longitude": fence.longitude
+        }
+
+    def get_stats(self) -> Dict:
+        """Fence statistics"""
+        return {**self.stats, "active_rides": len(self.driver_fences), "cached_misses": len(self._misses)}
+
+# Global geofence engine instance
+geofence_engine = GeofenceEngine()
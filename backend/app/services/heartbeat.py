@@ -0,0 +1,172 @@
+import asyncio
+import os
+import time
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Ping a connection after this long without any message from it (seconds)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("WS_HEARTBEAT_INTERVAL_SECONDS", "30"))
+# Reap a connection that sends nothing for this long after a ping (seconds)
+HEARTBEAT_TIMEOUT_SECONDS = float(os.getenv("WS_HEARTBEAT_TIMEOUT_SECONDS", "20"))
+# Resolution of the timing wheel (seconds per slot)
+HEARTBEAT_TICK_SECONDS = float(os.getenv("WS_HEARTBEAT_TICK_SECONDS", "1"))
+HEARTBEAT_WHEEL_SLOTS = int(os.getenv("WS_HEARTBEAT_WHEEL_SLOTS", "64"))
+
+# Close code sent to reaped connections
+IDLE_CLOSE_CODE = 1001  # Going Away
+
+class TimingWheel:
+    """
+    Hashed timing wheel. Scheduling is O(1) and advancing one tick only looks
+    at the keys hashed into that slot. Rescheduling a key leaves its old entry
+    behind; stale entries are skipped when their slot comes round.
+    """
+
+    def __init__(self, tick_seconds: float = HEARTBEAT_TICK_SECONDS, slots: int = HEARTBEAT_WHEEL_SLOTS,
+                 now: float = None):
+        self.tick_seconds = tick_seconds
+        self.slots: List[List] = [[] for _ in range(slots)]
+        self.origin = time.monotonic() if now is None else now
+        self.current_tick = 0
+        # key -> tick it is currently due at
+        self.due: Dict[str, int] = {}
+
+    def _tick_of(self, when: float) -> int:
+        return int((when - self.origin) / self.tick_seconds)
+
+    def schedule(self, key: str, delay: float, now: float = None):
+        """Fire key once `delay` seconds from now, replacing any earlier schedule"""
+        now = time.monotonic() if now is None else now
+        tick = max(self.current_tick + 1, self._tick_of(now + delay) + 1)
+        self.due[key] = tick
+        self.slots[tick % len(self.slots)].append((tick, key))
+
+    def cancel(self, key: str):
+        self.due.pop(key, None)
+
+    def advance(self, now: float = None) -> List[str]:
+        """Move the wheel up to now and return the keys that came due"""
+        now = time.monotonic() if now is None else now
+        target = self._tick_of(now)
+        expired = []
+        while self.current_tick < target:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % len(self.slots)]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                tick, key = entry
+                if tick > self.current_tick:
+                    remaining.append(entry)  # Due in a later revolution
+                elif self.due.get(key) == tick:
+                    del self.due[key]
+                    expired.append(key)
+            slot[:] = remaining
+        return expired
+
+    def __len__(self) -> int:
+        return len(self.due)
+
+class HeartbeatScheduler:
+    """Ping only connections that have gone quiet and reap the ones that stay silent"""
+
+    def __init__(self, ping: Callable[[str], Awaitable[None]], reap: Callable[[str], Awaitable[None]],
+                 interval: float = HEARTBEAT_INTERVAL_SECONDS, timeout: float = HEARTBEAT_TIMEOUT_SECONDS,
+                 tick_seconds: float = HEARTBEAT_TICK_SECONDS, slots: int = HEARTBEAT_WHEEL_SLOTS):
+        self.ping = ping
+        self.reap = reap
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimingWheel(tick_seconds, slots)
+        self.last_activity: Dict[str, float] = {}
+        # user_id -> when the unanswered ping was sent
+        self.awaiting: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"pings_sent": 0, "reaped": 0, "last_sweep_checked": 0, "last_sweep_ms": 0.0}
+
+    def track(self, user_id: str, now: float = None):
+        """Start watching a newly connected user"""
+        now = time.monotonic() if now is None else now
+        self.last_activity[user_id] = now
+        self.awaiting.pop(user_id, None)
+        self.wheel.schedule(user_id, self.interval, now)
+
+    def touch(self, user_id: str, now: float = None):
+        """Record activity; O(1), the wheel entry is checked lazily when it fires"""
+        if user_id in self.last_activity:
+            self.last_activity[user_id] = time.monotonic() if now is None else now
+            self.awaiting.pop(user_id, None)
+
+    def forget(self, user_id: str):
+        self.last_activity.pop(user_id, None)
+        self.awaiting.pop(user_id, None)
+        self.wheel.cancel(user_id)
+
+    async def sweep(self, now: float = None):
+        """Handle the connections that came due since the last sweep"""
+        now = time.monotonic() if now is None else now
+        started = time.perf_counter()
+        due = self.wheel.advance(now)
+        for user_id in due:
+            last_activity = self.last_activity.get(user_id)
+            if last_activity is None:
+                continue
+            if user_id in self.awaiting:
+                # Nothing received since the ping
+                self.forget(user_id)
+                self.stats["reaped"] += 1
+                try:
+                    await self.reap(user_id)
+                except Exception as e:
+                    logger.error(f"Failed to reap idle connection of user {user_id}: {e}")
+                continue
+
+            idle = now - last_activity
+            if idle < self.interval:
+                # Active since scheduled: check again when it could next go idle
+                self.wheel.schedule(user_id, self.interval - idle, now)
+                continue
+
+            self.awaiting[user_id] = now
+            self.wheel.schedule(user_id, self.timeout, now)
+            self.stats["pings_sent"] += 1
+            try:
+                await self.ping(user_id)
+            except Exception as e:
+                logger.error(f"Failed to ping user {user_id}: {e}")
+
+        self.stats["last_sweep_checked"] = len(due)
+        self.stats["last_sweep_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.wheel.tick_seconds)
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Heartbeat sweep failed: {e}")
+
+    def get_stats(self) -> Dict:
+        tracked = len(self.last_activity)
+        return {
+            **self.stats,
+            "tracked": tracked,
+            "awaiting_pong": len(self.awaiting),
+            "alive": tracked - len(self.awaiting),
+            "interval_seconds": self.interval,
+            "timeout_seconds": self.timeout
+        }
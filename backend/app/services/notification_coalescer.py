@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Set to "false" to deliver every notification individually
+NOTIFICATION_COALESCING = os.getenv("NOTIFICATION_COALESCING", "true").lower() == "true"
+# How often low-priority notifications are sent as one digest per user (seconds)
+NOTIFICATION_DIGEST_SECONDS = float(os.getenv("NOTIFICATION_DIGEST_SECONDS", "300"))
+# Item payloads kept in a summary; the count covers the rest
+COALESCE_MAX_ITEMS = 20
+
+# What offer() tells the caller to do with a notification
+DELIVER = "deliver"  # Store, push and send it now
+HELD = "held"        # Folded into the next summary
+
+SummaryHandler = Callable[[str, str, str, str, Dict, str], Awaitable[None]]
+
+class CoalesceRule:
+    """How bursts of one notification type are merged"""
+    __slots__ = ("window_seconds", "title", "message", "group_by", "latest_only")
+
+    def __init__(self, window_seconds: float, title: str, message: str, group_by: Optional[str] = None,
+                 latest_only: bool = False):
+        self.window_seconds = window_seconds
+        # Summary text; {count} is the number of notifications merged
+        self.title = title
+        self.message = message
+        # Data field that splits a user's notifications into separate groups, e.g. ride_id
+        self.group_by = group_by
+        # Keep only the newest payload (positions) instead of a list of items
+        self.latest_only = latest_only
+
+class PendingSummary:
+    """Notifications held for one user and group until its window closes"""
+    __slots__ = ("user_id", "notification_type", "priority", "count", "items", "by_type", "due_at")
+
+    def __init__(self, user_id: str, notification_type: str, priority: str, due_at: float):
+        self.user_id = user_id
+        self.notification_type = notification_type
+        self.priority = priority
+        self.count = 0
+        self.items = deque(maxlen=COALESCE_MAX_ITEMS)
+        self.by_type: Dict[str, int] = {}
+        self.due_at = due_at
+
+class NotificationCoalescer:
+    """
+    Merges bursts of high-frequency notification types per user. The first
+    notification of a burst is delivered at once and opens a window; the ones
+    that follow inside it become a single "N new ..." summary when it closes.
+    Only NORMAL and LOW priority notifications are merged; HIGH and URGENT
+    ones are always delivered at once. LOW priority notifications without a
+    rule go into a periodic digest. State is per server worker.
+    """
+
+    PRIORITY_ORDER = ("low", "normal", "high", "urgent")
+    # Priorities that are never merged or delayed
+    IMMEDIATE_PRIORITIES = ("high", "urgent")
+
+    def __init__(self, rules: Dict[str, CoalesceRule], on_summary: SummaryHandler,
+                 enabled: bool = NOTIFICATION_COALESCING, digest_seconds: float = NOTIFICATION_DIGEST_SECONDS):
+        self.rules = rules
+        self.on_summary = on_summary
+        self.enabled = enabled
+        self.digest_seconds = digest_seconds
+        self.windows: Dict[Tuple, float] = {}  # Group key -> when its window closes
+        self.pending: Dict[Tuple, PendingSummary] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"offered": 0, "delivered": 0, "held": 0, "summaries": 0, "digests": 0}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Send every held summary now"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush_due(float("inf"))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(1)
+                await self.flush_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification summary flush failed: {e}")
+
+    def offer(self, user_id: str, notification_type: str, priority: str, data: Dict,
+              now: Optional[float] = None) -> str:
+        """Decide what happens to a notification; returns DELIVER or HELD"""
+        self.stats["offered"] += 1
+        now = time.monotonic() if now is None else now
+        rule = self.rules.get(notification_type)
+
+        if not self.enabled or priority in self.IMMEDIATE_PRIORITIES or (rule is None and priority != "low"):
+            decision = DELIVER
+        elif rule is not None:
+            key = (user_id, notification_type, data.get(rule.group_by) if rule.group_by else None)
+            if self.windows.get(key, 0) <= now:
+                # First of a burst: goes out now and opens the window
+                self.windows[key] = now + rule.window_seconds
+                decision = DELIVER
+            else:
+                self._hold(key, user_id, notification_type, priority, data, self.windows[key], rule.latest_only)
+                decision = HELD
+        elif self.digest_seconds > 0:
+            key = (user_id, "digest", None)
+            self._hold(key, user_id, "digest", priority, {"type": notification_type, **data},
+                       now + self.digest_seconds, False)
+            decision = HELD
+        else:
+            decision = DELIVER
+
+        self.stats["delivered" if decision == DELIVER else "held"] += 1
+        return decision
+
+    def _hold(self, key: Tuple, user_id: str, notification_type: str, priority: str, data: Dict,
+              due_at: float, latest_only: bool):
+        summary = self.pending.get(key)
+        if summary is None:
+            summary = self.pending[key] = PendingSummary(user_id, notification_type, priority, due_at)
+        summary.count += 1
+        if latest_only:
+            summary.items.clear()
+        summary.items.append(data)
+        item_type = data.get("type", notification_type) if notification_type == "digest" else notification_type
+        summary.by_type[item_type] = summary.by_type.get(item_type, 0) + 1
+        if self.PRIORITY_ORDER.index(priority) > self.PRIORITY_ORDER.index(summary.priority):
+            summary.priority = priority
+
+    async def flush_due(self, now: Optional[float] = None) -> int:
+        """Send the summaries whose window has closed; returns how many were sent"""
+        now = time.monotonic() if now is None else now
+        # A window with nothing held just expires; one that produced a summary stays
+        # open for another period, so a steady stream yields one summary per window
+        for key, closes_at in list(self.windows.items()):
+            if closes_at <= now and key not in self.pending:
+                del self.windows[key]
+
+        sent = 0
+        for key, summary in list(self.pending.items()):
+            if summary.due_at > now:
+                continue
+            del self.pending[key]
+            rule = self.rules.get(summary.notification_type)
+            if rule is not None and key in self.windows and now != float("inf"):
+                self.windows[key] = now + rule.window_seconds
+            try:
+                await self._send_summary(summary, rule)
+                sent += 1
+            except Exception as e:
+                logger.error(f"Failed to send notification summary to user {summary.user_id}: {e}")
+        return sent
+
+    async def _send_summary(self, summary: PendingSummary, rule: Optional[CoalesceRule]):
+        if rule is None:
+            self.stats["digests"] += 1
+            title = "Your updates"
+            message = f"You have {summary.count} new updates"
+            data = {"count": summary.count, "by_type": summary.by_type, "items": list(summary.items)}
+        else:
+            self.stats["summaries"] += 1
+            title = rule.title.format(count=summary.count)
+            message = rule.message.format(count=summary.count)
+            if rule.latest_only:
+                data = {**summary.items[-1], "count": summary.count}
+            else:
+                data = {"count": summary.count, "items": list(summary.items)}
+        await self.on_summary(summary.user_id, summary.notification_type, title, message,
+                              {**data, "coalesced": True}, summary.priority)
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "open_windows": len(self.windows),
+            "pending_summaries": len(self.pending),
+            "held_notifications": sum(summary.count for summary in self.pending.values()),
+            "digest_seconds": self.digest_seconds
+        }
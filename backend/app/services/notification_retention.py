@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sqlalchemy import bindparam, delete, update
+from app.database import SessionLocal
+from app.models.notification import Notification, NotificationCounter
+from app.services.notification_store import NotificationStore
+
+logger = logging.getLogger(__name__)
+
+# Days a read notification is kept, unless its type has its own window below
+NOTIFICATION_RETENTION_DAYS = float(os.getenv("NOTIFICATION_RETENTION_DAYS", "30"))
+# How often the compaction task runs (seconds)
+NOTIFICATION_COMPACTION_SECONDS = float(os.getenv("NOTIFICATION_COMPACTION_SECONDS", "3600"))
+# Rows deleted per transaction, and the pause between batches (milliseconds)
+NOTIFICATION_COMPACTION_BATCH = int(os.getenv("NOTIFICATION_COMPACTION_BATCH", "1000"))
+NOTIFICATION_COMPACTION_PAUSE_MS = float(os.getenv("NOTIFICATION_COMPACTION_PAUSE_MS", "50"))
+
+# Retention of read notifications by type (days); short-lived updates go first
+RETENTION_DAYS_BY_TYPE = {
+    "location_update": 1,
+    "driver_arriving": 7,
+    "arrived_at_destination": 7,
+    "ride_request": 14,
+    "digest": 14,
+    "announcement": 90,
+    "payment_received": 365,
+}
+
+# Fixed part of a row: tuple header, timestamp, boolean and column overhead (bytes)
+ROW_OVERHEAD_BYTES = 48
+
+def row_bytes(row) -> int:
+    """Approximate stored size of a deleted notification"""
+    size = ROW_OVERHEAD_BYTES
+    for value in (row.id, row.user_id, row.type, row.title, row.message, row.priority):
+        size += len(value.encode()) if value else 0
+    if row.data:
+        size += len(json.dumps(row.data, separators=(",", ":")))
+    return size
+
+class NotificationCompactor:
+    """
+    Enforces retention: deletes read notifications older than their type's
+    window. Each batch is one short transaction (select oldest ids, delete,
+    adjust counters) run in a worker thread, with a pause in between, so the
+    sweep never holds locks for long or blocks the event loop. Unread
+    notifications are never removed.
+    """
+
+    def __init__(self, store: NotificationStore, batch_size: int = NOTIFICATION_COMPACTION_BATCH,
+                 pause_ms: float = NOTIFICATION_COMPACTION_PAUSE_MS,
+                 interval_seconds: float = NOTIFICATION_COMPACTION_SECONDS,
+                 default_days: float = NOTIFICATION_RETENTION_DAYS,
+                 days_by_type: Dict[str, float] = None):
+        self.store = store
+        self.batch_size = batch_size
+        self.pause_seconds = pause_ms / 1000
+        self.interval_seconds = interval_seconds
+        self.default_days = default_days
+        self.days_by_type = RETENTION_DAYS_BY_TYPE if days_by_type is None else days_by_type
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"runs": 0, "deleted": 0, "batches": 0, "bytes_reclaimed": 0, "errors": 0}
+        self.last_report: Optional[Dict] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.interval_seconds)
+                await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Notification compaction failed: {e}")
+
+    def policy(self) -> Dict:
+        return {"default_days": self.default_days, "days_by_type": dict(self.days_by_type)}
+
+    async def compact(self, now: Optional[datetime] = None) -> Dict:
+        """Delete every read notification past retention; returns what was reclaimed"""
+        async with self._lock:
+            started = time.perf_counter()
+            now = now or datetime.now(timezone.utc)
+            report = {"deleted": 0, "batches": 0, "bytes_reclaimed": 0, "by_type": {}}
+
+            # One pass per window: each listed type, then everything else on the default
+            passes = [([notification_type], days) for notification_type, days in self.days_by_type.items()]
+            passes.append((None, self.default_days))
+            for types, days in passes:
+                cutoff = now - timedelta(days=days)
+                while True:
+                    deleted = await asyncio.to_thread(self._delete_batch, types, cutoff)
+                    if not deleted:
+                        break
+                    report["batches"] += 1
+                    report["deleted"] += len(deleted)
+                    for row in deleted:
+                        size = row_bytes(row)
+                        report["bytes_reclaimed"] += size
+                        by_type = report["by_type"].setdefault(row.type, {"deleted": 0, "bytes_reclaimed": 0})
+                        by_type["deleted"] += 1
+                        by_type["bytes_reclaimed"] += size
+                    self.store.forget({row.user_id for row in deleted})
+                    if len(deleted) < self.batch_size:
+                        break
+                    # Let requests and other writers in between batches
+                    await asyncio.sleep(self.pause_seconds)
+
+            report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self.stats["runs"] += 1
+            for key in ("deleted", "batches", "bytes_reclaimed"):
+                self.stats[key] += report[key]
+            self.last_report = {**report, "finished_at": datetime.now(timezone.utc).isoformat()}
+            if report["deleted"]:
+                logger.info(f"Notification compaction removed {report['deleted']} notifications "
+                            f"({report['bytes_reclaimed']} bytes) in {report['batches']} batches")
+            return report
+
+    def _delete_batch(self, types: Optional[List[str]], cutoff: datetime) -> List:
+        db = SessionLocal()
+        try:
+            query = db.query(Notification.id).filter(
+                Notification.read.is_(True),
+                Notification.timestamp < cutoff
+            )
+            if types is not None:
+                query = query.filter(Notification.type.in_(types))
+            elif self.days_by_type:
+                query = query.filter(Notification.type.notin_(list(self.days_by_type)))
+            ids = [row.id for row in query.order_by(Notification.timestamp).limit(self.batch_size).all()]
+            if not ids:
+                db.rollback()
+                return []
+
+            # RETURNING the rows actually removed, so concurrent sweeps never double-count
+            deleted = db.execute(delete(Notification).where(
+                Notification.id.in_(ids), Notification.read.is_(True)
+            ).returning(
+                Notification.id, Notification.user_id, Notification.type, Notification.title,
+                Notification.message, Notification.data, Notification.priority
+            )).all()
+
+            removed: Dict[str, int] = {}
+            for row in deleted:
+                removed[row.user_id] = removed.get(row.user_id, 0) + 1
+            if removed:
+                # Only read rows are deleted, so unread counts are unchanged; one executemany for the batch
+                db.connection().execute(
+                    update(NotificationCounter)
+                    .where(NotificationCounter.user_id == bindparam("counter_user_id"))
+                    .values(total_count=NotificationCounter.total_count - bindparam("removed")),
+                    [{"counter_user_id": user_id, "removed": count} for user_id, count in removed.items()]
+                )
+            db.commit()
+            return deleted
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "policy": self.policy(),
+            "batch_size": self.batch_size,
+            "interval_seconds": self.interval_seconds,
+            "last_run": self.last_report
+        }
@@ -1,11 +1,22 @@
+import asyncio
 import logging
+import os
+import time
+import uuid
 from typing import Dict, List, Optional, Any
 from datetime import datetime, timezone
 from enum import Enum
 import json
+from app.services.notification_store import NotificationStore
+from app.services.notification_retention import NotificationCompactor
+from app.services.push_delivery import create_push_pool, push_message
+from app.services.notification_coalescer import NotificationCoalescer, CoalesceRule, DELIVER
 
 logger = logging.getLogger(__name__)
 
+# Concurrent in-app deliveries during a bulk send
+BULK_NOTIFICATION_CONCURRENCY = int(os.getenv("BULK_NOTIFICATION_CONCURRENCY", "100"))
+
 class NotificationType(Enum):
     """Types of notifications"""
     RIDE_REQUEST = "ride_request"
@@ -14,9 +25,12 @@ class NotificationType(Enum):
     RIDE_STARTED = "ride_started"
     RIDE_COMPLETED = "ride_completed"
     DRIVER_ARRIVING = "driver_arriving"
+    ARRIVED_AT_DESTINATION = "arrived_at_destination"
     LOCATION_UPDATE = "location_update"
     PAYMENT_RECEIVED = "payment_received"
     RIDE_CANCELLED = "ride_cancelled"
+    ANNOUNCEMENT = "announcement"
+    DIGEST = "digest"
 
 class NotificationPriority(Enum):
     """Notification priority levels"""
@@ -25,12 +39,37 @@ class NotificationPriority(Enum):
     HIGH = "high"
     URGENT = "urgent"
 
+# Types that arrive in bursts; follow-ups within the window are merged into one summary
+COALESCE_RULES = {
+    NotificationType.RIDE_REQUEST.value: CoalesceRule(
+        10, "New Ride Requests", "{count} new ride requests"
+    ),
+    NotificationType.LOCATION_UPDATE.value: CoalesceRule(
+        30, "Driver Location", "Your driver's location was updated", group_by="ride_id", latest_only=True
+    ),
+}
+
 class NotificationService:
     """Service for handling notifications"""
     
     def __init__(self):
-        self.notifications = {}  # In-memory storage for demo
+        self.store = NotificationStore()  # Persisted in batches, newest page cached per user
         self.push_tokens = {}    # Store push notification tokens
+        self.push = create_push_pool(on_invalid_token=self._drop_invalid_token)  # Queued, retried delivery
+        self.coalescer = NotificationCoalescer(COALESCE_RULES, self._send_summary)  # Bursts and digests
+        self.compactor = NotificationCompactor(self.store)  # Retention of read notifications
+        
+    async def start(self):
+        self.store.start()
+        await self.push.start()
+        self.coalescer.start()
+        self.compactor.start()
+        
+    async def stop(self):
+        self.compactor.stop()
+        await self.coalescer.stop()
+        await self.push.stop()
+        await self.store.stop()
         
     async def send_notification(self, 
                                user_id: str, 
@@ -40,26 +79,28 @@ class NotificationService:
                                data: Dict = None,
                                priority: NotificationPriority = NotificationPriority.NORMAL) -> bool:
         """
-        Send a notification to a user
+        Send a notification to a user; bursts of one type may be merged into a summary
         Returns True if successful, False otherwise
         """
         try:
+            decision = self.coalescer.offer(user_id, notification_type.value, priority.value, data or {})
+            if decision != DELIVER:
+                return True
             notification = {
-                "id": f"notif_{datetime.now(timezone.utc).timestamp()}",
+                "id": f"notif_{uuid.uuid4().hex}",
                 "user_id": user_id,
                 "type": notification_type.value,
                 "title": title,
                 "message": message,
-                "data": data or {},
+                # Round-trip so a stray datetime fails here, not in a whole write batch
+                "data": json.loads(json.dumps(data or {}, default=str)),
                 "priority": priority.value,
                 "timestamp": datetime.now(timezone.utc).isoformat(),
                 "read": False
             }
             
             # Store notification
-            if user_id not in self.notifications:
-                self.notifications[user_id] = []
-            self.notifications[user_id].append(notification)
+            self.store.add(notification)
             
             # Send push notification if token exists
             await self.send_push_notification(user_id, notification)
@@ -75,23 +116,30 @@ class NotificationService:
             return False
     
     async def send_push_notification(self, user_id: str, notification: Dict) -> bool:
-        """Send push notification to user's device"""
+        """Queue a push notification for the user's device; workers send and retry it"""
         if user_id in self.push_tokens:
-            token = self.push_tokens[user_id]
-            
-            # This would integrate with FCM, APNS, or other push services
-            # For now, just log the attempt
-            logger.info(f"Push notification would be sent to token {token}: {notification['title']}")
-            
-            # In production, you would:
-            # 1. Send to FCM for Android
-            # 2. Send to APNS for iOS
-            # 3. Handle delivery receipts
-            # 4. Retry failed deliveries
-            
+            await self.push.enqueue([push_message(user_id, self.push_tokens[user_id], notification)])
             return True
         return False
     
+    async def _send_summary(self, user_id: str, notification_type: str, title: str, message: str,
+                            data: Dict, priority: str):
+        """Deliver a coalesced summary or digest; it is never coalesced again"""
+        notification = {
+            "id": f"notif_{uuid.uuid4().hex}",
+            "user_id": user_id,
+            "type": notification_type,
+            "title": title,
+            "message": message,
+            "data": json.loads(json.dumps(data, default=str)),
+            "priority": priority,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "read": False
+        }
+        self.store.add(notification)
+        await self.send_push_notification(user_id, notification)
+        await self.send_websocket_notification(user_id, notification)
+    
     async def send_websocket_notification(self, user_id: str, notification: Dict) -> bool:
         """Send notification via WebSocket for real-time delivery"""
         try:
@@ -140,11 +188,21 @@ class NotificationService:
                 "message": "Your ride has been completed",
                 "priority": NotificationPriority.NORMAL
             },
+            NotificationType.LOCATION_UPDATE: {
+                "title": "Driver Location",
+                "message": "Your driver's location was updated",
+                "priority": NotificationPriority.NORMAL
+            },
             NotificationType.DRIVER_ARRIVING: {
                 "title": "Driver Arriving",
                 "message": "Your driver is arriving soon",
                 "priority": NotificationPriority.HIGH
             },
+            NotificationType.ARRIVED_AT_DESTINATION: {
+                "title": "Arrived at Destination",
+                "message": "You have arrived at your destination",
+                "priority": NotificationPriority.HIGH
+            },
             NotificationType.RIDE_CANCELLED: {
                 "title": "Ride Cancelled",
                 "message": "Your ride has been cancelled",
@@ -171,16 +229,97 @@ class NotificationService:
                                     notification_type: NotificationType,
                                     title: str, 
                                     message: str, 
-                                    data: Dict = None) -> Dict[str, bool]:
-        """Send notifications to multiple users"""
-        results = {}
-        
+                                    data: Dict = None,
+                                    priority: NotificationPriority = NotificationPriority.NORMAL,
+                                    data_by_user: Dict[str, Dict] = None) -> Dict:
+        """
+        Send the same notification to many users. The payload is built once,
+        pushes are queued for the worker pool and in-app delivery fans out
+        concurrently. `data_by_user` adds per-recipient fields to the shared
+        data. Returns an aggregated delivery report.
+
+        Every recipient gets the notification as-is: bulk sends do not go
+        through the coalescer, so they are never merged or held for a digest.
+        """
+        from app.services.websocket_service import manager
+
+        started = time.perf_counter()
+        user_ids = list(dict.fromkeys(user_ids))
+        # Everything except the id and recipient is shared by all copies
+        template = {
+            "type": notification_type.value,
+            "title": title,
+            "message": message,
+            "data": json.loads(json.dumps(data or {}, default=str)),
+            "priority": priority.value,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "read": False
+        }
+        notifications = []
         for user_id in user_ids:
-            results[user_id] = await self.send_notification(
-                user_id, notification_type, title, message, data
-            )
-        
-        return results
+            notification = {"id": f"notif_{uuid.uuid4().hex}", "user_id": user_id, **template}
+            if data_by_user and user_id in data_by_user:
+                notification["data"] = {
+                    **template["data"], **json.loads(json.dumps(data_by_user[user_id], default=str))
+                }
+            self.store.add(notification)
+            notifications.append(notification)
+
+        push_messages = [
+            push_message(notification["user_id"], self.push_tokens[notification["user_id"]], notification)
+            for notification in notifications if notification["user_id"] in self.push_tokens
+        ]
+        try:
+            await self.push.enqueue(push_messages)
+            push_queued = len(push_messages)
+        except Exception as e:
+            logger.error(f"Failed to queue bulk push notifications: {e}")
+            push_queued = 0
+
+        # A fixed pool of workers drains the recipients, so 5,000 users never means 5,000 tasks
+        pending = iter(notifications)
+        delivered = published = failed = 0
+
+        async def deliver():
+            nonlocal delivered, published, failed
+            for notification in pending:
+                try:
+                    local = await manager.send_personal_message({
+                        "type": "notification",
+                        "data": notification
+                    }, notification["user_id"])
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Failed to send WebSocket notification: {e}")
+                    continue
+                # Users not connected here were only handed to the broker; another worker may or may not hold them
+                if local:
+                    delivered += 1
+                else:
+                    published += 1
+
+        await asyncio.gather(*(deliver() for _ in range(min(BULK_NOTIFICATION_CONCURRENCY, len(notifications)))))
+
+        report = {
+            "recipients": len(user_ids),
+            "stored": len(notifications),
+            "websocket_delivered": delivered,
+            "websocket_published": published,
+            "websocket_failed": failed,
+            "push_queued": push_queued,
+            "push_failed": len(push_messages) - push_queued,
+            "without_push_token": len(user_ids) - len(push_messages),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        logger.info(f"Bulk notification '{title}' sent to {len(user_ids)} users: {report}")
+        return report
+    
+    async def _drop_invalid_token(self, user_id: str, token: str):
+        """The provider reported the device as unregistered"""
+        # Only if the user has not registered a new token since
+        if self.push_tokens.get(user_id) == token:
+            del self.push_tokens[user_id]
+            logger.info(f"Push token of user {user_id} is no longer valid and was removed")
     
     def register_push_token(self, user_id: str, token: str) -> bool:
         """Register a push notification token for a user"""
@@ -203,59 +342,39 @@ class NotificationService:
             logger.error(f"Failed to unregister push token for user {user_id}: {e}")
             return False
     
-    def get_user_notifications(self, user_id: str, limit: int = 50) -> List[Dict]:
-        """Get notifications for a specific user"""
-        if user_id in self.notifications:
-            # Return most recent notifications first
-            return sorted(
-                self.notifications[user_id], 
-                key=lambda x: x["timestamp"], 
-                reverse=True
-            )[:limit]
-        return []
+    async def get_user_notifications(self, user_id: str, limit: int = 50, unread_only: bool = False,
+                                     before: Optional[str] = None) -> List[Dict]:
+        """Get notifications for a specific user, newest first, starting after `before`"""
+        return await self.store.get_page(user_id, limit, unread_only, before)
     
-    def mark_notification_read(self, user_id: str, notification_id: str) -> bool:
+    async def mark_notification_read(self, user_id: str, notification_id: str) -> bool:
         """Mark a notification as read"""
         try:
-            if user_id in self.notifications:
-                for notification in self.notifications[user_id]:
-                    if notification["id"] == notification_id:
-                        notification["read"] = True
-                        return True
-            return False
+            return await self.store.mark_read(user_id, notification_id)
         except Exception as e:
             logger.error(f"Failed to mark notification as read: {e}")
             return False
     
-    def mark_all_notifications_read(self, user_id: str) -> bool:
+    async def mark_all_notifications_read(self, user_id: str) -> bool:
         """Mark all notifications as read for a user"""
         try:
-            if user_id in self.notifications:
-                for notification in self.notifications[user_id]:
-                    notification["read"] = True
-                return True
-            return False
+            await self.store.mark_all_read(user_id)
+            return True
         except Exception as e:
             logger.error(f"Failed to mark all notifications as read: {e}")
             return False
     
-    def get_notification_stats(self, user_id: str) -> Dict:
+    async def delete_notification(self, user_id: str, notification_id: str) -> bool:
+        """Delete a notification of a user"""
+        try:
+            return await self.store.delete(user_id, notification_id)
+        except Exception as e:
+            logger.error(f"Failed to delete notification: {e}")
+            return False
+    
+    async def get_notification_stats(self, user_id: str) -> Dict:
         """Get notification statistics for a user"""
-        if user_id in self.notifications:
-            notifications = self.notifications[user_id]
-            total = len(notifications)
-            unread = len([n for n in notifications if not n["read"]])
-            
-            return {
-                "total_notifications": total,
-                "unread_notifications": unread,
-                "read_notifications": total - unread
-            }
-        return {
-            "total_notifications": 0,
-            "unread_notifications": 0,
-            "read_notifications": 0
-        }
+        return await self.store.counts(user_id)
 
     def _create_notification_data(self, notification_type: str, user_id: str, data: Dict[str, Any]) -> Dict[str, Any]:
         return {
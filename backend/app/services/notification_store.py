@@ -0,0 +1,520 @@
+import asyncio
+import os
+import time
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import and_, delete, insert, or_
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models.notification import Notification, NotificationCounter
+
+logger = logging.getLogger(__name__)
+
+# Notifications written per INSERT, and how long a partial batch may wait (milliseconds)
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", "500"))
+NOTIFICATION_FLUSH_MS = float(os.getenv("NOTIFICATION_FLUSH_MS", "100"))
+# Unwritten notifications kept while the database is unreachable; the oldest are dropped beyond this
+NOTIFICATION_MAX_PENDING = int(os.getenv("NOTIFICATION_MAX_PENDING", "20000"))
+# Most recent notifications cached per user, users cached per worker, and cache lifetime (seconds)
+NOTIFICATION_HEAD_SIZE = int(os.getenv("NOTIFICATION_HEAD_SIZE", "50"))
+NOTIFICATION_HEAD_USERS = int(os.getenv("NOTIFICATION_HEAD_USERS", "5000"))
+NOTIFICATION_HEAD_TTL_SECONDS = float(os.getenv("NOTIFICATION_HEAD_TTL_SECONDS", "30"))
+# Largest page a client may request
+NOTIFICATION_PAGE_MAX = 200
+
+COLUMNS = ("id", "user_id", "type", "title", "message", "data", "priority", "read")
+
+def _to_row(notification: Dict) -> Dict:
+    row = {column: notification[column] for column in COLUMNS}
+    row["timestamp"] = datetime.fromisoformat(notification["timestamp"])
+    return row
+
+def _to_dict(notification: Notification) -> Dict:
+    timestamp = notification.timestamp
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return {
+        "id": notification.id,
+        "user_id": notification.user_id,
+        "type": notification.type,
+        "title": notification.title,
+        "message": notification.message,
+        "data": notification.data or {},
+        "priority": notification.priority,
+        "timestamp": timestamp.isoformat(),
+        "read": notification.read
+    }
+
+class UserNotifications:
+    """
+    Newest notifications of one user in a bounded ring (newest first), an
+    index from id to entry, and the user's total/unread counts kept up to date
+    on every add and mark-read. Listing N costs O(N); lookups and counts O(1).
+    """
+    __slots__ = ("entries", "index", "total", "unread", "complete", "loaded_at")
+
+    def __init__(self, size: int, entries: List[Dict] = (), total: int = 0, unread: int = 0,
+                 complete: bool = True):
+        self.entries = deque(entries, maxlen=size)
+        self.index: Dict[str, Dict] = {entry["id"]: entry for entry in self.entries}
+        self.total = total
+        self.unread = unread
+        # True while the ring holds every notification the user has
+        self.complete = complete
+        self.loaded_at = time.monotonic()
+
+    def add(self, notification: Dict):
+        if len(self.entries) == self.entries.maxlen:
+            evicted = self.entries.pop()
+            self.index.pop(evicted["id"], None)
+            self.complete = False
+        self.entries.appendleft(notification)
+        self.index[notification["id"]] = notification
+        self.total += 1
+        if not notification["read"]:
+            self.unread += 1
+
+    def get(self, notification_id: str) -> Optional[Dict]:
+        return self.index.get(notification_id)
+
+    def mark_read(self, notification_id: str, flipped: bool = None) -> bool:
+        """
+        Mark an entry read and keep the unread count in step. `flipped` is the
+        store's verdict for notifications that may be older than the ring.
+        """
+        entry = self.index.get(notification_id)
+        if flipped is None:
+            flipped = entry is not None and not entry["read"]
+        if entry is not None:
+            entry["read"] = True
+        if flipped and self.unread > 0:
+            self.unread -= 1
+        return flipped
+
+    def remove(self, notification_id: str, was_read: bool):
+        """Drop a deleted notification and its share of the counts"""
+        entry = self.index.pop(notification_id, None)
+        if entry is not None:
+            self.entries.remove(entry)
+        self.total = max(0, self.total - 1)
+        if not was_read:
+            self.unread = max(0, self.unread - 1)
+
+    def mark_all_read(self):
+        if self.unread:
+            for entry in self.entries:
+                entry["read"] = True
+        self.unread = 0
+
+    def latest(self, limit: int, unread_only: bool = False) -> Optional[List[Dict]]:
+        """Newest `limit` entries, or None when older notifications outside the ring are needed"""
+        if unread_only:
+            entries = list(islice((entry for entry in self.entries if not entry["read"]), limit))
+            # Short pages are only final if every unread notification is in the ring
+            enough = len(entries) == limit or len(entries) == self.unread
+        else:
+            entries = list(islice(self.entries, limit))
+            enough = len(entries) == limit
+        return entries if enough or self.complete else None
+
+    def counts(self) -> Dict:
+        return {
+            "total_notifications": self.total,
+            "unread_notifications": self.unread,
+            "read_notifications": self.total - self.unread
+        }
+
+class NotificationStore:
+    """
+    Notifications persisted in batches. Sends only append to a buffer; a
+    background task writes it with one multi-row INSERT plus one counter upsert
+    per batch. Reads of the newest page are served from a small per-user head
+    cache, older pages by keyset pagination on (timestamp, id). The database
+    calls are blocking, so each runs in a worker thread (asyncio.to_thread)
+    and never stalls the event loop.
+    """
+
+    def __init__(self, batch_size: int = NOTIFICATION_BATCH_SIZE, flush_ms: float = NOTIFICATION_FLUSH_MS,
+                 max_pending: int = NOTIFICATION_MAX_PENDING, head_size: int = NOTIFICATION_HEAD_SIZE,
+                 head_users: int = NOTIFICATION_HEAD_USERS, head_ttl: float = NOTIFICATION_HEAD_TTL_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_ms / 1000
+        self.max_pending = max_pending
+        self.head_size = head_size
+        self.head_users = head_users
+        self.head_ttl = head_ttl
+        self.pending: List[Dict] = []
+        # user_id -> [unwritten, unwritten unread]
+        self.pending_by_user: Dict[str, List[int]] = {}
+        self.heads: "OrderedDict[str, UserNotifications]" = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"written": 0, "batches": 0, "write_errors": 0, "dropped": 0,
+                      "head_hits": 0, "head_loads": 0, "page_queries": 0, "deleted": 0}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification flush failed: {e}")
+
+    def add(self, notification: Dict):
+        """Queue a notification for the next batch and show it in the user's cached head"""
+        user_id = notification["user_id"]
+        self.pending.append(notification)
+        self._pend(notification, 1)
+        head = self.heads.get(user_id)
+        if head is not None:
+            head.add(notification)
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+        if len(self.pending) > self.max_pending:
+            self._drop_oldest(len(self.pending) - self.max_pending)
+
+    def _drop_oldest(self, count: int):
+        dropped, self.pending = self.pending[:count], self.pending[count:]
+        for notification in dropped:
+            self._pend(notification, -1)
+        self.stats["dropped"] += count
+        logger.error(f"Notification buffer full; dropped {count} unwritten notifications")
+
+    def _pend(self, notification: Dict, sign: int):
+        user_id = notification["user_id"]
+        counts = self.pending_by_user.setdefault(user_id, [0, 0])
+        counts[0] += sign
+        counts[1] += 0 if notification["read"] else sign
+        if counts[0] <= 0:
+            del self.pending_by_user[user_id]
+
+    async def flush(self) -> int:
+        """Write every buffered notification; returns how many were written"""
+        async with self._flush_lock:
+            batch, self.pending = self.pending, []
+            self.pending_by_user = {}
+            written = 0
+            try:
+                for start in range(0, len(batch), self.batch_size):
+                    chunk = batch[start:start + self.batch_size]
+                    await asyncio.to_thread(self._write, chunk)
+                    written += len(chunk)
+                    self.stats["written"] += len(chunk)
+                    self.stats["batches"] += 1
+            except Exception as e:
+                # Keep what was not written for the next attempt
+                self.stats["write_errors"] += 1
+                logger.error(f"Failed to write notifications: {e}")
+                unwritten = batch[written:]
+                self.pending = unwritten + self.pending
+                for notification in unwritten:
+                    self._pend(notification, 1)
+                if len(self.pending) > self.max_pending:
+                    self._drop_oldest(len(self.pending) - self.max_pending)
+            return written
+
+    def _write(self, batch: List[Dict]):
+        deltas: Dict[str, List[int]] = {}
+        for notification in batch:
+            delta = deltas.setdefault(notification["user_id"], [0, 0])
+            delta[0] += 1
+            delta[1] += 0 if notification["read"] else 1
+
+        db = SessionLocal()
+        try:
+            db.execute(insert(Notification), [_to_row(notification) for notification in batch])
+            self._add_to_counters(db, deltas)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def _add_to_counters(db: Session, deltas: Dict[str, List[int]]):
+        """Add (total, unread) deltas to each user's counters in one statement"""
+        dialect = db.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        else:
+            for user_id, (total, unread) in deltas.items():
+                updated = db.query(NotificationCounter).filter(NotificationCounter.user_id == user_id).update({
+                    NotificationCounter.total_count: NotificationCounter.total_count + total,
+                    NotificationCounter.unread_count: NotificationCounter.unread_count + unread
+                }, synchronize_session=False)
+                if not updated:
+                    db.add(NotificationCounter(user_id=user_id, total_count=total, unread_count=unread))
+            return
+
+        statement = upsert(NotificationCounter).values([
+            {"user_id": user_id, "total_count": total, "unread_count": unread}
+            for user_id, (total, unread) in deltas.items()
+        ])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[NotificationCounter.user_id],
+            set_={
+                "total_count": NotificationCounter.total_count + statement.excluded.total_count,
+                "unread_count": NotificationCounter.unread_count + statement.excluded.unread_count
+            }
+        ))
+
+    async def _flush_user(self, user_id: str):
+        """Make the user's buffered notifications visible to queries"""
+        # A batch being written has already left pending_by_user, so wait for it too
+        if self.pending_by_user.get(user_id) or self._flush_lock.locked():
+            await self.flush()
+
+    def _cached(self, user_id: str) -> Optional[UserNotifications]:
+        """The user's cached ring, unless it is older than the TTL (another worker may have written since)"""
+        head = self.heads.get(user_id)
+        if head is None or time.monotonic() - head.loaded_at >= self.head_ttl:
+            return None
+        self.heads.move_to_end(user_id)
+        return head
+
+    async def _head(self, user_id: str) -> UserNotifications:
+        head = self._cached(user_id)
+        if head is not None:
+            return head
+
+        await self._flush_user(user_id)
+        # No batch is written while the snapshot loads, so the user's buffered
+        # notifications afterwards are exactly the ones it cannot contain
+        async with self._flush_lock:
+            entries, total, unread = await asyncio.to_thread(self._load_head, user_id)
+            head = UserNotifications(self.head_size, entries, total=total, unread=unread,
+                                     complete=len(entries) < self.head_size)
+            for notification in self.pending:
+                if notification["user_id"] == user_id:
+                    head.add(notification)
+        self.heads[user_id] = head
+        self.heads.move_to_end(user_id)
+        while len(self.heads) > self.head_users:
+            self.heads.popitem(last=False)
+        self.stats["head_loads"] += 1
+        return head
+
+    def _load_head(self, user_id: str) -> Tuple[List[Dict], int, int]:
+        db = SessionLocal()
+        try:
+            rows = db.query(Notification).filter(Notification.user_id == user_id).order_by(
+                Notification.timestamp.desc(), Notification.id.desc()
+            ).limit(self.head_size).all()
+            entries = [_to_dict(row) for row in rows]
+            counter = db.get(NotificationCounter, user_id)
+        finally:
+            db.close()
+        if counter is None:
+            return entries, len(entries), sum(1 for entry in entries if not entry["read"])
+        return entries, counter.total_count, counter.unread_count
+
+    async def get_page(self, user_id: str, limit: int = 50, unread_only: bool = False,
+                       before: Optional[str] = None) -> List[Dict]:
+        """Newest notifications first; pass the id of the last one received as `before` for the next page"""
+        limit = max(1, min(limit, NOTIFICATION_PAGE_MAX))
+        if before is None:
+            head = await self._head(user_id)
+            entries = head.latest(limit, unread_only)
+            if entries is not None:
+                self.stats["head_hits"] += 1
+                return entries
+
+        await self._flush_user(user_id)
+        self.stats["page_queries"] += 1
+        return await asyncio.to_thread(self._query_page, user_id, limit, unread_only, before)
+
+    @staticmethod
+    def _query_page(user_id: str, limit: int, unread_only: bool, before: Optional[str]) -> List[Dict]:
+        db = SessionLocal()
+        try:
+            query = db.query(Notification).filter(Notification.user_id == user_id)
+            if unread_only:
+                query = query.filter(Notification.read.is_(False))
+            if before is not None:
+                anchor = db.query(Notification.timestamp, Notification.id).filter(
+                    Notification.id == before, Notification.user_id == user_id
+                ).first()
+                if anchor is None:
+                    return []
+                query = query.filter(or_(
+                    Notification.timestamp < anchor.timestamp,
+                    and_(Notification.timestamp == anchor.timestamp, Notification.id < anchor.id)
+                ))
+            rows = query.order_by(Notification.timestamp.desc(), Notification.id.desc()).limit(limit).all()
+            return [_to_dict(row) for row in rows]
+        finally:
+            db.close()
+
+    async def mark_read(self, user_id: str, notification_id: str) -> bool:
+        """Mark one notification read; False if the user has no such notification"""
+        head = self._cached(user_id)
+        entry = head.get(notification_id) if head is not None else None
+        if entry is not None and entry["read"]:
+            return True  # Already read; nothing to write
+
+        await self._flush_user(user_id)
+        flipped = await asyncio.to_thread(self._mark_read_row, user_id, notification_id, entry is not None)
+        if flipped is None:
+            return False
+
+        head = self.heads.get(user_id)
+        if head is not None:
+            head.mark_read(notification_id, flipped=flipped)
+        return True
+
+    @staticmethod
+    def _mark_read_row(user_id: str, notification_id: str, known: bool) -> Optional[bool]:
+        """True if this call flipped the flag, False if it was already read, None if there is no such row"""
+        db = SessionLocal()
+        try:
+            # Only the request that flips the flag decrements the counter
+            flipped = db.query(Notification).filter(
+                Notification.id == notification_id,
+                Notification.user_id == user_id,
+                Notification.read.is_(False)
+            ).update({Notification.read: True}, synchronize_session=False)
+            if flipped:
+                db.query(NotificationCounter).filter(NotificationCounter.user_id == user_id).update(
+                    {NotificationCounter.unread_count: NotificationCounter.unread_count - 1},
+                    synchronize_session=False
+                )
+            elif not known and db.query(Notification.id).filter(
+                Notification.id == notification_id, Notification.user_id == user_id
+            ).first() is None:
+                return None
+            db.commit()
+            return bool(flipped)
+        finally:
+            db.close()
+
+    async def mark_all_read(self, user_id: str) -> int:
+        """Mark every notification of a user read; returns how many changed"""
+        await self._flush_user(user_id)
+        changed = await asyncio.to_thread(self._mark_all_read_rows, user_id)
+
+        head = self.heads.get(user_id)
+        if head is not None:
+            head.mark_all_read()
+        return changed
+
+    @staticmethod
+    def _mark_all_read_rows(user_id: str) -> int:
+        db = SessionLocal()
+        try:
+            changed = db.query(Notification).filter(
+                Notification.user_id == user_id, Notification.read.is_(False)
+            ).update({Notification.read: True}, synchronize_session=False)
+            db.query(NotificationCounter).filter(NotificationCounter.user_id == user_id).update(
+                {NotificationCounter.unread_count: 0}, synchronize_session=False
+            )
+            db.commit()
+            return changed
+        finally:
+            db.close()
+
+    async def delete(self, user_id: str, notification_id: str) -> bool:
+        """Delete one notification; False if the user has no such notification"""
+        for position, notification in enumerate(self.pending):
+            if notification["id"] == notification_id and notification["user_id"] == user_id:
+                # Never written; dropping it from the buffer is enough
+                del self.pending[position]
+                self._pend(notification, -1)
+                was_read = notification["read"]
+                break
+        else:
+            await self._flush_user(user_id)
+            was_read = await asyncio.to_thread(self._delete_row, user_id, notification_id)
+            if was_read is None:
+                return False
+
+        head = self.heads.get(user_id)
+        if head is not None:
+            head.remove(notification_id, was_read)
+        self.stats["deleted"] += 1
+        return True
+
+    @staticmethod
+    def _delete_row(user_id: str, notification_id: str) -> Optional[bool]:
+        """Whether the deleted row was read, or None if there was no such row"""
+        db = SessionLocal()
+        try:
+            # RETURNING: only the request that actually deleted the row adjusts the counters
+            deleted = db.execute(delete(Notification).where(
+                Notification.id == notification_id, Notification.user_id == user_id
+            ).returning(Notification.read)).first()
+            if deleted is None:
+                db.rollback()
+                return None
+            was_read = deleted.read
+            db.query(NotificationCounter).filter(NotificationCounter.user_id == user_id).update({
+                NotificationCounter.total_count: NotificationCounter.total_count - 1,
+                NotificationCounter.unread_count: NotificationCounter.unread_count - (0 if was_read else 1)
+            }, synchronize_session=False)
+            db.commit()
+            return was_read
+        finally:
+            db.close()
+
+    def forget(self, user_ids):
+        """Drop cached heads after their notifications were removed behind the cache's back"""
+        for user_id in user_ids:
+            self.heads.pop(user_id, None)
+
+    async def counts(self, user_id: str) -> Dict:
+        """Total and unread counts: from the cached ring, else the maintained counters plus the unwritten buffer"""
+        head = self._cached(user_id)
+        if head is not None:
+            return head.counts()
+
+        # Read under the flush lock so a batch is counted either in the table or in the buffer, never both
+        async with self._flush_lock:
+            total, unread = await asyncio.to_thread(self._load_counter, user_id)
+            pending_total, pending_unread = self.pending_by_user.get(user_id, (0, 0))
+        total += pending_total
+        unread += pending_unread
+        return {
+            "total_notifications": total,
+            "unread_notifications": unread,
+            "read_notifications": total - unread
+        }
+
+    @staticmethod
+    def _load_counter(user_id: str) -> Tuple[int, int]:
+        db = SessionLocal()
+        try:
+            counter = db.get(NotificationCounter, user_id)
+            return (counter.total_count, counter.unread_count) if counter else (0, 0)
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "pending": len(self.pending),
+            "cached_users": len(self.heads),
+            "batch_size": self.batch_size,
+            "head_size": self.head_size
+        }
@@ -0,0 +1,225 @@
+import asyncio
+import os
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sqlalchemy import or_, update
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.models.outbox import OutboxEvent
+from app.models.ride import Ride
+from app.services.notification_service import notification_service, NotificationType
+from app.services.websocket_service import manager
+from app.services.event_stream import event_stream_hub
+
+logger = logging.getLogger(__name__)
+
+# Events delivered per transaction
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+# Fallback poll when no endpoint woke the dispatcher, e.g. events written by another worker (seconds)
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+# How often the cursor restarts from the oldest undelivered event, catching
+# transactions that committed after a higher id was already delivered (seconds)
+OUTBOX_RESCAN_SECONDS = float(os.getenv("OUTBOX_RESCAN_SECONDS", "30"))
+# A claimed event not marked delivered within this long is claimed again (seconds)
+OUTBOX_CLAIM_TIMEOUT_SECONDS = float(os.getenv("OUTBOX_CLAIM_TIMEOUT_SECONDS", "60"))
+
+# Push/in-app notification sent for each event type; the rest are WebSocket only
+EVENT_NOTIFICATIONS = {
+    "ride_requested": NotificationType.RIDE_REQUEST,
+    "ride_request_accepted": NotificationType.RIDE_ACCEPTED,
+    "ride_request_declined": NotificationType.RIDE_DECLINED,
+    "ride_started": NotificationType.RIDE_STARTED,
+    "ride_completed": NotificationType.RIDE_COMPLETED,
+    "ride_cancelled": NotificationType.RIDE_CANCELLED,
+}
+
+def record_ride_event(db: Session, ride: Ride, event_type: str, recipient_ids: List[str],
+                      payload: Dict = None) -> OutboxEvent:
+    """Add a ride event to the caller's transaction; it is only delivered if the caller commits"""
+    # Kept even without recipients: the company's admin stream sees every event
+    recipients = [user_id for user_id in dict.fromkeys(recipient_ids) if user_id]
+    event = OutboxEvent(
+        event_type=event_type,
+        ride_id=ride.id,
+        company_id=ride.company_id,
+        recipient_ids=recipients,
+        payload={"status": ride.status, **(payload or {})}
+    )
+    db.add(event)
+    return event
+
+class OutboxDispatcher:
+    """
+    Delivers outbox events in id order. A short transaction claims each batch
+    (SELECT ... FOR UPDATE SKIP LOCKED, stamp claimed_at, commit); the events
+    are delivered with no locks held, then stamped dispatched_at in a second
+    short transaction. Both transactions run in a worker thread, off the
+    event loop. Workers skip each other's live claims; a claim left by a
+    crash expires and the batch is re-delivered, so clients drop duplicates
+    by event_id.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll_seconds: float = OUTBOX_POLL_SECONDS,
+                 rescan_seconds: float = OUTBOX_RESCAN_SECONDS,
+                 claim_timeout_seconds: float = OUTBOX_CLAIM_TIMEOUT_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.rescan_seconds = rescan_seconds
+        self.claim_timeout = timedelta(seconds=claim_timeout_seconds)
+        self.cursor = 0
+        self._last_rescan = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "events_dispatched": 0, "messages_sent": 0,
+                      "notifications_sent": 0, "delivery_errors": 0, "rescans": 0}
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def wake(self):
+        """Called after a commit that wrote events, so they go out without waiting for the poll"""
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+
+    async def drain(self) -> int:
+        """Deliver every undelivered event past the cursor; returns how many were delivered"""
+        now = time.monotonic()
+        if now - self._last_rescan >= self.rescan_seconds:
+            self._last_rescan = now
+            self.cursor = 0
+            self.stats["rescans"] += 1
+
+        delivered = 0
+        while True:
+            count = await self._dispatch_batch()
+            delivered += count
+            if count < self.batch_size:
+                return delivered
+
+    async def _dispatch_batch(self) -> int:
+        events = await asyncio.to_thread(self._claim_batch)
+        if not events:
+            return 0
+
+        for event in events:
+            await self._deliver(event)
+        dispatched_at = await asyncio.to_thread(self._mark_dispatched, [event.id for event in events])
+
+        for event in events:
+            if event.created_at is not None:
+                created_at = event.created_at
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                lag = (dispatched_at - created_at).total_seconds()
+                self._lag_total += lag
+                self._lag_max = max(self._lag_max, lag)
+        self.cursor = events[-1].id
+        self.stats["batches"] += 1
+        self.stats["events_dispatched"] += len(events)
+        return len(events)
+
+    def _claim_batch(self) -> List[OutboxEvent]:
+        """Claim the next undelivered events and commit, so no row lock outlives this call"""
+        db = SessionLocal()
+        try:
+            now = datetime.now(timezone.utc)
+            events = db.query(OutboxEvent).filter(
+                OutboxEvent.id > self.cursor,
+                OutboxEvent.dispatched_at.is_(None),
+                or_(OutboxEvent.claimed_at.is_(None), OutboxEvent.claimed_at < now - self.claim_timeout)
+            ).order_by(OutboxEvent.id).limit(self.batch_size).with_for_update(skip_locked=True).all()
+            if not events:
+                db.rollback()
+                return []
+
+            db.execute(update(OutboxEvent).where(
+                OutboxEvent.id.in_([event.id for event in events])
+            ).values(claimed_at=now))
+            # Detached before the commit so the loaded rows stay readable during delivery
+            db.expunge_all()
+            db.commit()
+            return events
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _mark_dispatched(self, event_ids: List[int]) -> datetime:
+        dispatched_at = datetime.now(timezone.utc)
+        db = SessionLocal()
+        try:
+            db.execute(update(OutboxEvent).where(OutboxEvent.id.in_(event_ids)).values(dispatched_at=dispatched_at))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        return dispatched_at
+
+    async def _deliver(self, event: OutboxEvent):
+        payload = event.payload or {}
+        message = {
+            "type": "ride_event",
+            "event_id": event.id,
+            "event": event.event_type,
+            "data": {"ride_id": event.ride_id, **payload},
+            "timestamp": (event.created_at or datetime.now(timezone.utc)).isoformat()
+        }
+        notification_type = EVENT_NOTIFICATIONS.get(event.event_type)
+        try:
+            await event_stream_hub.publish(event.id, event.event_type, event.company_id,
+                                           event.recipient_ids or [], message["data"])
+        except Exception as e:
+            self.stats["delivery_errors"] += 1
+            logger.error(f"Failed to publish outbox event {event.id} to event streams: {e}")
+        for user_id in event.recipient_ids or []:
+            try:
+                await manager.send_personal_message(message, user_id)
+                self.stats["messages_sent"] += 1
+                if notification_type is not None:
+                    await notification_service.send_ride_notification(
+                        user_id, event.ride_id, notification_type, {"event_id": event.id, **payload}
+                    )
+                    self.stats["notifications_sent"] += 1
+            except Exception as e:
+                # One unreachable recipient must not hold back the rest of the batch
+                self.stats["delivery_errors"] += 1
+                logger.error(f"Failed to deliver outbox event {event.id} to {user_id}: {e}")
+
+    def get_stats(self) -> Dict:
+        dispatched = self.stats["events_dispatched"]
+        return {
+            **self.stats,
+            "cursor": self.cursor,
+            "avg_dispatch_lag_ms": round(self._lag_total / dispatched * 1000, 1) if dispatched else 0.0,
+            "max_dispatch_lag_ms": round(self._lag_max * 1000, 1),
+            "batch_size": self.batch_size
+        }
+
+# Global instance
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import os
+import time
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How long a ride request waits for a driver before it expires (seconds)
+PENDING_RIDE_TTL_SECONDS = float(os.getenv("PENDING_RIDE_TTL_SECONDS", "120"))
+# Open requests allowed per rider and per company on this worker
+MAX_PENDING_RIDES_PER_RIDER = int(os.getenv("MAX_PENDING_RIDES_PER_RIDER", "3"))
+MAX_PENDING_RIDES_PER_COMPANY = int(os.getenv("MAX_PENDING_RIDES_PER_COMPANY", "500"))
+# How often expired requests are collected (seconds)
+PENDING_RIDE_SWEEP_SECONDS = float(os.getenv("PENDING_RIDE_SWEEP_SECONDS", "1"))
+
+class PendingRideLimitError(Exception):
+    """Raised when a rider or company already has too many open ride requests"""
+
+    def __init__(self, scope: str, limit: int):
+        self.scope = scope
+        self.limit = limit
+        super().__init__(f"Too many pending ride requests for this {scope} (limit {limit})")
+
+class PendingRideStore:
+    """
+    Ride requests waiting for a driver, each with its own expiry time.
+    A min-heap of (expires_at, ride_id) makes expiry O(log n) per entry;
+    entries resolved early are skipped lazily when they reach the top.
+    """
+
+    def __init__(self, ttl_seconds: float = PENDING_RIDE_TTL_SECONDS,
+                 max_per_rider: int = MAX_PENDING_RIDES_PER_RIDER,
+                 max_per_company: int = MAX_PENDING_RIDES_PER_COMPANY):
+        self.ttl_seconds = ttl_seconds
+        self.max_per_rider = max_per_rider
+        self.max_per_company = max_per_company
+        self.rides: Dict[str, Dict] = {}
+        self.expires_at: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self.by_rider: Dict[str, Set[str]] = {}
+        self.by_company: Dict[str, Set[str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"added": 0, "resolved": 0, "expired": 0, "rejected_rider_limit": 0, "rejected_company_limit": 0}
+
+    def __contains__(self, ride_id: str) -> bool:
+        return ride_id in self.rides
+
+    def __len__(self) -> int:
+        return len(self.rides)
+
+    def get(self, ride_id: str) -> Optional[Dict]:
+        return self.rides.get(ride_id)
+
+    def add(self, ride_id: str, ride_data: Dict, ttl_seconds: float = None, now: float = None):
+        """Store a ride request; raises PendingRideLimitError when a cap is reached"""
+        now = time.monotonic() if now is None else now
+        rider_id = ride_data.get("rider_id")
+        company_id = ride_data.get("company_id")
+        if ride_id not in self.rides:
+            if rider_id and len(self.by_rider.get(rider_id, ())) >= self.max_per_rider:
+                self.stats["rejected_rider_limit"] += 1
+                raise PendingRideLimitError("rider", self.max_per_rider)
+            if company_id and len(self.by_company.get(company_id, ())) >= self.max_per_company:
+                self.stats["rejected_company_limit"] += 1
+                raise PendingRideLimitError("company", self.max_per_company)
+        else:
+            self._unindex(ride_id)
+
+        expires_at = now + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        self.rides[ride_id] = ride_data
+        self.expires_at[ride_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, ride_id))
+        if rider_id:
+            self.by_rider.setdefault(rider_id, set()).add(ride_id)
+        if company_id:
+            self.by_company.setdefault(company_id, set()).add(ride_id)
+        self.stats["added"] += 1
+
+    def pop(self, ride_id: str) -> Optional[Dict]:
+        """Remove a request that was answered; its heap entry is discarded later"""
+        if ride_id not in self.rides:
+            return None
+        self.stats["resolved"] += 1
+        return self._remove(ride_id)
+
+    def expire(self, now: float = None) -> List[Dict]:
+        """Remove and return every request whose TTL has passed"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, ride_id = heapq.heappop(self._heap)
+            # Skip entries for requests answered or re-added since
+            if self.expires_at.get(ride_id) != expires_at:
+                continue
+            expired.append(self._remove(ride_id))
+        self.stats["expired"] += len(expired)
+
+        # Bound the stale entries left behind by early removals
+        if len(self._heap) > 2 * len(self.rides) + 64:
+            self._heap = [(expires_at, ride_id) for ride_id, expires_at in self.expires_at.items()]
+            heapq.heapify(self._heap)
+        return expired
+
+    def _remove(self, ride_id: str) -> Dict:
+        self._unindex(ride_id)
+        del self.expires_at[ride_id]
+        return self.rides.pop(ride_id)
+
+    def _unindex(self, ride_id: str):
+        ride_data = self.rides[ride_id]
+        for index, key in ((self.by_rider, ride_data.get("rider_id")), (self.by_company, ride_data.get("company_id"))):
+            members = index.get(key)
+            if members is not None:
+                members.discard(ride_id)
+                if not members:
+                    del index[key]
+
+    def start(self, on_expired: Callable[[Dict], Awaitable[None]]):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(on_expired))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, on_expired: Callable[[Dict], Awaitable[None]]):
+        while True:
+            try:
+                await asyncio.sleep(PENDING_RIDE_SWEEP_SECONDS)
+                for ride_data in self.expire():
+                    # One failed notification must not drop the rest of the batch
+                    try:
+                        await on_expired(ride_data)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Expiry callback failed for ride {ride_data.get('id')}: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pending ride expiry failed: {e}")
+
+    def next_expiry(self) -> Optional[float]:
+        """Earliest live expiry time; stale entries at the top of the heap are discarded"""
+        while self._heap and self.expires_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        oldest = self.next_expiry()
+        return {
+            **self.stats,
+            "pending": len(self.rides),
+            "riders_waiting": len(self.by_rider),
+            "companies": len(self.by_company),
+            "heap_entries": len(self._heap),
+            "next_expiry_seconds": round(oldest - now, 1) if oldest is not None else None,
+            "ttl_seconds": self.ttl_seconds
+        }
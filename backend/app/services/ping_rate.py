@@ -0,0 +1,160 @@
+import os
+import time
+import logging
+from typing import Dict, Optional, Tuple
+from app.services.location_service import LocationService
+
+logger = logging.getLogger(__name__)
+
+# Interval bounds (seconds) for location pings
+PING_INTERVAL_MIN = float(os.getenv("PING_INTERVAL_MIN", "2"))
+PING_INTERVAL_ACTIVE_MAX = float(os.getenv("PING_INTERVAL_ACTIVE_MAX", "30"))
+PING_INTERVAL_IDLE = float(os.getenv("PING_INTERVAL_IDLE", "30"))
+PING_INTERVAL_PARKED = float(os.getenv("PING_INTERVAL_PARKED", "60"))
+
+# Intervals are snapped to these steps so small speed changes don't cause a push
+PING_INTERVAL_STEPS = (2.0, 5.0, 10.0, 15.0, 30.0, 60.0)
+
+ACTIVE_RIDE_STATUSES = ("confirmed", "in_progress")
+
+class PingRatePolicy:
+    """Compute a recommended location ping interval"""
+
+    def __init__(self,
+                 min_interval: float = PING_INTERVAL_MIN,
+                 active_max_interval: float = PING_INTERVAL_ACTIVE_MAX,
+                 idle_interval: float = PING_INTERVAL_IDLE,
+                 parked_interval: float = PING_INTERVAL_PARKED,
+                 near_distance_km: float = 0.5,
+                 stationary_speed_kmh: float = 3.0,
+                 pings_before_fence: int = 3):
+        self.min_interval = min_interval
+        self.active_max_interval = active_max_interval
+        self.idle_interval = idle_interval
+        self.parked_interval = parked_interval
+        self.near_distance_km = near_distance_km
+        self.stationary_speed_kmh = stationary_speed_kmh
+        self.pings_before_fence = pings_before_fence
+
+    def recommend(self, speed_kmh: Optional[float], distance_km: Optional[float],
+                  ride_status: Optional[str]) -> float:
+        """
+        Recommend an interval from speed, distance to the next pickup/drop-off
+        and ride status. Returns seconds.
+        """
+        stationary = speed_kmh is not None and speed_kmh < self.stationary_speed_kmh
+
+        # No active ride: nobody is waiting on this position
+        if ride_status not in ACTIVE_RIDE_STATUSES:
+            interval = self.parked_interval if stationary else self.idle_interval
+            return self._snap(interval)
+
+        # Close to the fence: full precision
+        if distance_km is not None and distance_km <= self.near_distance_km:
+            return self._snap(self.min_interval)
+
+        if distance_km is None or speed_kmh is None:
+            return self._snap(self.active_max_interval / 3)
+
+        if stationary:
+            return self._snap(self.active_max_interval / 2)
+
+        # Ping several times before the vehicle can reach the fence
+        seconds_to_fence = (distance_km - self.near_distance_km) / speed_kmh * 3600
+        interval = seconds_to_fence / self.pings_before_fence
+        interval = max(self.min_interval, min(self.active_max_interval, interval))
+        return self._snap(interval)
+
+    def _snap(self, interval: float) -> float:
+        """Round down to the nearest configured step"""
+        snapped = PING_INTERVAL_STEPS[0]
+        for step in PING_INTERVAL_STEPS:
+            if step <= interval:
+                snapped = step
+        return max(snapped, self.min_interval)
+
+class PingRateController:
+    """Track recommended intervals per user and throttle clients that ignore them"""
+
+    def __init__(self, policy: PingRatePolicy = None, tolerance: float = 0.8):
+        self.policy = policy or PingRatePolicy()
+        # Accept pings arriving slightly early to absorb network jitter
+        self.tolerance = tolerance
+        self.intervals: Dict[str, float] = {}
+        # user_id -> (monotonic time, latitude, longitude) of last accepted ping
+        self.last_accepted: Dict[str, Tuple[float, Optional[float], Optional[float]]] = {}
+        # Users already reminded of their interval since their last accepted ping
+        self.reminded: Dict[str, bool] = {}
+        self.stats = {"accepted": 0, "throttled": 0, "interval_changes": 0}
+
+    def get_interval(self, user_id: str) -> float:
+        """Current recommended interval for a user"""
+        return self.intervals.get(user_id, self.policy.idle_interval)
+
+    def allow(self, user_id: str, now: float = None) -> bool:
+        """Return True if a ping from this user should be ingested"""
+        now = time.monotonic() if now is None else now
+        last = self.last_accepted.get(user_id)
+        if last is not None and now - last[0] < self.get_interval(user_id) * self.tolerance:
+            self.stats["throttled"] += 1
+            return False
+        self.stats["accepted"] += 1
+        self.reminded.pop(user_id, None)
+        return True
+
+    def retry_after(self, user_id: str, now: float = None) -> float:
+        """Seconds until the next ping from this user will be accepted"""
+        now = time.monotonic() if now is None else now
+        last = self.last_accepted.get(user_id)
+        if last is None:
+            return 0.0
+        return max(0.0, last[0] + self.get_interval(user_id) * self.tolerance - now)
+
+    def needs_reminder(self, user_id: str) -> bool:
+        """Return True once per throttled burst so the interval is re-sent"""
+        if self.reminded.get(user_id):
+            return False
+        self.reminded[user_id] = True
+        return True
+
+    def record(self, user_id: str, latitude: Optional[float], longitude: Optional[float],
+               speed_kmh: Optional[float], distance_km: Optional[float],
+               ride_status: Optional[str], now: float = None) -> Optional[float]:
+        """
+        Record an accepted ping and recompute the user's interval.
+        Returns the new interval if it changed, None otherwise.
+        """
+        now = time.monotonic() if now is None else now
+        last = self.last_accepted.get(user_id)
+
+        # Derive speed from consecutive pings when the client doesn't send it
+        if speed_kmh is None and last is not None and None not in (latitude, longitude, last[1], last[2]):
+            elapsed = now - last[0]
+            if elapsed > 0:
+                moved_km = LocationService.calculate_distance(last[1], last[2], latitude, longitude)
+                speed_kmh = moved_km / elapsed * 3600
+
+        self.last_accepted[user_id] = (now, latitude, longitude)
+
+        interval = self.policy.recommend(speed_kmh, distance_km, ride_status)
+        if self.intervals.get(user_id) == interval:
+            return None
+
+        self.intervals[user_id] = interval
+        self.stats["interval_changes"] += 1
+        return interval
+
+    def forget(self, user_id: str):
+        """Drop all state for a user"""
+        self.intervals.pop(user_id, None)
+        self.last_accepted.pop(user_id, None)
+        self.reminded.pop(user_id, None)
+
+    def get_stats(self) -> Dict:
+        """Ingest statistics"""
+        total = self.stats["accepted"] + self.stats["throttled"]
+        return {
+            **self.stats,
+            "tracked_users": len(self.intervals),
+            "throttle_ratio": round(self.stats["throttled"] / total, 4) if total else 0.0
+        }
@@ -0,0 +1,115 @@
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# Longest company id accepted from a client
+MAX_COMPANY_ID_LENGTH = 64
+
+def _coordinate(value, limit: float) -> float:
+    number = float(value)
+    if not -limit <= number <= limit:
+        raise ValueError(f"Coordinate out of range: {value}")
+    return number
+
+def _optional_float(value, minimum: float = None) -> Optional[float]:
+    if value is None:
+        return None
+    number = float(value)
+    if number != number or (minimum is not None and number < minimum):  # NaN or below range
+        return None
+    return number
+
+def _epoch_seconds(value) -> Optional[float]:
+    """Client timestamp (ISO string or epoch seconds/milliseconds) as epoch seconds"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+class PresenceRecord:
+    """Fixed-shape presence state of one connected user, parsed from location updates"""
+    __slots__ = ("company_id", "is_driver", "is_available", "latitude", "longitude",
+                 "heading", "speed", "client_timestamp", "updated_at")
+
+    def __init__(self):
+        self.company_id: Optional[str] = None
+        self.is_driver: Optional[bool] = None
+        self.is_available: Optional[bool] = None
+        self.latitude: Optional[float] = None
+        self.longitude: Optional[float] = None
+        self.heading: Optional[float] = None
+        self.speed: Optional[float] = None
+        self.client_timestamp: Optional[float] = None
+        self.updated_at: float = 0.0
+
+    def apply(self, data: Dict) -> bool:
+        """
+        Merge a location update into the record. Fields missing from the update
+        keep their previous value (compact binary frames only carry coordinates).
+        Raises ValueError for malformed coordinates; returns True if the company,
+        driver flag or availability changed.
+        """
+        latitude = data.get("latitude")
+        longitude = data.get("longitude")
+        if (latitude is None) != (longitude is None):
+            raise ValueError("latitude and longitude must be sent together")
+        if latitude is not None:
+            latitude = _coordinate(latitude, 90)
+            longitude = _coordinate(longitude, 180)
+
+        company_id = data.get("company_id")
+        if company_id is not None:
+            company_id = str(company_id)
+            if len(company_id) > MAX_COMPANY_ID_LENGTH:
+                raise ValueError("company_id too long")
+        speed = _optional_float(data.get("speed"), minimum=0)
+        heading = _optional_float(data.get("heading"))
+
+        # Everything parsed; nothing below can fail half-way
+        previous = (self.company_id, self.is_driver, self.is_available)
+        if company_id is not None:
+            # Thousands of users share a handful of company ids
+            self.company_id = sys.intern(company_id)
+        if data.get("is_driver") is not None:
+            self.is_driver = bool(data["is_driver"])
+        if data.get("is_available") is not None:
+            self.is_available = bool(data["is_available"])
+
+        if latitude is not None:
+            self.latitude = latitude
+            self.longitude = longitude
+        if "speed" in data:
+            self.speed = speed
+        if "heading" in data:
+            self.heading = heading % 360 if heading is not None else None
+        self.client_timestamp = _epoch_seconds(data.get("timestamp"))
+        self.updated_at = time.time()
+
+        return previous != (self.company_id, self.is_driver, self.is_available)
+
+    @property
+    def has_location(self) -> bool:
+        return self.latitude is not None and self.longitude is not None
+
+    def location(self) -> Dict:
+        """Position fields forwarded to riders"""
+        return {"latitude": self.latitude, "longitude": self.longitude, "speed": self.speed, "heading": self.heading}
+
+    def to_dict(self) -> Dict:
+        return {
+            "company_id": self.company_id,
+            "is_driver": self.is_driver,
+            "is_available": self.is_available,
+            **self.location(),
+            "timestamp": datetime.fromtimestamp(self.client_timestamp, tz=timezone.utc).isoformat()
+            if self.client_timestamp is not None else None,
+            "updated_at": datetime.fromtimestamp(self.updated_at, tz=timezone.utc).isoformat()
+        }
@@ -0,0 +1,405 @@
+import asyncio
+import heapq
+import json
+import os
+import random
+import socket
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# "log" (development: log and drop) or "http_stub" (POST batches to a local stub server)
+PUSH_PROVIDER = os.getenv("PUSH_PROVIDER", "log")
+PUSH_STUB_URL = os.getenv("PUSH_STUB_URL", "http://localhost:8099/send")
+# "memory" (single worker, lost on restart) or "redis" (durable, shared by all workers)
+PUSH_QUEUE_BACKEND = os.getenv("PUSH_QUEUE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+# Concurrent provider calls per server worker
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "4"))
+# Messages per provider call (FCM accepts up to 500)
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "500"))
+# Attempts before a message is dead-lettered, and the retry backoff range (seconds)
+PUSH_MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", "5"))
+PUSH_BACKOFF_BASE_SECONDS = float(os.getenv("PUSH_BACKOFF_BASE_SECONDS", "1"))
+PUSH_BACKOFF_MAX_SECONDS = float(os.getenv("PUSH_BACKOFF_MAX_SECONDS", "300"))
+# Dead letters kept for inspection
+PUSH_DEAD_LETTER_MAX = int(os.getenv("PUSH_DEAD_LETTER_MAX", "10000"))
+# Provider call timeout (seconds)
+PUSH_PROVIDER_TIMEOUT_SECONDS = float(os.getenv("PUSH_PROVIDER_TIMEOUT_SECONDS", "10"))
+
+# Per-message outcomes reported by a provider
+PUSH_OK = "ok"
+PUSH_RETRY = "retry"                  # Transient: provider unavailable, rate limited, timeout
+PUSH_INVALID_TOKEN = "invalid_token"  # Device unregistered; drop the token
+PUSH_FAILED = "failed"                # Permanent: malformed message, rejected payload
+
+InvalidTokenHandler = Callable[[str, str], Awaitable[None]]
+
+def push_message(user_id: str, token: str, notification: Dict) -> Dict:
+    """Queue entry for one device"""
+    return {
+        "id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "token": token,
+        "title": notification["title"],
+        "body": notification["message"],
+        "data": {"notification_id": notification.get("id"), "type": notification.get("type"),
+                 **(notification.get("data") or {})},
+        "priority": notification.get("priority", "normal"),
+        "attempt": 0
+    }
+
+class PushProvider(ABC):
+    """Sends a batch of messages to a push service"""
+
+    @abstractmethod
+    async def send(self, messages: List[Dict]) -> List[str]:
+        """One outcome (PUSH_OK, PUSH_RETRY, ...) per message, in order"""
+
+class LogPushProvider(PushProvider):
+    """Development provider: logs each batch and reports success"""
+
+    async def send(self, messages: List[Dict]) -> List[str]:
+        logger.info(f"Push batch of {len(messages)} would be sent: {messages[0]['title'] if messages else ''}")
+        return [PUSH_OK] * len(messages)
+
+class HttpStubPushProvider(PushProvider):
+    """
+    POSTs {"messages": [...]} to a local stub (see push_stub_server.py) and reads
+    {"results": ["ok" | "retry" | "invalid_token" | "failed", ...]}. A 429/5xx
+    response or a connection error retries the whole batch.
+    """
+
+    def __init__(self, url: str = PUSH_STUB_URL, timeout: float = PUSH_PROVIDER_TIMEOUT_SECONDS):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.timeout = timeout
+
+    async def send(self, messages: List[Dict]) -> List[str]:
+        body = json.dumps({"messages": [
+            {key: message[key] for key in ("id", "token", "title", "body", "data", "priority")}
+            for message in messages
+        ]}).encode()
+        try:
+            status, payload = await asyncio.wait_for(self._post(body), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Push stub unreachable: {e}")
+            return [PUSH_RETRY] * len(messages)
+
+        if status == 429 or status >= 500:
+            return [PUSH_RETRY] * len(messages)
+        if status != 200:
+            return [PUSH_FAILED] * len(messages)
+        results = json.loads(payload).get("results", [])
+        return [results[i] if i < len(results) else PUSH_RETRY for i in range(len(messages))]
+
+    async def _post(self, body: bytes) -> Tuple[int, bytes]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(
+                f"POST {self.path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, payload = response.partition(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        return status, payload
+
+class PushQueue(ABC):
+    """Ready messages, delayed retries and dead letters"""
+
+    async def start(self):
+        """Connect and recover messages left in flight by a crashed worker"""
+
+    async def stop(self):
+        """Disconnect"""
+
+    @abstractmethod
+    async def put(self, messages: List[Dict]):
+        """Queue messages for delivery"""
+
+    @abstractmethod
+    async def get_batch(self, max_items: int, timeout: float) -> List[Dict]:
+        """Up to max_items ready messages; waits up to timeout for the first one"""
+
+    async def ack(self, messages: List[Dict]):
+        """Remove finished messages from the in-flight set"""
+
+    @abstractmethod
+    async def retry(self, message: Dict, delay: float):
+        """Deliver a message again once delay seconds have passed"""
+
+    @abstractmethod
+    async def dead_letter(self, message: Dict, reason: str):
+        """Give up on a message and keep it for inspection"""
+
+    async def promote_due(self) -> int:
+        """Move retries whose backoff has passed back to the ready queue"""
+        return 0
+
+    async def get_stats(self) -> Dict:
+        return {"backend": self.__class__.__name__}
+
+class InMemoryPushQueue(PushQueue):
+    """Process-local queue; anything queued is lost on restart"""
+
+    def __init__(self, dead_letter_max: int = PUSH_DEAD_LETTER_MAX):
+        self.ready = deque()
+        self.delayed: List[Tuple[float, str, Dict]] = []
+        self.dead = deque(maxlen=dead_letter_max)
+        self.available = asyncio.Event()
+
+    async def put(self, messages: List[Dict]):
+        self.ready.extend(messages)
+        if self.ready:
+            self.available.set()
+
+    async def get_batch(self, max_items: int, timeout: float) -> List[Dict]:
+        if not self.ready:
+            self.available.clear()
+            try:
+                await asyncio.wait_for(self.available.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = []
+        while self.ready and len(batch) < max_items:
+            batch.append(self.ready.popleft())
+        return batch
+
+    async def retry(self, message: Dict, delay: float):
+        heapq.heappush(self.delayed, (time.time() + delay, message["id"], message))
+
+    async def dead_letter(self, message: Dict, reason: str):
+        self.dead.append({**message, "reason": reason, "dead_at": time.time()})
+
+    async def promote_due(self) -> int:
+        now = time.time()
+        due = []
+        while self.delayed and self.delayed[0][0] <= now:
+            due.append(heapq.heappop(self.delayed)[2])
+        await self.put(due)
+        return len(due)
+
+    async def get_stats(self) -> Dict:
+        return {"backend": self.__class__.__name__, "ready": len(self.ready),
+                "delayed": len(self.delayed), "dead_letters": len(self.dead)}
+
+class RedisPushQueue(PushQueue):
+    """
+    Durable queue shared by all workers. Messages move atomically from the
+    ready list to this worker's in-flight list and are removed on ack; in-flight
+    lists of workers whose liveness key expired are pushed back on start.
+    """
+
+    READY_KEY = "push:ready"
+    DELAYED_KEY = "push:delayed"
+    DEAD_KEY = "push:dead"
+    ALIVE_TTL_SECONDS = 30
+
+    def __init__(self, url: str = REDIS_URL, dead_letter_max: int = PUSH_DEAD_LETTER_MAX):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.dead_letter_max = dead_letter_max
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.inflight_key = f"push:inflight:{self.worker_id}"
+        self.alive_key = f"push:alive:{self.worker_id}"
+
+    async def start(self):
+        await self.redis.set(self.alive_key, 1, ex=self.ALIVE_TTL_SECONDS)
+        async for key in self.redis.scan_iter(match="push:inflight:*"):
+            owner = key[len("push:inflight:"):]
+            if owner != self.worker_id and not await self.redis.exists(f"push:alive:{owner}"):
+                recovered = 0
+                while await self.redis.lmove(key, self.READY_KEY, "RIGHT", "LEFT"):
+                    recovered += 1
+                logger.warning(f"Recovered {recovered} in-flight push messages of stopped worker {owner}")
+
+    async def stop(self):
+        await self.redis.delete(self.alive_key)
+        await self.redis.close()
+
+    async def put(self, messages: List[Dict]):
+        if messages:
+            await self.redis.lpush(self.READY_KEY, *(json.dumps(message) for message in messages))
+
+    async def get_batch(self, max_items: int, timeout: float) -> List[Dict]:
+        first = await self.redis.blmove(self.READY_KEY, self.inflight_key, timeout, "RIGHT", "LEFT")
+        if first is None:
+            return []
+        raw = [first]
+        if max_items > 1:
+            pipe = self.redis.pipeline(transaction=False)
+            for _ in range(max_items - 1):
+                pipe.lmove(self.READY_KEY, self.inflight_key, "RIGHT", "LEFT")
+            raw.extend(item for item in await pipe.execute() if item is not None)
+        batch = []
+        for item in raw:
+            message = json.loads(item)
+            message["_raw"] = item  # Exact list value, needed to remove it on ack
+            batch.append(message)
+        return batch
+
+    async def ack(self, messages: List[Dict]):
+        pipe = self.redis.pipeline(transaction=False)
+        for message in messages:
+            pipe.lrem(self.inflight_key, 1, message["_raw"])
+        await pipe.execute()
+
+    @staticmethod
+    def _encode(message: Dict, **extra) -> str:
+        return json.dumps({**{key: value for key, value in message.items() if key != "_raw"}, **extra})
+
+    async def retry(self, message: Dict, delay: float):
+        await self.redis.zadd(self.DELAYED_KEY, {self._encode(message): time.time() + delay})
+
+    async def dead_letter(self, message: Dict, reason: str):
+        pipe = self.redis.pipeline()
+        pipe.lpush(self.DEAD_KEY, self._encode(message, reason=reason, dead_at=time.time()))
+        pipe.ltrim(self.DEAD_KEY, 0, self.dead_letter_max - 1)
+        await pipe.execute()
+
+    async def promote_due(self) -> int:
+        await self.redis.set(self.alive_key, 1, ex=self.ALIVE_TTL_SECONDS)
+        due = await self.redis.zrangebyscore(self.DELAYED_KEY, "-inf", time.time(), start=0, num=PUSH_BATCH_SIZE)
+        promoted = 0
+        for item in due:
+            # Only the worker whose ZREM succeeds requeues it
+            if await self.redis.zrem(self.DELAYED_KEY, item):
+                await self.redis.lpush(self.READY_KEY, item)
+                promoted += 1
+        return promoted
+
+    async def get_stats(self) -> Dict:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.READY_KEY)
+        pipe.zcard(self.DELAYED_KEY)
+        pipe.llen(self.DEAD_KEY)
+        pipe.llen(self.inflight_key)
+        ready, delayed, dead, inflight = await pipe.execute()
+        return {"backend": self.__class__.__name__, "ready": ready, "delayed": delayed,
+                "dead_letters": dead, "in_flight": inflight}
+
+class PushWorkerPool:
+    """
+    Delivers queued pushes off the request path: each worker takes a batch,
+    makes one provider call, acks successes, schedules transient failures with
+    jittered exponential backoff and dead-letters the rest.
+    """
+
+    def __init__(self, queue: PushQueue, provider: PushProvider, workers: int = PUSH_WORKERS,
+                 batch_size: int = PUSH_BATCH_SIZE, max_attempts: int = PUSH_MAX_ATTEMPTS,
+                 on_invalid_token: Optional[InvalidTokenHandler] = None, retry_poll_seconds: float = 1.0):
+        self.queue = queue
+        self.provider = provider
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.on_invalid_token = on_invalid_token
+        self.retry_poll_seconds = retry_poll_seconds
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"queued": 0, "batches": 0, "sent": 0, "retried": 0, "dead_lettered": 0,
+                      "invalid_tokens": 0, "provider_errors": 0}
+        self._provider_seconds = 0.0
+
+    async def start(self):
+        if self._tasks:
+            return
+        await self.queue.start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._promote()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.queue.stop()
+
+    async def enqueue(self, messages: List[Dict]):
+        for start in range(0, len(messages), self.batch_size):
+            await self.queue.put(messages[start:start + self.batch_size])
+        self.stats["queued"] += len(messages)
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """Delay before retry number `attempt` (1-based): doubling, capped, with full jitter above half"""
+        delay = min(PUSH_BACKOFF_MAX_SECONDS, PUSH_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self):
+        while True:
+            try:
+                batch = await self.queue.get_batch(self.batch_size, timeout=1.0)
+                if batch:
+                    await self.deliver(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Push worker failed: {e}")
+                await asyncio.sleep(1)
+
+    async def _promote(self):
+        while True:
+            try:
+                await asyncio.sleep(self.retry_poll_seconds)
+                await self.queue.promote_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Push retry promotion failed: {e}")
+
+    async def deliver(self, batch: List[Dict]):
+        """Send one batch and settle every message in it"""
+        started = time.perf_counter()
+        try:
+            outcomes = await self.provider.send(batch)
+        except Exception as e:
+            logger.error(f"Push provider call failed: {e}")
+            self.stats["provider_errors"] += 1
+            outcomes = [PUSH_RETRY] * len(batch)
+        self._provider_seconds += time.perf_counter() - started
+        self.stats["batches"] += 1
+
+        for message, outcome in zip(batch, outcomes):
+            if outcome == PUSH_OK:
+                self.stats["sent"] += 1
+            elif outcome == PUSH_INVALID_TOKEN:
+                self.stats["invalid_tokens"] += 1
+                if self.on_invalid_token:
+                    await self.on_invalid_token(message["user_id"], message["token"])
+            elif outcome == PUSH_RETRY and message["attempt"] + 1 < self.max_attempts:
+                message["attempt"] += 1
+                self.stats["retried"] += 1
+                await self.queue.retry(message, self.backoff(message["attempt"]))
+            else:
+                self.stats["dead_lettered"] += 1
+                await self.queue.dead_letter(message, outcome)
+        await self.queue.ack(batch)
+
+    async def get_stats(self) -> Dict:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "provider": self.provider.__class__.__name__,
+            "avg_provider_call_ms": round(self._provider_seconds / batches * 1000, 1) if batches else 0.0,
+            "queue": await self.queue.get_stats()
+        }
+
+def create_push_pool(on_invalid_token: Optional[InvalidTokenHandler] = None) -> PushWorkerPool:
+    """Build the queue and provider selected by PUSH_QUEUE_BACKEND and PUSH_PROVIDER"""
+    queue = RedisPushQueue() if PUSH_QUEUE_BACKEND == "redis" else InMemoryPushQueue()
+    provider = HttpStubPushProvider() if PUSH_PROVIDER == "http_stub" else LogPushProvider()
+    return PushWorkerPool(queue, provider, on_invalid_token=on_invalid_token)
@@ -0,0 +1,116 @@
+import os
+import time
+import uuid
+import logging
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+from app.services.frame_protocol import SharedFrame
+from app.services.send_queue import COALESCED_MESSAGE_TYPES
+
+logger = logging.getLogger(__name__)
+
+# Events kept per user for replay after a reconnect
+REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "200"))
+# How long a disconnected user's buffer is kept waiting for a resume (seconds)
+REPLAY_RETENTION_SECONDS = float(os.getenv("WS_REPLAY_RETENTION_SECONDS", "300"))
+
+# Transient messages that are superseded rather than replayed
+UNSEQUENCED_MESSAGE_TYPES = COALESCED_MESSAGE_TYPES | {"heartbeat", "session", "ride_status"}
+
+class ReplayLog:
+    """One user's event stream: a sequence counter and the most recent events"""
+    __slots__ = ("stream_id", "seq", "events")
+
+    def __init__(self, max_events: int = REPLAY_BUFFER_SIZE):
+        # A new stream id tells clients that old sequence numbers no longer apply
+        self.stream_id = uuid.uuid4().hex[:12]
+        self.seq = 0
+        # (seq, message) pairs; messages may be SharedFrames shared with other users
+        self.events: deque = deque(maxlen=max_events)
+
+    def record(self, message) -> int:
+        self.seq += 1
+        self.events.append((self.seq, message))
+        return self.seq
+
+    def since(self, last_seq: int) -> Optional[List[Tuple[int, object]]]:
+        """Events after last_seq, or None if some of them are no longer buffered"""
+        if last_seq > self.seq:
+            return None
+        oldest = self.events[0][0] if self.events else self.seq + 1
+        if last_seq + 1 < oldest:
+            return None
+        # Sequence numbers are contiguous, so the start index is computable
+        start = last_seq + 1 - oldest
+        return [self.events[i] for i in range(start, len(self.events))]
+
+class ReplayRegistry:
+    """Replay logs of connected and recently disconnected users"""
+
+    def __init__(self, max_events: int = REPLAY_BUFFER_SIZE, retention_seconds: float = REPLAY_RETENTION_SECONDS):
+        self.max_events = max_events
+        self.retention_seconds = retention_seconds
+        self.logs: Dict[str, ReplayLog] = {}
+        # user_id -> disconnect time, oldest first
+        self._detached: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = {"recorded": 0, "resumed": 0, "replayed": 0, "snapshots": 0, "expired": 0}
+
+    def attach(self, user_id: str) -> ReplayLog:
+        """Get (or start) the log of a connecting user"""
+        self._detached.pop(user_id, None)
+        log = self.logs.get(user_id)
+        if log is None:
+            log = ReplayLog(self.max_events)
+            self.logs[user_id] = log
+        self.prune()
+        return log
+
+    def detach(self, user_id: str):
+        """Keep a disconnected user's log for a while so a quick reconnect can resume"""
+        if user_id in self.logs:
+            self._detached.pop(user_id, None)
+            self._detached[user_id] = time.monotonic()
+        self.prune()
+
+    def prune(self, now: float = None):
+        """Drop logs of users that did not come back within the retention window"""
+        now = time.monotonic() if now is None else now
+        while self._detached:
+            user_id, detached_at = next(iter(self._detached.items()))
+            if now - detached_at < self.retention_seconds:
+                break
+            del self._detached[user_id]
+            self.logs.pop(user_id, None)
+            self.stats["expired"] += 1
+
+    def record(self, user_id: str, message) -> Optional[int]:
+        """Sequence an outgoing message; returns None for transient messages or unknown users"""
+        log = self.logs.get(user_id)
+        if log is None:
+            return None
+        message_type = message.message_type if isinstance(message, SharedFrame) else message.get("type")
+        if message_type in UNSEQUENCED_MESSAGE_TYPES:
+            return None
+        self.stats["recorded"] += 1
+        return log.record(message)
+
+    def resume(self, user_id: str, stream_id: Optional[str], last_seq: Optional[int]) -> Optional[List[Tuple[int, object]]]:
+        """Missed events for a reconnecting client, or None if it needs a snapshot"""
+        log = self.logs.get(user_id)
+        events = None
+        if log is not None and stream_id == log.stream_id and last_seq is not None:
+            events = log.since(last_seq)
+        if events is None:
+            self.stats["snapshots"] += 1
+            return None
+        self.stats["resumed"] += 1
+        self.stats["replayed"] += len(events)
+        return events
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "streams": len(self.logs),
+            "detached": len(self._detached),
+            "buffered_events": sum(len(log.events) for log in self.logs.values())
+        }
@@ -0,0 +1,176 @@
+import asyncio
+import os
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from app.database import SessionLocal
+from app.models.ride import Ride, RideRequest
+from app.services.notification_service import notification_service, NotificationType
+from app.services.outbox import record_ride_event, outbox_dispatcher
+from app.services.geofence_service import geofence_engine
+from app.services.websocket_service import manager
+
+logger = logging.getLogger(__name__)
+
+# How long past its scheduled time an available ride is kept before it is cancelled (minutes)
+RIDE_EXPIRY_GRACE_MINUTES = float(os.getenv("RIDE_EXPIRY_GRACE_MINUTES", "15"))
+# How often stale rides are swept (seconds)
+RIDE_EXPIRY_SWEEP_SECONDS = float(os.getenv("RIDE_EXPIRY_SWEEP_SECONDS", "60"))
+# Rides cancelled per transaction, and the pause between batches (milliseconds)
+RIDE_EXPIRY_BATCH_SIZE = int(os.getenv("RIDE_EXPIRY_BATCH_SIZE", "200"))
+RIDE_EXPIRY_PAUSE_MS = float(os.getenv("RIDE_EXPIRY_PAUSE_MS", "50"))
+
+class StaleRideSweeper:
+    """
+    Cancels rides still "available" after their scheduled time has passed.
+    Each batch claims the oldest stale rides with FOR UPDATE SKIP LOCKED
+    (served by the partial index on scheduled_time WHERE status = 'available'),
+    cancels them and their pending and accepted requests and records a
+    ride_expired event in one transaction; drivers and riders are then told
+    with one bulk notification each. Accepting a rider does not change the
+    ride's status, so rides with confirmed passengers are swept too. Batches
+    run in a worker thread so the sweep never blocks the event loop.
+    """
+
+    def __init__(self, grace_minutes: float = RIDE_EXPIRY_GRACE_MINUTES,
+                 sweep_seconds: float = RIDE_EXPIRY_SWEEP_SECONDS,
+                 batch_size: int = RIDE_EXPIRY_BATCH_SIZE, pause_ms: float = RIDE_EXPIRY_PAUSE_MS):
+        self.grace = timedelta(minutes=grace_minutes)
+        self.sweep_seconds = sweep_seconds
+        self.batch_size = batch_size
+        self.pause_seconds = pause_ms / 1000
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"sweeps": 0, "batches": 0, "rides_expired": 0, "requests_cancelled": 0,
+                      "notified": 0, "errors": 0}
+        self.last_sweep: Optional[Dict] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Stale ride sweep failed: {e}")
+            await asyncio.sleep(self.sweep_seconds)
+
+    async def sweep(self, now: Optional[datetime] = None) -> Dict:
+        """Cancel every stale available ride, batch by batch; returns what was done"""
+        started = time.perf_counter()
+        cutoff = (now or datetime.now(timezone.utc)) - self.grace
+        report = {"rides_expired": 0, "requests_cancelled": 0, "batches": 0}
+        while True:
+            expired = await asyncio.to_thread(self._expire_batch, cutoff)
+            if not expired:
+                break
+            outbox_dispatcher.wake()
+            report["batches"] += 1
+            report["rides_expired"] += len(expired)
+            report["requests_cancelled"] += sum(len(riders) for _, _, riders in expired)
+            for ride_id, driver_id, _ in expired:
+                geofence_engine.remove_ride(driver_id, ride_id)
+                manager.ride_rooms.close_room(ride_id)
+                await manager.publish_ride_change(ride_id, "closed", driver_id)
+            await self._notify(expired)
+            if len(expired) < self.batch_size:
+                break
+            await asyncio.sleep(self.pause_seconds)
+
+        self.stats["sweeps"] += 1
+        for key in ("batches", "rides_expired", "requests_cancelled"):
+            self.stats[key] += report[key]
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.last_sweep = {**report, "cutoff": cutoff.isoformat()}
+        if report["rides_expired"]:
+            logger.info(f"Expired {report['rides_expired']} stale rides and "
+                        f"{report['requests_cancelled']} ride requests in {report['batches']} batches")
+        return report
+
+    def _expire_batch(self, cutoff: datetime) -> List:
+        """Cancel one batch; returns (ride_id, driver_id, rider_ids) per ride"""
+        db = SessionLocal()
+        try:
+            rides = db.query(Ride).filter(
+                Ride.status == "available",
+                Ride.scheduled_time < cutoff
+            ).order_by(Ride.scheduled_time).limit(self.batch_size).with_for_update(skip_locked=True).all()
+            if not rides:
+                db.rollback()
+                return []
+
+            ride_ids = [ride.id for ride in rides]
+            # Accepted riders lose their seat too, so they are cancelled and told like pending ones
+            open_requests = RideRequest.status.in_(["pending", "accepted"])
+            riders: Dict[str, List[str]] = {ride_id: [] for ride_id in ride_ids}
+            for request in db.query(RideRequest.ride_id, RideRequest.user_id).filter(
+                RideRequest.ride_id.in_(ride_ids), open_requests
+            ).all():
+                riders[request.ride_id].append(request.user_id)
+            db.query(RideRequest).filter(
+                RideRequest.ride_id.in_(ride_ids), open_requests
+            ).update({RideRequest.status: "cancelled"}, synchronize_session=False)
+
+            expired = []
+            for ride in rides:
+                ride.status = "cancelled"
+                # Notifications go out in bulk below, so the event itself only updates live views
+                record_ride_event(db, ride, "ride_expired", [ride.driver_id, *riders[ride.id]], {
+                    "reason": "scheduled_time_passed",
+                    "scheduled_time": ride.scheduled_time.isoformat()
+                })
+                expired.append((ride.id, ride.driver_id, riders[ride.id]))
+            db.commit()
+            return expired
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _notify(self, expired: List):
+        """One bulk notification for the drivers and one for the riders of a batch"""
+        driver_rides: Dict[str, List[str]] = {}
+        rider_rides: Dict[str, List[str]] = {}
+        for ride_id, driver_id, rider_ids in expired:
+            driver_rides.setdefault(driver_id, []).append(ride_id)
+            for rider_id in rider_ids:
+                rider_rides.setdefault(rider_id, []).append(ride_id)
+
+        for user_rides, message in (
+            (driver_rides, "Your ride was cancelled because its scheduled time passed before it started"),
+            (rider_rides, "A ride you requested was cancelled because its scheduled time passed")
+        ):
+            if not user_rides:
+                continue
+            try:
+                report = await notification_service.send_bulk_notifications(
+                    list(user_rides), NotificationType.RIDE_CANCELLED, "Ride Cancelled", message,
+                    data={"reason": "scheduled_time_passed"},
+                    data_by_user={user_id: {"ride_ids": ride_ids} for user_id, ride_ids in user_rides.items()}
+                )
+                self.stats["notified"] += report["stored"]
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Failed to notify users of expired rides: {e}")
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "grace_minutes": self.grace.total_seconds() / 60,
+            "batch_size": self.batch_size,
+            "last_sweep": self.last_sweep
+        }
+
+# Global instance
+stale_ride_sweeper = StaleRideSweeper()
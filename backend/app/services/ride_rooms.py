@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+from app.services.frame_protocol import SharedFrame
+
+logger = logging.getLogger(__name__)
+
+# Minimum gap between driver location pushes to a ride's riders (milliseconds)
+RIDE_ROOM_THROTTLE_MS = int(os.getenv("RIDE_ROOM_THROTTLE_MS", "1000"))
+# How long a "driver has no active ride" lookup is trusted (seconds)
+RIDE_ROOM_MISS_TTL = float(os.getenv("RIDE_ROOM_MISS_TTL", "30"))
+# Most "no active ride" lookups cached at once; the oldest are dropped first
+RIDE_ROOM_MAX_MISSES = 10000
+
+# Fields of a driver location forwarded to riders
+DRIVER_LOCATION_FIELDS = ("latitude", "longitude", "speed", "heading")
+
+SendFunction = Callable[[SharedFrame, str], Awaitable[None]]
+
+class RideRoom:
+    """Participants of one active ride and its pending driver location"""
+
+    def __init__(self, ride_id: str, driver_id: str, rider_ids: Iterable[str] = ()):
+        self.ride_id = ride_id
+        self.driver_id = driver_id
+        self.rider_ids: Set[str] = set(rider_ids)
+        self.last_sent = 0.0
+        # Latest location not yet pushed (conflated latest-wins)
+        self.pending: Optional[Dict] = None
+        self.flush_task: Optional[asyncio.Task] = None
+
+class RideRoomRegistry:
+    """Map rides to their connected participants and push driver locations to riders"""
+
+    def __init__(self, send: SendFunction, throttle_ms: int = RIDE_ROOM_THROTTLE_MS):
+        self.send = send
+        self.throttle_seconds = throttle_ms / 1000
+        self.rooms: Dict[str, RideRoom] = {}
+        self.driver_rooms: Dict[str, str] = {}
+        # driver_id -> monotonic time until which "no room" is cached, oldest first
+        self._misses: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = {"received": 0, "pushed": 0, "conflated": 0}
+
+    def open_room(self, ride_id: str, driver_id: str, rider_ids: Iterable[str]) -> RideRoom:
+        """Create or refresh the room of a ride"""
+        room = self.rooms.get(ride_id)
+        if room is None:
+            room = RideRoom(ride_id, driver_id, rider_ids)
+            self.rooms[ride_id] = room
+        else:
+            room.rider_ids = set(rider_ids)
+        self.driver_rooms[driver_id] = ride_id
+        self._misses.pop(driver_id, None)
+        return room
+
+    def close_room(self, ride_id: str):
+        """Drop a finished or cancelled ride's room"""
+        room = self.rooms.pop(ride_id, None)
+        if room is None:
+            return
+        if room.flush_task:
+            room.flush_task.cancel()
+        if self.driver_rooms.get(room.driver_id) == ride_id:
+            del self.driver_rooms[room.driver_id]
+
+    def add_rider(self, ride_id: str, rider_id: str):
+        room = self.rooms.get(ride_id)
+        if room:
+            room.rider_ids.add(rider_id)
+
+    def remove_rider(self, ride_id: str, rider_id: str):
+        room = self.rooms.get(ride_id)
+        if room:
+            room.rider_ids.discard(rider_id)
+
+    def room_for_driver(self, driver_id: str) -> Optional[RideRoom]:
+        ride_id = self.driver_rooms.get(driver_id)
+        return self.rooms.get(ride_id) if ride_id else None
+
+    def is_known_miss(self, driver_id: str, now: float = None) -> bool:
+        """True if the driver was recently found to have no active ride"""
+        now = time.monotonic() if now is None else now
+        expires = self._misses.get(driver_id)
+        if expires is None:
+            return False
+        if expires <= now:
+            del self._misses[driver_id]
+            return False
+        return True
+
+    def record_miss(self, driver_id: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        self._misses[driver_id] = now + RIDE_ROOM_MISS_TTL
+        self._misses.move_to_end(driver_id)
+        while len(self._misses) > RIDE_ROOM_MAX_MISSES:
+            self._misses.popitem(last=False)
+
+    def forget_driver(self, driver_id: str):
+        """Look the driver's ride up again on the next location"""
+        self._misses.pop(driver_id, None)
+
+    async def publish_driver_location(self, room: RideRoom, location_data: Dict):
+        """Push a driver location to the room's riders, at most once per throttle window"""
+        self.stats["received"] += 1
+        if room.pending is not None:
+            self.stats["conflated"] += 1
+        room.pending = {key: location_data.get(key) for key in DRIVER_LOCATION_FIELDS}
+
+        wait = room.last_sent + self.throttle_seconds - time.monotonic()
+        if wait <= 0:
+            await self._flush(room)
+        elif room.flush_task is None:
+            room.flush_task = asyncio.create_task(self._flush_later(room, wait))
+
+    async def _flush_later(self, room: RideRoom, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            room.flush_task = None
+            await self._flush(room)
+        except asyncio.CancelledError:
+            pass
+
+    async def _flush(self, room: RideRoom):
+        location = room.pending
+        if location is None or self.rooms.get(room.ride_id) is not room:
+            return
+        room.pending = None
+        room.last_sent = time.monotonic()
+
+        frame = SharedFrame({
+            "type": "driver_location",
+            "data": {"ride_id": room.ride_id, "driver_id": room.driver_id, **location},
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        })
+        for rider_id in list(room.rider_ids):
+            await self.send(frame, rider_id)
+        self.stats["pushed"] += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "rooms": len(self.rooms),
+            "cached_misses": len(self._misses),
+            "riders": sum(len(room.rider_ids) for room in self.rooms.values())
+        }
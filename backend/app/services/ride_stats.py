@@ -0,0 +1,87 @@
+import logging
+from typing import Dict, List
+from sqlalchemy import bindparam, func, update
+from sqlalchemy.orm import Session
+from app.models.ride import Ride, RideRequest
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+# Users written per UPDATE round trip during a backfill
+BACKFILL_BATCH_SIZE = 1000
+
+def record_ride_completed(db: Session, driver_id: str, passenger_ids: List[str]):
+    """Count a completed ride for its driver and every passenger, in the caller's transaction"""
+    user_ids = list(dict.fromkeys([driver_id, *passenger_ids]))
+    # Incremented in SQL, so concurrent completions never lose an update
+    db.query(User).filter(User.id.in_(user_ids)).update(
+        {User.total_rides: func.coalesce(User.total_rides, 0) + 1}, synchronize_session=False
+    )
+
+def record_driver_rating(db: Session, driver_id: str, rating: float):
+    """Add a rating to the driver's running sum and count, and the average derived from them"""
+    # SET expressions see the row's old values, so the average uses the new sum over the new count
+    db.query(User).filter(User.id == driver_id).update({
+        User.rating_sum: User.rating_sum + rating,
+        User.rating_count: User.rating_count + 1,
+        User.rating: (User.rating_sum + rating) / (User.rating_count + 1)
+    }, synchronize_session=False)
+
+def backfill_ride_stats(db: Session, batch_size: int = BACKFILL_BATCH_SIZE) -> Dict:
+    """Recompute every user's rating and ride aggregates from ride history"""
+    ratings = {row.driver_id: (row.rating_sum, row.rating_count) for row in db.query(
+        Ride.driver_id,
+        func.sum(Ride.ride_rating).label("rating_sum"),
+        func.count(Ride.ride_rating).label("rating_count")
+    ).filter(Ride.status == "completed", Ride.ride_rating.isnot(None)).group_by(Ride.driver_id)}
+
+    rides: Dict[str, int] = {row.driver_id: row.count for row in db.query(
+        Ride.driver_id, func.count(Ride.id).label("count")
+    ).filter(Ride.status == "completed").group_by(Ride.driver_id)}
+    for row in db.query(RideRequest.user_id, func.count(RideRequest.id).label("count")).join(
+        Ride, Ride.id == RideRequest.ride_id
+    ).filter(
+        Ride.status == "completed",
+        RideRequest.status == "accepted",
+        # A driver riding their own ride is already counted above
+        RideRequest.user_id != Ride.driver_id
+    ).group_by(RideRequest.user_id):
+        rides[row.user_id] = rides.get(row.user_id, 0) + row.count
+
+    statement = update(User).where(User.id == bindparam("user_id")).values(
+        rating_sum=bindparam("rating_sum"),
+        rating_count=bindparam("rating_count"),
+        rating=bindparam("rating"),
+        total_rides=bindparam("total_rides")
+    )
+    user_ids = [row.id for row in db.query(User.id).order_by(User.id)]
+    for start in range(0, len(user_ids), batch_size):
+        rows = []
+        for user_id in user_ids[start:start + batch_size]:
+            rating_sum, rating_count = ratings.get(user_id, (0.0, 0))
+            rows.append({
+                "user_id": user_id,
+                "rating_sum": float(rating_sum or 0.0),
+                "rating_count": rating_count,
+                "rating": float(rating_sum) / rating_count if rating_count else 0.0,
+                "total_rides": rides.get(user_id, 0)
+            })
+        db.connection().execute(statement, rows)
+        db.commit()
+
+    report = {"users": len(user_ids), "rated_drivers": len(ratings),
+              "users_with_rides": len(rides), "ratings": sum(count for _, count in ratings.values())}
+    logger.info(f"Ride stats backfilled: {report}")
+    return report
+
+if __name__ == "__main__":
+    # Usage (from backend/): python -m app.services.ride_stats
+    from app.database import SessionLocal
+    import app.models  # noqa: F401 - registers every mapper
+
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        print(backfill_ride_stats(db))
+    finally:
+        db.close()
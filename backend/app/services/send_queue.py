@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+import time
+import logging
+from collections import deque
+from typing import Callable, Dict, Optional
+from fastapi import WebSocket
+from app.services.frame_protocol import FrameCodec, SharedFrame, sequenced_text
+
+logger = logging.getLogger(__name__)
+
+# Outbound queue bounds per connection
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Disconnect clients whose oldest queued message is older than this (seconds)
+MAX_SEND_LAG_SECONDS = float(os.getenv("WS_MAX_SEND_LAG_SECONDS", "15"))
+# Report clients as lagging once their oldest queued message is older than this
+LAGGING_THRESHOLD_SECONDS = float(os.getenv("WS_LAGGING_THRESHOLD_SECONDS", "2"))
+
+# Close code sent to clients that fall too far behind
+SLOW_CONSUMER_CLOSE_CODE = 1013  # Try Again Later
+
+# Message types where only the latest queued message matters
+COALESCED_MESSAGE_TYPES = {
+    "ping_interval", "location_update", "location_updated", "driver_status_updated", "driver_location"
+}
+
+class ConnectionSender:
+    """Bounded outbound queue for one WebSocket, drained by its own writer task"""
+
+    def __init__(self, user_id: str, websocket: WebSocket, codec: Optional[FrameCodec],
+                 on_failure: Callable[[str, "ConnectionSender"], None],
+                 max_queue: int = SEND_QUEUE_SIZE, max_lag_seconds: float = MAX_SEND_LAG_SECONDS):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        self.on_failure = on_failure
+        self.max_queue = max_queue
+        self.max_lag_seconds = max_lag_seconds
+
+        # Entries are [message_type, message, enqueued_at, seq]
+        self.queue: deque = deque()
+        # message_type -> queued entry, for coalescing
+        self._coalesce: Dict[str, list] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.failure_reason: Optional[str] = None
+
+        self.stats = {"enqueued": 0, "sent": 0, "dropped": 0, "coalesced": 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message, seq: Optional[int] = None) -> bool:
+        """Queue a message (dict or SharedFrame) without awaiting network I/O"""
+        if self.closed:
+            return False
+
+        now = time.monotonic()
+        if self.lag(now) > self.max_lag_seconds:
+            self._fail("slow consumer", close_code=SLOW_CONSUMER_CLOSE_CODE)
+            return False
+
+        message_type = message.message_type if isinstance(message, SharedFrame) else message.get("type")
+        self.stats["enqueued"] += 1
+
+        # Latest-wins: replace the queued message in place, keeping its slot
+        if message_type in COALESCED_MESSAGE_TYPES:
+            entry = self._coalesce.get(message_type)
+            if entry is not None:
+                entry[1] = message
+                self.stats["coalesced"] += 1
+                return True
+
+        entry = [message_type, message, now, seq]
+        self.queue.append(entry)
+        if message_type in COALESCED_MESSAGE_TYPES:
+            self._coalesce[message_type] = entry
+
+        # Drop the oldest message once the queue is full
+        while len(self.queue) > self.max_queue:
+            dropped = self.queue.popleft()
+            if self._coalesce.get(dropped[0]) is dropped:
+                del self._coalesce[dropped[0]]
+            self.stats["dropped"] += 1
+
+        self._wakeup.set()
+        return True
+
+    def lag(self, now: float = None) -> float:
+        """Age in seconds of the oldest queued message"""
+        if not self.queue:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return now - self.queue[0][2]
+
+    def close(self):
+        """Stop the writer task and discard queued messages"""
+        self.closed = True
+        self.queue.clear()
+        self._coalesce.clear()
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._wakeup.set()
+
+    async def _writer(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                entry = self.queue.popleft()
+                if self._coalesce.get(entry[0]) is entry:
+                    del self._coalesce[entry[0]]
+
+                message, seq = entry[1], entry[3]
+                try:
+                    if self.codec:
+                        await self.websocket.send_bytes(self.codec.encode(message, seq))
+                    else:
+                        text = message.text() if isinstance(message, SharedFrame) else json.dumps(message)
+                        if seq is not None:
+                            text = sequenced_text(text, seq)
+                        await self.websocket.send_text(text)
+                except Exception as e:
+                    logger.error(f"Failed to send message to user {self.user_id}: {e}")
+                    self._fail("send failed")
+                    return
+                self.stats["sent"] += 1
+        except asyncio.CancelledError:
+            pass
+
+    def _fail(self, reason: str, close_code: Optional[int] = None):
+        if self.closed:
+            return
+        self.failure_reason = reason
+        logger.warning(f"Dropping WebSocket of user {self.user_id}: {reason} "
+                       f"(queued={len(self.queue)}, lag={self.lag():.1f}s)")
+        if close_code is not None:
+            asyncio.create_task(self._close_socket(close_code))
+        self.on_failure(self.user_id, self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
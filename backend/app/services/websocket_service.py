@@ -1,142 +1,728 @@
 import asyncio
 import json
 import logging
-from typing import Dict, Set, Optional, List, Any
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Set, Optional, List, Any, Tuple
 from fastapi import WebSocket, WebSocketDisconnect
 from datetime import datetime, timezone
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from app.database import get_database
+from app.database import get_database, SessionLocal
 from app.models.user import User
 from app.models.ride import Ride, RideRequest
+from app.services.location_service import LocationService
+from app.services.ping_rate import PingRateController
+from app.services.geofence_service import geofence_engine
+from app.services.frame_protocol import FrameCodec, FrameProtocolError, SharedFrame, BINARY_SUBPROTOCOL
+from app.services.send_queue import ConnectionSender, LAGGING_THRESHOLD_SECONDS
+from app.services.broker import (
+    Broker, create_broker, user_channel, company_channel, worker_channel, RIDES_CHANNEL, DISPATCH_CHANNEL
+)
+from app.services.ride_rooms import RideRoomRegistry, RideRoom
+from app.services.heartbeat import HeartbeatScheduler, IDLE_CLOSE_CODE
+from app.services.replay_buffer import ReplayRegistry, ReplayLog
+from app.services.pending_rides import PendingRideStore, PendingRideLimitError
+from app.services.presence import PresenceRecord
+from app.services.driver_presence import DriverPresenceService, create_driver_presence
+from app.services.dispatch import DispatchEngine
 
 logger = logging.getLogger(__name__)
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, broker: Broker = None):
         # Store active connections by user_id
         self.active_connections: Dict[str, WebSocket] = {}
-        # Store user's current location
-        self.user_locations: Dict[str, Dict] = {}
-        # Store ride requests waiting for matches
-        self.pending_rides: Dict[str, Dict] = {}
+        # Parsed presence (company, driver flags, position) of users who sent a location
+        self.user_locations: Dict[str, PresenceRecord] = {}
+        # Ride requests waiting for a driver, expired after a TTL
+        self.pending_rides = PendingRideStore()
+        # Driver availability and positions with a heartbeat TTL, queryable over REST
+        self.driver_presence: DriverPresenceService = create_driver_presence()
+        # Offers ride requests to the nearest drivers in expanding waves
+        self.dispatch = DispatchEngine(self.driver_presence, self.send_personal_message,
+                                       on_finish=self._on_dispatch_finished)
+        # ride_id -> (worker running its dispatch, monotonic expiry), oldest first
+        self.remote_dispatch: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # Server-recommended location ping intervals and throttling
+        self.ping_rate = PingRateController()
+        # Binary frame codecs for connections that negotiated the binary subprotocol
+        self.codecs: Dict[str, FrameCodec] = {}
+        # Company and driver flag from the users table, loaded on connect
+        self.user_profiles: Dict[str, Dict] = {}
+        # Secondary indexes over connected users
+        self.company_members: Dict[str, Set[str]] = {}
+        self.company_available_drivers: Dict[str, Set[str]] = {}
+        # user_id -> (company_id, is_available_driver) as currently indexed
+        self._indexed: Dict[str, tuple] = {}
+        # Per-connection outbound queues, each drained by its own writer task
+        self.senders: Dict[str, ConnectionSender] = {}
+        self.sender_failures: Dict[str, int] = {}
+        # Cross-worker fan-out; each worker only delivers to its own sockets
+        self.broker = broker or create_broker()
+        self.broker.set_handler(self._on_broker_message)
+        self.broker.subscribe(RIDES_CHANNEL)
+        self.broker.subscribe(DISPATCH_CHANNEL)
+        self.broker.subscribe(worker_channel(self.broker.worker_id))
+        # Per-ride rooms: driver location goes only to that ride's confirmed riders
+        self.ride_rooms = RideRoomRegistry(self.send_personal_message)
+        # Pings quiet connections and reaps the ones that never answer
+        self.heartbeats = HeartbeatScheduler(self.send_heartbeat, self.reap_connection)
+        # Sequenced per-user event streams for resuming after a reconnect
+        self.replay = ReplayRegistry()
         
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+    async def start_broker(self):
+        await self.broker.start()
+        
+    async def stop_broker(self):
+        await self.broker.stop()
+        
+    def start_heartbeats(self):
+        self.heartbeats.start()
+        
+    def stop_heartbeats(self):
+        self.heartbeats.stop()
+        
+    def start_pending_ride_expiry(self):
+        self.pending_rides.start(self.notify_ride_request_expired)
+        
+    def stop_pending_ride_expiry(self):
+        self.pending_rides.stop()
+        
+    async def connect(self, websocket: WebSocket, user_id: str, subprotocol: Optional[str] = None,
+                      stream_id: Optional[str] = None, last_seq: Optional[int] = None):
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[user_id] = websocket
-        logger.info(f"User {user_id} connected to WebSocket")
+        if subprotocol == BINARY_SUBPROTOCOL:
+            self.codecs[user_id] = FrameCodec()
+        else:
+            self.codecs.pop(user_id, None)
         
-        # Send current ride status if user has active rides
-        await self.send_ride_status(user_id)
+        # A reconnect replaces the previous connection's writer
+        previous_sender = self.senders.pop(user_id, None)
+        if previous_sender:
+            previous_sender.close()
+        sender = ConnectionSender(user_id, websocket, self.codecs.get(user_id), self._on_sender_failure)
+        sender.start()
+        self.senders[user_id] = sender
+        self.broker.subscribe(user_channel(user_id))
+        self.heartbeats.track(user_id)
+        logger.info(f"User {user_id} connected to WebSocket ({subprotocol or 'json'})")
         
-    def disconnect(self, user_id: str):
+        profile = self.load_user_profile(user_id)
+        if profile:
+            self.user_profiles[user_id] = profile
+        self.reindex_user(user_id)
+        
+        # Tell the client how often to send location updates
+        await self.send_ping_interval(user_id)
+        
+        # Replay what a reconnecting client missed, or fall back to a snapshot
+        log = self.replay.attach(user_id)
+        missed = self.replay.resume(user_id, stream_id, last_seq)
+        await self.send_personal_message({
+            "type": "session",
+            "data": {"stream_id": log.stream_id, "seq": log.seq, "resumed": missed is not None},
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }, user_id)
+        if missed is None:
+            await self.send_ride_status(user_id, log)
+        else:
+            for seq, message in missed:
+                sender.enqueue(message, seq)
+        
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        # A stale socket's disconnect must not tear down the user's newer connection
+        if websocket is not None and self.active_connections.get(user_id) is not websocket:
+            return
         if user_id in self.active_connections:
             del self.active_connections[user_id]
         if user_id in self.user_locations:
             del self.user_locations[user_id]
+        self.ping_rate.forget(user_id)
+        self.codecs.pop(user_id, None)
+        sender = self.senders.pop(user_id, None)
+        if sender:
+            sender.close()
+            self.broker.unsubscribe(user_channel(user_id))
+        self.user_profiles.pop(user_id, None)
+        self.heartbeats.forget(user_id)
+        self.replay.detach(user_id)
+        self.reindex_user(user_id)
         logger.info(f"User {user_id} disconnected from WebSocket")
         
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
+    def load_user_profile(self, user_id: str) -> Optional[Dict]:
+        """Load the company and driver flag of a connecting user"""
+        try:
+            db = SessionLocal()
             try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
-            except Exception as e:
-                logger.error(f"Failed to send message to user {user_id}: {e}")
-                self.disconnect(user_id)
+                user = db.query(User.company_id, User.is_driver).filter(User.id == user_id).first()
+            finally:
+                db.close()
+        except Exception as e:
+            logger.warning(f"Could not load profile for user {user_id}: {e}")
+            return None
+        
+        if not user:
+            return None
+        return {"company_id": user.company_id, "is_driver": bool(user.is_driver)}
+        
+    def reindex_user(self, user_id: str):
+        """Bring the company and available-driver indexes in line with a user's state"""
+        previous = self._indexed.pop(user_id, None)
+        if previous:
+            company_id, was_available_driver = previous
+            self._discard(self.company_members, company_id, user_id)
+            if was_available_driver:
+                self._discard(self.company_available_drivers, company_id, user_id)
+            if company_id not in self.company_members:
+                self.broker.unsubscribe(company_channel(company_id))
+        
+        if user_id not in self.active_connections:
+            return
+        
+        # The users table is authoritative; location data fills in for unknown users
+        location = self.user_locations.get(user_id)
+        profile = self.user_profiles.get(user_id, {})
+        company_id = profile.get("company_id") or (location.company_id if location else None)
+        if not company_id:
+            return
+        
+        is_driver = profile["is_driver"] if "is_driver" in profile else bool(location and location.is_driver)
+        is_available_driver = is_driver and bool(location and location.is_available)
+        
+        if company_id not in self.company_members:
+            self.broker.subscribe(company_channel(company_id))
+        self.company_members.setdefault(company_id, set()).add(user_id)
+        if is_available_driver:
+            self.company_available_drivers.setdefault(company_id, set()).add(user_id)
+        self._indexed[user_id] = (company_id, is_available_driver)
+        
+    @staticmethod
+    def _discard(index: Dict[str, Set[str]], key: str, user_id: str):
+        members = index.get(key)
+        if members is not None:
+            members.discard(user_id)
+            if not members:
+                del index[key]
+                
+    async def set_driver_availability(self, user_id: str, is_available: bool) -> bool:
+        """Update a driver's availability. Returns False if the user has no location yet"""
+        location = self.user_locations.get(user_id)
+        if location is None:
+            return False
+        location.is_available = bool(is_available)
+        self.reindex_user(user_id)
+        await self.driver_presence.set_available(user_id, location.is_available)
+        return True
+        
+    async def send_personal_message(self, message, user_id: str) -> bool:
+        """
+        Queue a message (dict or SharedFrame) for a user; the connection's writer task does the network I/O.
+        True if it was queued on a socket of this worker, False if it was only published to the broker.
+        """
+        # Users who just dropped keep buffering so a quick reconnect can resume
+        seq = self.replay.record(user_id, message)
+        sender = self.senders.get(user_id)
+        if sender:
+            sender.enqueue(message, seq)
+            return True
+        # The user may be connected to another worker
+        if isinstance(message, SharedFrame):
+            message = message.message
+        await self.broker.publish(user_channel(user_id), self.broker.wrap("user", user_id, message))
+        return False
+            
+    def _deliver_local(self, message: dict, user_ids):
+        """Queue a message for users connected to this worker"""
+        # Encoded once on first send, then reused by every recipient's writer
+        frame = SharedFrame(message)
+        for user_id in list(user_ids):
+            sender = self.senders.get(user_id)
+            if sender:
+                sender.enqueue(frame, self.replay.record(user_id, frame))
+                
+    async def _on_broker_message(self, channel: str, envelope: Dict):
+        """Deliver a message published by any worker to the local sockets it targets"""
+        if envelope.get("origin") == self.broker.worker_id:
+            return  # Already delivered locally before publishing
+        
+        kind = envelope.get("kind")
+        target = envelope.get("target")
+        message = envelope.get("message", {})
+        if kind == "user":
+            self._deliver_local(message, (target,))
+        elif kind == "company":
+            self._deliver_local(message, self.company_members.get(target, ()))
+        elif kind == "company_drivers":
+            self._deliver_local(message, self.company_available_drivers.get(target, ()))
+        elif kind == "ride":
+            self.apply_ride_change(target, message)
+        elif kind == "dispatch_started":
+            self._track_remote_dispatch(target, envelope.get("origin"))
+        elif kind == "dispatch_finished":
+            self.remote_dispatch.pop(target, None)
+        elif kind == "ride_response":
+            await self.handle_ride_response(target, message, forwarded=True)
+            
+    def _track_remote_dispatch(self, ride_id: str, worker_id: str, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.remote_dispatch[ride_id] = (worker_id, now + self.pending_rides.ttl_seconds)
+        self.remote_dispatch.move_to_end(ride_id)
+        # Entries share one TTL, so the expired ones are at the front
+        while self.remote_dispatch and next(iter(self.remote_dispatch.values()))[1] <= now:
+            self.remote_dispatch.popitem(last=False)
+            
+    async def _on_dispatch_finished(self, ride_id: str):
+        await self.broker.publish(DISPATCH_CHANNEL, self.broker.wrap("dispatch_finished", ride_id, {}))
+            
+    async def publish_ride_change(self, ride_id: str, op: str, driver_id: str,
+                                  rider_id: Optional[str] = None, rider_ids: Optional[List[str]] = None):
+        """Tell the other workers about a ride change already applied on this one"""
+        change = {"op": op, "driver_id": driver_id}
+        if rider_id is not None:
+            change["rider_id"] = rider_id
+        if rider_ids is not None:
+            change["rider_ids"] = list(rider_ids)
+        await self.broker.publish(RIDES_CHANNEL, self.broker.wrap("ride", ride_id, change))
+        
+    def apply_ride_change(self, ride_id: str, change: Dict):
+        """Bring this worker's cached room and fences of a ride up to date"""
+        op = change.get("op")
+        driver_id = change.get("driver_id")
+        rider_id = change.get("rider_id")
+        if op == "rider_added":
+            self.ride_rooms.add_rider(ride_id, rider_id)
+            geofence_engine.add_rider(driver_id, ride_id, rider_id)
+            # The driver may have an active ride now; look it up on the next location
+            geofence_engine.forget_driver(driver_id)
+        elif op == "rider_removed":
+            self.ride_rooms.remove_rider(ride_id, rider_id)
+            geofence_engine.remove_rider(driver_id, ride_id, rider_id)
+        elif op == "started":
+            rider_ids = change.get("rider_ids") or []
+            if ride_id in self.ride_rooms.rooms:
+                self.ride_rooms.open_room(ride_id, driver_id, rider_ids)
+            else:
+                self.ride_rooms.forget_driver(driver_id)
+            if not geofence_engine.update_ride(driver_id, ride_id, "in_progress", rider_ids):
+                # Fences of another ride, or none: rebuild from the ride being driven
+                geofence_engine.remove_ride(driver_id)
+                geofence_engine.forget_driver(driver_id)
+        elif op == "picked_up":
+            geofence_engine.mark_picked_up(driver_id, ride_id)
+        elif op == "closed":
+            self.ride_rooms.close_room(ride_id)
+            geofence_engine.remove_ride(driver_id, ride_id)
+            
+    def _on_sender_failure(self, user_id: str, sender: ConnectionSender):
+        """Called by a writer whose send failed or whose client fell too far behind"""
+        reason = sender.failure_reason or "unknown"
+        self.sender_failures[reason] = self.sender_failures.get(reason, 0) + 1
+        if self.senders.get(user_id) is sender:
+            self.disconnect(user_id)
+            
+    def get_send_queue_stats(self) -> Dict:
+        """Outbound queue depth, drops and lagging clients"""
+        now = time.monotonic()
+        lagging = {}
+        totals = {"queued": 0, "enqueued": 0, "sent": 0, "dropped": 0, "coalesced": 0}
+        for user_id, sender in self.senders.items():
+            totals["queued"] += len(sender.queue)
+            for key, value in sender.stats.items():
+                totals[key] += value
+            lag = sender.lag(now)
+            if lag >= LAGGING_THRESHOLD_SECONDS:
+                lagging[user_id] = {"lag_seconds": round(lag, 2), "queued": len(sender.queue)}
+        return {
+            **totals,
+            "disconnects": dict(self.sender_failures),
+            "lagging_clients": lagging
+        }
+                
+    async def receive_message(self, websocket: WebSocket, user_id: str) -> dict:
+        """Receive and decode one text (JSON) or binary frame"""
+        frame = await websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        # Any frame from the client proves the connection is alive
+        self.heartbeats.touch(user_id)
+        
+        if frame.get("bytes") is not None:
+            codec = self.codecs.get(user_id)
+            if codec is None:
+                raise FrameProtocolError("Binary frame received without the binary subprotocol")
+            return codec.decode(frame["bytes"])
+        return json.loads(frame["text"])
                 
     async def broadcast_ride_request(self, ride_request: dict, company_id: str):
-        """Broadcast ride request to all available drivers in the company"""
+        """Offer a ride request to the company's drivers, in waves when the pickup point is known"""
+        if ride_request.get("pickup_latitude") is not None and ride_request.get("pickup_longitude") is not None:
+            await self.handle_ride_request({**ride_request, "company_id": company_id})
+            return
+        
+        # Without a pickup point there is no "nearest": fall back to every available driver
         message = {
             "type": "ride_request",
             "data": ride_request,
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        # Send to all drivers in the company
-        for user_id, websocket in self.active_connections.items():
-            if user_id in self.user_locations:
-                user_info = self.user_locations[user_id]
-                if (user_info.get("company_id") == company_id and 
-                    user_info.get("is_driver") and 
-                    user_info.get("is_available")):
-                    await self.send_personal_message(message, user_id)
+        # Local drivers first, then every other worker's drivers via the broker
+        self._deliver_local(message, self.company_available_drivers.get(company_id, ()))
+        await self.broker.publish(
+            company_channel(company_id), self.broker.wrap("company_drivers", company_id, message)
+        )
                     
-    async def update_user_location(self, user_id: str, location_data: dict):
-        """Update user's current location"""
-        self.user_locations[user_id] = location_data
+    async def ingest_location_update(self, user_id: str, location_data: dict) -> bool:
+        """Store a location update unless the client is pinging faster than recommended"""
+        if not self.ping_rate.allow(user_id):
+            # Remind the client of its interval once per throttled burst
+            if self.ping_rate.needs_reminder(user_id):
+                await self.send_ping_interval(user_id, throttled=True)
+            return False
+        
+        try:
+            location = await self.update_user_location(user_id, location_data)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Ignoring malformed location update from user {user_id}: {e}")
+            return False
+        
+        # Detect arrivals at the pickup/drop-off of the driver's active ride
+        if user_id not in geofence_engine.driver_fences and self.is_driver(user_id, location):
+            self.load_ride_fences(user_id)
+        await geofence_engine.process_driver_location(user_id, location.latitude, location.longitude)
+        
+        await self.refresh_ping_interval(user_id, location.latitude, location.longitude, location.speed)
+        return True
+        
+    async def refresh_ping_interval(self, user_id: str, latitude: Optional[float], longitude: Optional[float],
+                                    speed_kmh: Optional[float] = None, ride_status: Optional[str] = None,
+                                    target: Optional[Dict] = None):
+        """Recompute a user's ping interval and push it if it changed"""
+        target = target or geofence_engine.next_target(user_id)
+        distance_km = None
+        if target:
+            ride_status = ride_status or target.get("status")
+            if latitude is not None and longitude is not None:
+                distance_km = LocationService.calculate_distance(
+                    latitude, longitude, target["latitude"], target["longitude"]
+                )
+        
+        try:
+            speed_kmh = float(speed_kmh) if speed_kmh is not None else None
+        except (TypeError, ValueError):
+            speed_kmh = None
+        
+        interval = self.ping_rate.record(user_id, latitude, longitude, speed_kmh, distance_km, ride_status)
+        if interval is not None:
+            await self.send_ping_interval(user_id)
+            
+    async def send_ping_interval(self, user_id: str, throttled: bool = False):
+        """Push the recommended location ping interval to a client"""
+        await self.send_personal_message({
+            "type": "ping_interval",
+            "data": {
+                "interval_seconds": self.ping_rate.get_interval(user_id),
+                "throttled": throttled
+            },
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }, user_id)
+        
+    async def update_user_location(self, user_id: str, location_data: dict) -> PresenceRecord:
+        """Parse a location update into the user's presence record (ValueError if malformed)"""
+        location = self.user_locations.get(user_id)
+        if location is None:
+            location = PresenceRecord()
+        # Parse before storing so a malformed first update leaves no record behind
+        changed = location.apply(location_data)
+        self.user_locations[user_id] = location
+        
+        # Only touch the indexes when an indexed field changed
+        if changed:
+            self.reindex_user(user_id)
+        
+        # Every driver location doubles as a presence heartbeat
+        profile = self.user_profiles.get(user_id, {})
+        company_id = profile.get("company_id") or location.company_id
+        if self.is_driver(user_id, location) and company_id and location.has_location:
+            await self.driver_presence.heartbeat(
+                user_id, company_id, location.latitude, location.longitude, bool(location.is_available)
+            )
         
         # Notify relevant users about location update
-        await self.notify_location_update(user_id, location_data)
+        await self.notify_location_update(user_id, location)
+        return location
+        
+    def is_driver(self, user_id: str, location: PresenceRecord) -> bool:
+        """The loaded profile decides; the client's own flag is the fallback"""
+        profile = self.user_profiles.get(user_id, {})
+        return profile["is_driver"] if "is_driver" in profile else bool(location.is_driver)
         
-    async def notify_location_update(self, user_id: str, location_data: dict):
+    async def notify_location_update(self, user_id: str, location: PresenceRecord):
         """Notify other users about location update (e.g., driver location for active rides)"""
-        if user_id in self.user_locations:
-            user_info = self.user_locations[user_id]
-            if user_info.get("is_driver"):
-                # Notify riders about driver location
-                await self.notify_riders_about_driver(user_id, location_data)
+        if location.has_location and (self.user_profiles.get(user_id, {}).get("is_driver") or location.is_driver):
+            # Notify riders about driver location
+            await self.notify_riders_about_driver(user_id, location.location())
                 
     async def notify_riders_about_driver(self, driver_id: str, location_data: dict):
         """Notify riders about their driver's location"""
-        # This would need to be implemented based on active ride relationships
-        pass
+        room = self.ride_rooms.room_for_driver(driver_id) or self.load_ride_room(driver_id)
+        if room:
+            await self.ride_rooms.publish_driver_location(room, location_data)
+            
+    def load_ride_room(self, driver_id: str) -> Optional[RideRoom]:
+        """Build the room of a driver's in-progress ride from its accepted requests"""
+        # Rooms opened by another worker's REST request are rebuilt here on first use
+        if self.ride_rooms.is_known_miss(driver_id):
+            return None
+        try:
+            db = SessionLocal()
+            try:
+                ride = db.query(Ride.id).filter(
+                    Ride.driver_id == driver_id,
+                    Ride.status == "in_progress"
+                ).first()
+                rider_ids = []
+                if ride:
+                    rider_ids = [request.user_id for request in db.query(RideRequest.user_id).filter(
+                        RideRequest.ride_id == ride.id,
+                        RideRequest.status == "accepted"
+                    ).all()]
+            finally:
+                db.close()
+        except Exception as e:
+            logger.warning(f"Could not load ride room for driver {driver_id}: {e}")
+            return None
         
-    async def send_ride_status(self, user_id: str):
-        """Send current ride status to user"""
-        # This would query the database for user's active rides
-        pass
+        if not ride:
+            self.ride_rooms.record_miss(driver_id)
+            return None
+        return self.ride_rooms.open_room(ride.id, driver_id, rider_ids)
         
-    async def handle_ride_request(self, ride_data: dict):
-        """Handle new ride request and find matches"""
+    def load_ride_fences(self, driver_id: str) -> bool:
+        """Rebuild the fences of a driver's active ride from the database"""
+        # Rides accepted through another worker's REST request, or before a restart
+        if geofence_engine.is_known_miss(driver_id):
+            return False
+        try:
+            db = SessionLocal()
+            try:
+                rides = db.query(
+                    Ride.id, Ride.status, Ride.pickup_time,
+                    Ride.pickup_latitude, Ride.pickup_longitude,
+                    Ride.destination_latitude, Ride.destination_longitude
+                ).filter(
+                    Ride.driver_id == driver_id,
+                    Ride.status.in_(["available", "confirmed", "in_progress"]),
+                    Ride.confirmed_passengers > 0
+                ).order_by(Ride.scheduled_time).all()
+                # The ride being driven wins over later confirmed ones
+                ride = next((row for row in rides if row.status == "in_progress"), rides[0] if rides else None)
+                rider_ids = []
+                if ride:
+                    rider_ids = [request.user_id for request in db.query(RideRequest.user_id).filter(
+                        RideRequest.ride_id == ride.id,
+                        RideRequest.status == "accepted"
+                    ).all()]
+            finally:
+                db.close()
+        except Exception as e:
+            logger.warning(f"Could not load ride fences for driver {driver_id}: {e}")
+            return False
+        
+        if not ride:
+            geofence_engine.record_miss(driver_id)
+            return False
+        geofence_engine.register_ride(
+            driver_id, ride.id, ride.status,
+            ride.pickup_latitude, ride.pickup_longitude,
+            ride.destination_latitude, ride.destination_longitude,
+            rider_ids=rider_ids, picked_up=ride.pickup_time is not None
+        )
+        geofence_engine.stats["loaded"] += 1
+        return True
+        
+    async def send_ride_status(self, user_id: str, log: Optional[ReplayLog] = None):
+        """Send a snapshot of the user's active rides, as driver or as rider"""
+        try:
+            db = SessionLocal()
+            try:
+                # One query: rides the user drives plus rides they have a live request on
+                rows = db.query(
+                    Ride.id, Ride.status, Ride.driver_id, Ride.pickup_location, Ride.destination,
+                    Ride.pickup_latitude, Ride.pickup_longitude,
+                    Ride.destination_latitude, Ride.destination_longitude,
+                    Ride.scheduled_time, Ride.confirmed_passengers, Ride.vehicle_capacity,
+                    Ride.current_latitude, Ride.current_longitude, Ride.pickup_time,
+                    RideRequest.status.label("request_status")
+                ).outerjoin(
+                    RideRequest,
+                    and_(
+                        RideRequest.ride_id == Ride.id,
+                        RideRequest.user_id == user_id,
+                        RideRequest.status.in_(("pending", "accepted"))
+                    )
+                ).filter(
+                    Ride.status.in_(("available", "confirmed", "in_progress")),
+                    or_(Ride.driver_id == user_id, RideRequest.id.isnot(None))
+                ).all()
+            finally:
+                db.close()
+        except Exception as e:
+            logger.warning(f"Could not load ride status for user {user_id}: {e}")
+            return
+        
+        rides = [{
+            "id": row.id,
+            "status": row.status,
+            "role": "driver" if row.driver_id == user_id else "rider",
+            "request_status": row.request_status,
+            "driver_id": row.driver_id,
+            "pickup_location": row.pickup_location,
+            "destination": row.destination,
+            "pickup_latitude": row.pickup_latitude,
+            "pickup_longitude": row.pickup_longitude,
+            "destination_latitude": row.destination_latitude,
+            "destination_longitude": row.destination_longitude,
+            "scheduled_time": row.scheduled_time.isoformat() if row.scheduled_time else None,
+            "confirmed_passengers": row.confirmed_passengers,
+            "vehicle_capacity": row.vehicle_capacity,
+            "current_latitude": row.current_latitude,
+            "current_longitude": row.current_longitude,
+            "picked_up": row.pickup_time is not None
+        } for row in rows]
+        
+        data = {"rides": rides}
+        if log is not None:
+            # Deltas after this snapshot continue from here
+            data.update(stream_id=log.stream_id, seq=log.seq)
+        await self.send_personal_message({
+            "type": "ride_status",
+            "data": data,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }, user_id)
+        
+    async def handle_ride_request(self, ride_data: dict) -> bool:
+        """Handle new ride request and find matches; False if the request was refused"""
         company_id = ride_data.get("company_id")
         pickup_location = ride_data.get("pickup_location")
         destination = ride_data.get("destination")
         
         # Store pending ride
         ride_id = ride_data.get("id")
-        self.pending_rides[ride_id] = ride_data
+        if not ride_id:
+            ride_id = ride_data["id"] = str(uuid.uuid4())
+        try:
+            self.pending_rides.add(ride_id, ride_data)
+        except PendingRideLimitError as e:
+            await self.send_personal_message({
+                "type": "ride_request_rejected",
+                "data": {"ride_id": ride_id, "reason": str(e)},
+                "timestamp": datetime.now(timezone.utc).isoformat()
+            }, ride_data.get("rider_id"))
+            return False
         
-        # Find nearby available drivers
-        nearby_drivers = await self.find_nearby_drivers(
-            company_id, 
-            ride_data.get("pickup_latitude"), 
-            ride_data.get("pickup_longitude")
-        )
+        # Offer to the nearest drivers first, widening the radius wave by wave
+        self.dispatch.start(ride_id, ride_data)
+        # Drivers on other workers answer through this one
+        await self.broker.publish(DISPATCH_CHANNEL, self.broker.wrap("dispatch_started", ride_id, {}))
+        return True
         
-        # Send ride request to nearby drivers
-        for driver_id in nearby_drivers:
+    async def handle_ride_response(self, driver_id: str, response_data: dict, forwarded: bool = False):
+        """Apply a driver's accept or decline on the worker that runs the ride's dispatch"""
+        ride_id = response_data.get("ride_id")
+        if ride_id not in self.dispatch.jobs and not forwarded:
+            owner = self.remote_dispatch.get(ride_id)
+            if owner and owner[1] > time.monotonic():
+                await self.broker.publish(
+                    worker_channel(owner[0]), self.broker.wrap("ride_response", driver_id, response_data)
+                )
+                return
+        
+        response_type = response_data.get("response")  # "accept" or "decline"
+        if response_type == "accept":
+            await self.accept_ride_offer(driver_id, ride_id, response_data)
+        elif response_type == "decline":
+            await self.decline_ride_offer(driver_id, ride_id, response_data)
+            
+    async def accept_ride_offer(self, driver_id: str, ride_id: str, response_data: dict):
+        """Handle when a driver accepts a ride"""
+        # Only the first driver to accept an open offer gets the ride
+        if not await self.dispatch.accept(ride_id, driver_id):
             await self.send_personal_message({
-                "type": "ride_request",
-                "data": ride_data,
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "type": "ride_offer_unavailable",
+                "data": {"ride_id": ride_id, "reason": "Ride already taken or no longer offered to you"},
+                "timestamp": response_data.get("timestamp")
             }, driver_id)
+            return
+        
+        # Get ride details from pending rides, removing it
+        ride_data = self.pending_rides.pop(ride_id)
+        if ride_data:
+            rider_id = ride_data.get("rider_id")
+            
+            # Notify rider that ride was accepted
+            await self.send_personal_message({
+                "type": "ride_accepted",
+                "data": {
+                    "ride_id": ride_id,
+                    "driver_id": driver_id,
+                    "driver_name": response_data.get("driver_name"),
+                    "estimated_arrival": response_data.get("estimated_arrival")
+                },
+                "timestamp": response_data.get("timestamp")
+            }, rider_id)
+            
+            # Notify driver
+            await self.send_personal_message({
+                "type": "ride_confirmed",
+                "data": {
+                    "ride_id": ride_id,
+                    "rider_id": rider_id,
+                    "pickup_location": ride_data.get("pickup_location"),
+                    "destination": ride_data.get("destination")
+                },
+                "timestamp": response_data.get("timestamp")
+            }, driver_id)
+            
+    async def decline_ride_offer(self, driver_id: str, ride_id: str, response_data: dict):
+        """Handle when a driver declines a ride"""
+        # A wave that has fully declined moves on to the next one early
+        self.dispatch.decline(ride_id, driver_id)
+        ride_data = self.pending_rides.get(ride_id)
+        if ride_data:
+            rider_id = ride_data.get("rider_id")
+            
+            # Notify rider that ride was declined
+            await self.send_personal_message({
+                "type": "ride_declined",
+                "data": {
+                    "ride_id": ride_id,
+                    "driver_id": driver_id,
+                    "reason": response_data.get("reason", "Driver unavailable")
+                },
+                "timestamp": response_data.get("timestamp")
+            }, rider_id)
+        
+    async def notify_ride_request_expired(self, ride_data: dict):
+        """Tell the rider that no driver picked up their request in time"""
+        self.dispatch.cancel(ride_data.get("id"), reason="expired")
+        rider_id = ride_data.get("rider_id")
+        if not rider_id:
+            return
+        await self.send_personal_message({
+            "type": "ride_request_expired",
+            "data": {
+                "ride_id": ride_data.get("id"),
+                "reason": "No driver responded",
+                "pickup_location": ride_data.get("pickup_location"),
+                "destination": ride_data.get("destination")
+            },
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }, rider_id)
             
-    async def find_nearby_drivers(self, company_id: str, lat: float, lon: float, max_distance: float = 5.0):
-        """Find nearby available drivers in the same company"""
-        nearby_drivers = []
-        
-        for user_id, user_info in self.user_locations.items():
-            if (user_info.get("company_id") == company_id and 
-                user_info.get("is_driver") and 
-                user_info.get("is_available") and
-                user_info.get("latitude") and 
-                user_info.get("longitude")):
-                
-                # Calculate distance (simple Euclidean distance for demo)
-                driver_lat = user_info["latitude"]
-                driver_lon = user_info["longitude"]
-                distance = ((lat - driver_lat) ** 2 + (lon - driver_lon) ** 2) ** 0.5
-                
-                if distance <= max_distance:
-                    nearby_drivers.append({
-                        "user_id": user_id,
-                        "distance": distance,
-                        "location": user_info
-                    })
-        
-        # Sort by distance
-        nearby_drivers.sort(key=lambda x: x["distance"])
-        return nearby_drivers
-
     async def send_ride_notification(self, user_id: str, notification_type: str, data: dict):
         """Send ride-related notification to user"""
         message = {
@@ -149,37 +735,48 @@ class ConnectionManager:
 
     async def broadcast_company_message(self, company_id: str, message: dict):
         """Broadcast message to all users in a company"""
-        for user_id, websocket in self.active_connections.items():
-            if user_id in self.user_locations:
-                user_info = self.user_locations[user_id]
-                if user_info.get("company_id") == company_id:
-                    await self.send_personal_message(message, user_id)
+        self._deliver_local(message, self.company_members.get(company_id, ()))
+        await self.broker.publish(
+            company_channel(company_id), self.broker.wrap("company", company_id, message)
+        )
 
     async def get_connection_stats(self):
         """Get connection statistics"""
         return {
             "active_connections": len(self.active_connections),
             "users_with_location": len(self.user_locations),
-            "pending_rides": len(self.pending_rides),
-            "companies_online": len(set(
-                user_info.get("company_id") 
-                for user_info in self.user_locations.values() 
-                if user_info.get("company_id")
-            ))
+            "pending_rides": self.pending_rides.get_stats(),
+            "location_pings": self.ping_rate.get_stats(),
+            "geofences": geofence_engine.get_stats(),
+            "send_queues": self.get_send_queue_stats(),
+            "broker": self.broker.get_stats(),
+            "ride_rooms": self.ride_rooms.get_stats(),
+            "driver_presence": await self.driver_presence.get_stats(),
+            "dispatch": {**self.dispatch.get_stats(), "remote_jobs": len(self.remote_dispatch)},
+            "heartbeats": self.heartbeats.get_stats(),
+            "replay": self.replay.get_stats(),
+            "companies_online": len(self.company_members),
+            "available_drivers": sum(len(drivers) for drivers in self.company_available_drivers.values())
         }
 
-    async def cleanup_inactive_connections(self):
-        """Clean up inactive connections"""
-        inactive_users = []
-        for user_id, websocket in self.active_connections.items():
-            try:
-                # Send ping to check if connection is alive
-                await websocket.ping()
-            except:
-                inactive_users.append(user_id)
+    async def send_heartbeat(self, user_id: str):
+        """Ask a quiet client to prove it is still there"""
+        await self.send_personal_message({
+            "type": "heartbeat",
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }, user_id)
         
-        for user_id in inactive_users:
-            self.disconnect(user_id)
+    async def reap_connection(self, user_id: str):
+        """Close and forget a connection that stopped answering heartbeats"""
+        websocket = self.active_connections.get(user_id)
+        if websocket is None:
+            return
+        logger.info(f"Reaping idle WebSocket of user {user_id}")
+        self.disconnect(user_id)
+        try:
+            await websocket.close(code=IDLE_CLOSE_CODE)
+        except Exception:
+            pass
 
 # Global instance
 manager = ConnectionManager()
@@ -6,6 +6,11 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from app.database import engine, Base
 from app.api import api_router
+from app.services.websocket_service import manager
+from app.services.outbox import outbox_dispatcher
+from app.services.event_stream import event_stream_hub
+from app.services.notification_service import notification_service
+from app.services.ride_expiry import stale_ride_sweeper
 import logging
 
 # Configure logging
@@ -104,6 +109,28 @@ if os.path.exists("../web-admin/templates"):
 # Include API routes
 app.include_router(api_router, prefix="/api/v1")
 
+@app.on_event("startup")
+async def start_realtime_services():
+    """Connect the WebSocket pub/sub broker and start the background sweepers"""
+    await manager.start_broker()
+    await event_stream_hub.start()
+    manager.start_heartbeats()
+    manager.start_pending_ride_expiry()
+    outbox_dispatcher.start()
+    await notification_service.start()
+    stale_ride_sweeper.start()
+
+@app.on_event("shutdown")
+async def stop_realtime_services():
+    """Stop the background sweepers and disconnect the WebSocket pub/sub broker"""
+    stale_ride_sweeper.stop()
+    outbox_dispatcher.stop()
+    await notification_service.stop()
+    manager.stop_heartbeats()
+    manager.stop_pending_ride_expiry()
+    await event_stream_hub.stop()
+    await manager.stop_broker()
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
@@ -138,4 +165,6 @@ async def admin_home(request: Request):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Same variable the uvicorn CLI reads for --ws-per-message-deflate
+    per_message_deflate = os.getenv("UVICORN_WS_PER_MESSAGE_DEFLATE", "true").lower() in ("1", "true", "yes")
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=per_message_deflate)
@@ -0,0 +1,7 @@
+-- Migration: Notification retention index
+-- Date: 2026-10-19
+-- Description: Lets the compaction task find the oldest read notifications without
+--              scanning unread ones; read rows past their type's retention are deleted in batches
+
+CREATE INDEX IF NOT EXISTS idx_notifications_read_timestamp
+    ON notifications(timestamp) WHERE read;
@@ -0,0 +1,27 @@
+-- Migration: Persist notifications
+-- Date: 2026-10-19
+-- Description: Notifications move from an in-process dict to a table written in batches;
+--              per-user counters keep unread badges O(1)
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id VARCHAR PRIMARY KEY,
+    user_id VARCHAR NOT NULL,
+    type VARCHAR(50) NOT NULL,
+    title VARCHAR NOT NULL,
+    message VARCHAR NOT NULL,
+    data JSON,
+    priority VARCHAR(20) NOT NULL DEFAULT 'normal',
+    read BOOLEAN NOT NULL DEFAULT FALSE,
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Keyset pages: WHERE user_id = ? [AND read = false] AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC
+CREATE INDEX IF NOT EXISTS idx_notifications_user_read_timestamp
+    ON notifications(user_id, read, timestamp DESC);
+
+CREATE TABLE IF NOT EXISTS notification_counters (
+    user_id VARCHAR PRIMARY KEY,
+    total_count INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
@@ -0,0 +1,6 @@
+-- Migration: Outbox event claims
+-- Date: 2026-10-19
+-- Description: The outbox dispatcher claims a batch and commits before delivering it, so row
+--              locks are no longer held while messages go out; claimed_at marks the claim
+
+ALTER TABLE outbox_events ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE;
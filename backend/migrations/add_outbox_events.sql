@@ -0,0 +1,19 @@
+-- Migration: Add transactional outbox for ride lifecycle events
+-- Date: 2026-10-19
+-- Description: Ride endpoints write events here in the same transaction as the state change;
+--              the outbox dispatcher delivers them in id order and stamps dispatched_at
+
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGSERIAL PRIMARY KEY,
+    event_type VARCHAR(50) NOT NULL,
+    ride_id VARCHAR NOT NULL,
+    company_id VARCHAR,
+    recipient_ids JSON NOT NULL DEFAULT '[]',
+    payload JSON,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    dispatched_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Partial index: the dispatcher only ever reads undelivered events
+CREATE INDEX IF NOT EXISTS idx_outbox_events_undispatched
+    ON outbox_events(id) WHERE dispatched_at IS NULL;
@@ -0,0 +1,7 @@
+-- Migration: Stale scheduled ride index
+-- Date: 2026-10-19
+-- Description: Lets the stale ride sweeper find available rides whose scheduled time has
+--              passed without scanning rides in any other status
+
+CREATE INDEX IF NOT EXISTS idx_rides_available_scheduled_time
+    ON rides(scheduled_time) WHERE status = 'available';
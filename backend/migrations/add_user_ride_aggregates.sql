@@ -0,0 +1,34 @@
+-- Migration: Running rating and ride-count aggregates on users
+-- Date: 2026-10-19
+-- Description: rate_ride and complete_ride keep rating_sum, rating_count, rating and
+--              total_rides up to date in SQL; this backfills them from ride history.
+--              To recompute later: python -m app.services.ride_stats (from backend/)
+
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS rating_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+ADD COLUMN IF NOT EXISTS rating_count INTEGER NOT NULL DEFAULT 0;
+
+-- Driver ratings
+UPDATE users SET
+    rating_sum = stats.rating_sum,
+    rating_count = stats.rating_count,
+    rating = stats.rating_sum / stats.rating_count
+FROM (
+    SELECT driver_id, SUM(ride_rating) AS rating_sum, COUNT(ride_rating) AS rating_count
+    FROM rides
+    WHERE status = 'completed' AND ride_rating IS NOT NULL
+    GROUP BY driver_id
+) AS stats
+WHERE users.id = stats.driver_id;
+
+-- Completed rides as driver or accepted passenger
+UPDATE users SET total_rides = COALESCE((
+    SELECT COUNT(*) FROM rides WHERE rides.driver_id = users.id AND rides.status = 'completed'
+), 0) + COALESCE((
+    SELECT COUNT(*) FROM ride_requests
+    JOIN rides ON rides.id = ride_requests.ride_id
+    WHERE ride_requests.user_id = users.id
+      AND ride_requests.status = 'accepted'
+      AND rides.status = 'completed'
+      AND rides.driver_id <> users.id
+), 0);
@@ -0,0 +1,213 @@
+import asyncio
+
+import pytest
+
+from app.services.dispatch import DispatchEngine
+from app.services.driver_presence import InMemoryDriverPresence
+
+PICKUP = (37.0, -122.0)
+RIDE = {"ride_id": "ride-1", "rider_id": "rider-1", "company_id": "acme",
+        "pickup_latitude": PICKUP[0], "pickup_longitude": PICKUP[1]}
+
+
+class Harness:
+    """Dispatch engine over in-memory presence, recording every message sent"""
+
+    def __init__(self, wave_size=2, radii_km=(2, 5), wave_timeout=5.0):
+        self.sent = []
+        self.finished = []
+        self.presence = InMemoryDriverPresence(ttl_seconds=60)
+
+        async def send(message, user_id):
+            self.sent.append((user_id, message))
+
+        async def on_finish(ride_id):
+            self.finished.append(ride_id)
+
+        self.engine = DispatchEngine(self.presence, send, wave_size=wave_size, radii_km=radii_km,
+                                     wave_timeout=wave_timeout, on_finish=on_finish)
+
+    async def add_driver(self, driver_id, north_degrees, company_id="acme"):
+        # 0.01 degrees of latitude is about 1.1 km
+        await self.presence.heartbeat(driver_id, company_id, PICKUP[0] + north_degrees, PICKUP[1], True)
+
+    def offers(self, message_type="ride_request"):
+        return [user_id for user_id, message in self.sent if message["type"] == message_type]
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_first_wave_offers_nearest_drivers_only():
+    async def scenario():
+        harness = Harness()
+        for driver_id, north in (("d-far", 0.015), ("d-near", 0.005), ("d-mid", 0.01), ("d-out", 0.03)):
+            await harness.add_driver(driver_id, north)
+        await harness.add_driver("d-other-company", 0.001, company_id="globex")
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        assert harness.offers() == ["d-near", "d-mid"]
+        assert harness.sent[0][1]["offer"]["wave"] == 1
+        harness.engine.cancel("ride-1")
+        await settle()
+
+    asyncio.run(scenario())
+
+
+def test_whole_wave_declining_sends_next_wave_without_waiting():
+    async def scenario():
+        harness = Harness(wave_timeout=60)
+        for driver_id, north in (("d1", 0.005), ("d2", 0.01), ("d3", 0.03)):
+            await harness.add_driver(driver_id, north)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        harness.engine.decline("ride-1", "d1")
+        await settle()
+        assert harness.offers() == ["d1", "d2"]
+        harness.engine.decline("ride-1", "d2")
+        await settle()
+        # The 5 km wave skips drivers already asked
+        assert harness.offers() == ["d1", "d2", "d3"]
+        assert harness.sent[-1][1]["offer"]["wave"] == 2
+        harness.engine.cancel("ride-1")
+        await settle()
+
+    asyncio.run(scenario())
+
+
+def test_unanswered_wave_times_out_into_the_next():
+    async def scenario():
+        harness = Harness(wave_size=1, wave_timeout=0.05)
+        await harness.add_driver("d1", 0.005)
+        await harness.add_driver("d2", 0.03)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        assert harness.offers() == ["d1"]
+        await asyncio.sleep(0.1)
+        assert harness.offers() == ["d1", "d2"]
+        await asyncio.sleep(0.1)
+        assert harness.engine.stats["exhausted"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_accepts_have_exactly_one_winner():
+    async def scenario():
+        harness = Harness(wave_size=3)
+        for driver_id, north in (("d1", 0.005), ("d2", 0.008), ("d3", 0.01)):
+            await harness.add_driver(driver_id, north)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+
+        results = await asyncio.gather(*(harness.engine.accept("ride-1", driver_id) for driver_id in ("d1", "d2", "d3")))
+        assert sorted(results) == [False, False, True]
+        winner = ("d1", "d2", "d3")[results.index(True)]
+        await settle()
+        # Losers get their offers withdrawn; the winner does not
+        assert sorted(harness.offers("ride_offer_cancelled")) == sorted({"d1", "d2", "d3"} - {winner})
+        assert harness.finished == ["ride-1"]
+        assert "ride-1" not in harness.engine.jobs
+        assert harness.engine.stats["accepted"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_accept_requires_an_open_offer():
+    async def scenario():
+        harness = Harness(wave_size=1)
+        await harness.add_driver("d1", 0.005)
+        await harness.add_driver("d2", 0.008)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        # d2 was not offered the ride in this wave
+        assert await harness.engine.accept("ride-1", "d2") is False
+        assert await harness.engine.accept("ride-unknown", "d1") is False
+        assert await harness.engine.accept("ride-1", "d1") is True
+        assert await harness.engine.accept("ride-1", "d1") is False
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("reason", ["cancelled", "expired"])
+def test_cancel_withdraws_open_offers(reason):
+    async def scenario():
+        harness = Harness()
+        await harness.add_driver("d1", 0.005)
+        await harness.add_driver("d2", 0.01)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        harness.engine.decline("ride-1", "d1")
+        harness.engine.cancel("ride-1", reason=reason)
+        await settle()
+        withdrawn = [(user_id, message["data"]["reason"]) for user_id, message in harness.sent
+                     if message["type"] == "ride_offer_cancelled"]
+        assert withdrawn == [("d2", reason)]
+        assert harness.finished == ["ride-1"]
+
+    asyncio.run(scenario())
+
+
+def test_restarting_a_ride_does_not_report_it_finished():
+    async def scenario():
+        harness = Harness()
+        await harness.add_driver("d1", 0.005)
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        harness.engine.start("ride-1", dict(RIDE))
+        await settle()
+        # The replaced job finished, but a newer one owns the ride
+        assert harness.finished == []
+        assert "ride-1" in harness.engine.jobs
+        harness.engine.cancel("ride-1")
+        await settle()
+        assert harness.finished == ["ride-1"]
+
+    asyncio.run(scenario())
+
+
+def test_accepts_on_another_worker_are_forwarded_to_the_dispatching_one():
+    from app.services.broker import InMemoryBroker
+    from app.services.websocket_service import ConnectionManager
+
+    async def scenario():
+        hub = {}
+        dispatching, other = ConnectionManager(InMemoryBroker(hub)), ConnectionManager(InMemoryBroker(hub))
+        sent = {dispatching: [], other: []}
+        for manager in (dispatching, other):
+            async def record(message, user_id, sent=sent[manager]):
+                sent.append((user_id, message["type"]))
+            manager.send_personal_message = record
+            manager.dispatch.send = record
+        presence = InMemoryDriverPresence(ttl_seconds=60)
+        dispatching.dispatch.presence = presence
+        for driver_id, north in (("d1", 0.005), ("d2", 0.008)):
+            await presence.heartbeat(driver_id, "acme", PICKUP[0] + north, PICKUP[1], True)
+
+        assert await dispatching.handle_ride_request({**RIDE, "id": "ride-1"})
+        await settle()
+        assert "ride-1" in other.remote_dispatch
+
+        # Both drivers are connected to the other worker and answer at once
+        await asyncio.gather(
+            other.handle_ride_response("d1", {"ride_id": "ride-1", "response": "accept"}),
+            other.handle_ride_response("d2", {"ride_id": "ride-1", "response": "accept"})
+        )
+        await settle()
+
+        assert dispatching.dispatch.stats["accepted"] == 1
+        assert "ride-1" not in dispatching.pending_rides
+        assert ("rider-1", "ride_accepted") in sent[dispatching]
+        assert sum(1 for _, message_type in sent[dispatching] if message_type == "ride_confirmed") == 1
+        # The loser is refused exactly once, by whichever worker handled its answer
+        refused = [user_id for manager in sent for user_id, message_type in sent[manager]
+                   if message_type == "ride_offer_unavailable"]
+        assert len(refused) == 1
+        # The finished dispatch is forgotten everywhere, so late answers are refused locally
+        assert "ride-1" not in other.remote_dispatch
+        sent[other].clear()
+        await other.handle_ride_response("d2", {"ride_id": "ride-1", "response": "accept"})
+        assert sent[other] == [("d2", "ride_offer_unavailable")]
+
+    asyncio.run(scenario())
@@ -0,0 +1,84 @@
+import asyncio
+
+from app.services.broker import InMemoryBroker
+from app.services.event_stream import EventStreamHub, user_stream
+
+
+def hub(**kwargs):
+    return EventStreamHub(InMemoryBroker(), **kwargs)
+
+
+def events(subscription):
+    """(kind, id) of every queued frame; reset frames carry no id"""
+    frames = []
+    for text in subscription.drain().split("\n\n"):
+        if not text:
+            continue
+        lines = dict(line.split(": ", 1) for line in text.split("\n"))
+        frames.append((lines["event"], int(lines["id"]) if "id" in lines else None))
+    return frames
+
+
+def publish(stream_hub, event_id, user_id="u1"):
+    stream_hub.record(event_id, "ride_started", {"ride_id": f"ride-{event_id}"}, [user_stream(user_id)])
+
+
+def test_resume_replays_events_after_last_event_id():
+    stream_hub = hub()
+    for event_id in (1, 2, 3):
+        publish(stream_hub, event_id)
+    subscription = stream_hub.subscribe(user_stream("u1"), last_event_id=1)
+    assert events(subscription) == [("ride_started", 2), ("ride_started", 3)]
+    assert stream_hub.stats["resumed"] == 1
+
+
+def test_resume_against_an_empty_buffer_resets():
+    # A worker that just started has seen nothing, so it cannot know what the client missed
+    stream_hub = hub()
+    subscription = stream_hub.subscribe(user_stream("u1"), last_event_id=40)
+    assert events(subscription) == [("reset", None)]
+    assert stream_hub.stats["resets"] == 1
+    assert stream_hub.stats["resumed"] == 0
+
+
+def test_resume_from_before_the_first_event_this_worker_saw_resets():
+    stream_hub = hub()
+    for event_id in (50, 51):
+        publish(stream_hub, event_id, user_id="someone-else")
+    # Events 41-49 went out before this worker joined
+    assert events(stream_hub.subscribe(user_stream("u1"), last_event_id=40)) == [("reset", None)]
+    # A client that already has event 49 missed nothing here
+    publish(stream_hub, 52)
+    assert events(stream_hub.subscribe(user_stream("u1"), last_event_id=49)) == [("ride_started", 52)]
+
+
+def test_resume_past_the_evicted_events_resets():
+    stream_hub = hub(buffer_size=2)
+    for event_id in (1, 2, 3, 4):
+        publish(stream_hub, event_id)
+    assert events(stream_hub.subscribe(user_stream("u1"), last_event_id=1)) == [("reset", None)]
+    assert events(stream_hub.subscribe(user_stream("u1"), last_event_id=2)) == [
+        ("ride_started", 3), ("ride_started", 4)]
+
+
+def test_new_connection_without_last_event_id_gets_only_live_events():
+    stream_hub = hub()
+    publish(stream_hub, 1)
+    subscription = stream_hub.subscribe(user_stream("u1"))
+    assert events(subscription) == []
+    publish(stream_hub, 2)
+    assert events(subscription) == [("ride_started", 2)]
+
+
+def test_events_published_on_one_worker_reach_every_worker():
+    async def scenario():
+        shared = {}
+        first, second = EventStreamHub(InMemoryBroker(shared)), EventStreamHub(InMemoryBroker(shared))
+        await first.start()
+        await second.start()
+        subscription = second.subscribe(user_stream("u1"))
+        await first.publish(7, "ride_started", "acme", ["u1"], {"ride_id": "ride-7"})
+        assert events(subscription) == [("ride_started", 7)]
+        assert first.first_event_id == second.first_event_id == 7
+
+    asyncio.run(scenario())
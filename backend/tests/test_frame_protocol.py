@@ -0,0 +1,117 @@
+import zlib
+
+import msgpack
+import pytest
+
+from app.services.frame_protocol import (
+    FRAME_DRIVER_LOCATION_DELTA, FRAME_DRIVER_LOCATION_FULL, FRAME_LOCATION_DELTA, FRAME_LOCATION_FULL,
+    FRAME_MSGPACK, FRAME_MSGPACK_DEFLATE, FRAME_SEQUENCED, LOCATION_DELTA, LOCATION_FULL, SEQUENCE_HEADER,
+    FrameCodec, FrameProtocolError, SharedFrame, inflate, pack_message
+)
+
+TIMESTAMP = "2026-10-19T08:00:00+00:00"
+
+
+def location(latitude, longitude, timestamp=TIMESTAMP, **fields):
+    return {"type": "location_update", "data": {"latitude": latitude, "longitude": longitude, **fields},
+            "timestamp": timestamp}
+
+
+def driver_location(latitude, longitude, timestamp=TIMESTAMP, ride_id="ride-1", driver_id="driver-1"):
+    return {"type": "driver_location", "timestamp": timestamp,
+            "data": {"ride_id": ride_id, "driver_id": driver_id, "latitude": latitude, "longitude": longitude,
+                     "speed": 42.5, "heading": 90}}
+
+
+def test_location_round_trip_uses_full_then_delta_frames():
+    sender, receiver = FrameCodec(), FrameCodec()
+    first = sender.encode(location(37.7749, -122.4194, speed=30.5, heading=180, is_driver=True))
+    second = sender.encode(location(37.7751, -122.4190, timestamp="2026-10-19T08:00:05+00:00"))
+    assert first[0] == FRAME_LOCATION_FULL
+    assert second[0] == FRAME_LOCATION_DELTA
+    assert len(second) == LOCATION_DELTA.size
+
+    decoded = receiver.decode(first)
+    assert decoded["data"]["latitude"] == pytest.approx(37.7749)
+    assert decoded["data"]["speed"] == 30.5
+    assert decoded["data"]["heading"] == 180
+    assert decoded["data"]["is_driver"] is True
+    decoded = receiver.decode(second)
+    assert decoded["data"]["longitude"] == pytest.approx(-122.4190)
+    assert decoded["timestamp"] == "2026-10-19T08:00:05+00:00"
+
+
+def test_large_jump_falls_back_to_full_frame():
+    codec = FrameCodec()
+    codec.encode(location(37.0, -122.0))
+    assert codec.encode(location(38.0, -122.0))[0] == FRAME_LOCATION_FULL
+
+
+def test_driver_location_round_trip_carries_ids_over_deltas():
+    sender, receiver = FrameCodec(), FrameCodec()
+    full = sender.encode(driver_location(37.7749, -122.4194))
+    delta = sender.encode(driver_location(37.7750, -122.4193, timestamp="2026-10-19T08:00:02+00:00"))
+    other_ride = sender.encode(driver_location(37.7750, -122.4193, ride_id="ride-2"))
+    assert (full[0], delta[0], other_ride[0]) == (
+        FRAME_DRIVER_LOCATION_FULL, FRAME_DRIVER_LOCATION_DELTA, FRAME_DRIVER_LOCATION_FULL)
+
+    assert receiver.decode(full)["data"]["ride_id"] == "ride-1"
+    decoded = receiver.decode(delta)
+    assert decoded["type"] == "driver_location"
+    assert decoded["data"]["driver_id"] == "driver-1"
+    assert decoded["data"]["latitude"] == pytest.approx(37.7750)
+    assert decoded["data"]["speed"] == 42.5
+    assert receiver.decode(other_ride)["data"]["ride_id"] == "ride-2"
+
+
+def test_other_messages_use_msgpack_and_compress_when_large():
+    codec = FrameCodec()
+    small = {"type": "ride_status", "data": {"status": "in_progress"}}
+    assert codec.encode(small)[0] == FRAME_MSGPACK
+    assert codec.decode(codec.encode(small)) == small
+
+    large = {"type": "nearby_drivers", "data": {"drivers": [{"id": f"driver-{i}"} for i in range(200)]}}
+    frame = codec.encode(SharedFrame(large))
+    assert frame[0] == FRAME_MSGPACK_DEFLATE
+    assert codec.decode(frame) == large
+
+
+def test_sequenced_frame_round_trip():
+    codec = FrameCodec()
+    decoded = codec.decode(codec.encode({"type": "notification", "data": {}}, seq=7))
+    assert decoded == {"type": "notification", "data": {}, "seq": 7}
+
+
+@pytest.mark.parametrize("frame, error", [
+    (b"", "Empty frame"),
+    (bytes((0x7F,)), "Unknown frame type"),
+    (bytes((FRAME_LOCATION_FULL, 0, 1, 2)), "Malformed frame"),
+    (bytes((FRAME_MSGPACK,)) + msgpack.packb([1, 2]), "must contain a map"),
+    (bytes((FRAME_MSGPACK_DEFLATE,)) + b"not deflate", "Malformed frame"),
+    (bytes((FRAME_SEQUENCED,)) + b"\x01", "Malformed frame"),
+    (SEQUENCE_HEADER.pack(FRAME_SEQUENCED, 1) + SEQUENCE_HEADER.pack(FRAME_SEQUENCED, 2)
+     + pack_message({"type": "x"}), "Nested sequenced frame"),
+    (LOCATION_DELTA.pack(FRAME_LOCATION_DELTA, 0, 1, 1, 0, 0, 10), "without a preceding full frame"),
+    (LOCATION_FULL.pack(FRAME_LOCATION_FULL, 0, 1, 1, 0, 0, 2 ** 63), "Malformed frame"),
+    (LOCATION_FULL.pack(FRAME_DRIVER_LOCATION_FULL, 0, 1, 1, 0, 0, 2 ** 63) + b"\x01r\x01d", "Malformed frame"),
+    (LOCATION_DELTA.pack(FRAME_DRIVER_LOCATION_DELTA, 0, 1, 1, 0, 0, 10), "without a preceding full frame"),
+])
+def test_malformed_frames_raise_protocol_error(frame, error):
+    with pytest.raises(FrameProtocolError, match=error):
+        FrameCodec().decode(frame)
+
+
+def test_truncated_driver_location_ids_are_rejected():
+    frame = FrameCodec().encode(driver_location(37.0, -122.0))
+    with pytest.raises(FrameProtocolError):
+        FrameCodec().decode(frame[:-3])
+    with pytest.raises(FrameProtocolError, match="Trailing bytes"):
+        FrameCodec().decode(frame + b"x")
+
+
+def test_inflate_refuses_payloads_past_the_limit():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    bomb = compressor.compress(b"\0" * 100_000) + compressor.flush()
+    assert len(inflate(bomb, limit=200_000)) == 100_000
+    with pytest.raises(FrameProtocolError, match="inflates past"):
+        inflate(bomb, limit=1000)
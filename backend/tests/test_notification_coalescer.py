@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from app.services.notification_coalescer import DELIVER, HELD, CoalesceRule, NotificationCoalescer
+
+
+@pytest.fixture
+def summaries():
+    return []
+
+
+@pytest.fixture
+def coalescer(summaries):
+    async def on_summary(user_id, notification_type, title, message, data, priority):
+        summaries.append({"user_id": user_id, "type": notification_type, "title": title,
+                          "message": message, "data": data, "priority": priority})
+
+    rules = {
+        "ride_request": CoalesceRule(10, "New Ride Requests", "{count} new ride requests"),
+        "location_update": CoalesceRule(30, "Driver Location", "Location updated",
+                                        group_by="ride_id", latest_only=True),
+    }
+    return NotificationCoalescer(rules, on_summary, enabled=True, digest_seconds=300)
+
+
+def test_first_of_burst_is_delivered_and_followers_are_held(coalescer):
+    assert coalescer.offer("u1", "ride_request", "normal", {"ride_id": "r1"}, now=0) == DELIVER
+    assert coalescer.offer("u1", "ride_request", "normal", {"ride_id": "r2"}, now=1) == HELD
+    assert coalescer.offer("u1", "ride_request", "normal", {"ride_id": "r3"}, now=9.9) == HELD
+    # Windows are per user
+    assert coalescer.offer("u2", "ride_request", "normal", {"ride_id": "r4"}, now=1) == DELIVER
+
+
+def test_summary_sent_when_window_closes(coalescer, summaries):
+    coalescer.offer("u1", "ride_request", "normal", {"ride_id": "r1"}, now=0)
+    coalescer.offer("u1", "ride_request", "normal", {"ride_id": "r2"}, now=1)
+    coalescer.offer("u1", "ride_request", "low", {"ride_id": "r3"}, now=2)
+
+    assert asyncio.run(coalescer.flush_due(now=9)) == 0
+    assert asyncio.run(coalescer.flush_due(now=10)) == 1
+    [summary] = summaries
+    assert summary["message"] == "2 new ride requests"
+    assert summary["data"]["count"] == 2
+    assert summary["data"]["coalesced"] is True
+    assert [item["ride_id"] for item in summary["data"]["items"]] == ["r2", "r3"]
+    assert summary["priority"] == "normal"
+
+
+def test_window_stays_open_after_a_summary(coalescer, summaries):
+    coalescer.offer("u1", "ride_request", "normal", {}, now=0)
+    coalescer.offer("u1", "ride_request", "normal", {}, now=1)
+    asyncio.run(coalescer.flush_due(now=10))
+    # A steady stream keeps producing one summary per window
+    assert coalescer.offer("u1", "ride_request", "normal", {}, now=11) == HELD
+    asyncio.run(coalescer.flush_due(now=20))
+    assert len(summaries) == 2
+    # An idle window expires, so the next notification is delivered at once
+    asyncio.run(coalescer.flush_due(now=31))
+    assert coalescer.offer("u1", "ride_request", "normal", {}, now=32) == DELIVER
+
+
+@pytest.mark.parametrize("priority", ["high", "urgent"])
+def test_high_and_urgent_are_never_held(coalescer, priority):
+    coalescer.offer("u1", "ride_request", "normal", {}, now=0)
+    assert coalescer.offer("u1", "ride_request", priority, {}, now=1) == DELIVER
+    assert coalescer.offer("u1", "announcement", priority, {}, now=1) == DELIVER
+    assert not coalescer.pending
+
+
+def test_latest_only_groups_keep_the_newest_payload(coalescer, summaries):
+    coalescer.offer("u1", "location_update", "normal", {"ride_id": "r1", "lat": 1}, now=0)
+    coalescer.offer("u1", "location_update", "normal", {"ride_id": "r1", "lat": 2}, now=1)
+    coalescer.offer("u1", "location_update", "normal", {"ride_id": "r1", "lat": 3}, now=2)
+    # Another ride opens its own window
+    assert coalescer.offer("u1", "location_update", "normal", {"ride_id": "r2", "lat": 9}, now=2) == DELIVER
+
+    asyncio.run(coalescer.flush_due(now=30))
+    [summary] = summaries
+    assert summary["data"]["lat"] == 3
+    assert summary["data"]["count"] == 2
+
+
+def test_low_priority_without_rule_goes_to_digest(coalescer, summaries):
+    assert coalescer.offer("u1", "announcement", "low", {"text": "a"}, now=0) == HELD
+    assert coalescer.offer("u1", "payment_received", "low", {"amount": 5}, now=10) == HELD
+    assert coalescer.offer("u1", "announcement", "normal", {}, now=10) == DELIVER
+
+    asyncio.run(coalescer.flush_due(now=299))
+    assert not summaries
+    asyncio.run(coalescer.flush_due(now=300))
+    [digest] = summaries
+    assert digest["type"] == "digest"
+    assert digest["data"]["by_type"] == {"announcement": 1, "payment_received": 1}
+
+
+def test_disabled_delivers_everything(coalescer):
+    coalescer.enabled = False
+    for now in range(5):
+        assert coalescer.offer("u1", "ride_request", "normal", {}, now=now) == DELIVER
+    assert coalescer.stats["held"] == 0
+
+
+def test_stop_flushes_held_summaries(coalescer, summaries):
+    coalescer.offer("u1", "ride_request", "normal", {}, now=0)
+    coalescer.offer("u1", "ride_request", "normal", {}, now=1)
+    asyncio.run(coalescer.stop())
+    assert len(summaries) == 1
+    assert not coalescer.pending
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from app.models.notification import Notification, NotificationCounter
+from app.services.notification_retention import NotificationCompactor, row_bytes
+from app.services.notification_store import NotificationStore
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+def seed(db, user_id, notification_type, count, age_days, read=True, start=0):
+    for i in range(start, start + count):
+        db.add(Notification(id=f"{user_id}-{notification_type}-{age_days}-{i}", user_id=user_id,
+                            type=notification_type, title="Title", message="Message", data={"i": i},
+                            priority="normal", read=read, timestamp=NOW - timedelta(days=age_days, minutes=i)))
+
+
+def set_counter(db, user_id):
+    db.flush()
+    total = db.query(Notification).filter(Notification.user_id == user_id).count()
+    unread = db.query(Notification).filter(Notification.user_id == user_id, Notification.read.is_(False)).count()
+    db.merge(NotificationCounter(user_id=user_id, total_count=total, unread_count=unread))
+
+
+def compactor(**kwargs):
+    options = {"batch_size": 3, "pause_ms": 0, "default_days": 30, "days_by_type": {"location_update": 1}}
+    options.update(kwargs)
+    return NotificationCompactor(NotificationStore(), **options)
+
+
+def remaining(db):
+    db.expire_all()
+    return {row.id for row in db.query(Notification.id)}
+
+
+def test_deletes_read_rows_past_their_window_in_batches(db):
+    seed(db, "u1", "location_update", 7, age_days=2)      # Past the 1-day window
+    seed(db, "u1", "location_update", 2, age_days=0.5)    # Inside it
+    seed(db, "u1", "announcement", 4, age_days=40)        # Past the 30-day default
+    seed(db, "u1", "announcement", 2, age_days=10)
+    set_counter(db, "u1")
+    db.commit()
+
+    report = asyncio.run(compactor().compact(now=NOW))
+
+    assert report["deleted"] == 11
+    # 7 rows in batches of 3, then 4 rows: 3 + 2 batches
+    assert report["batches"] == 5
+    assert report["by_type"]["location_update"]["deleted"] == 7
+    assert report["by_type"]["announcement"]["deleted"] == 4
+    assert report["bytes_reclaimed"] == sum(by_type["bytes_reclaimed"] for by_type in report["by_type"].values())
+    assert len(remaining(db)) == 4
+
+
+def test_unread_rows_are_never_deleted(db):
+    seed(db, "u1", "announcement", 5, age_days=400, read=False)
+    seed(db, "u1", "announcement", 1, age_days=400, start=10)
+    set_counter(db, "u1")
+    db.commit()
+
+    report = asyncio.run(compactor().compact(now=NOW))
+    assert report["deleted"] == 1
+    assert len(remaining(db)) == 5
+
+
+def test_counters_drop_by_the_rows_removed(db):
+    seed(db, "u1", "announcement", 4, age_days=40)
+    seed(db, "u1", "announcement", 2, age_days=40, read=False, start=10)
+    seed(db, "u2", "announcement", 5, age_days=40)
+    set_counter(db, "u1")
+    set_counter(db, "u2")
+    db.commit()
+
+    asyncio.run(compactor().compact(now=NOW))
+    db.expire_all()
+    counters = {row.user_id: (row.total_count, row.unread_count) for row in db.query(NotificationCounter)}
+    assert counters == {"u1": (2, 2), "u2": (0, 0)}
+
+
+def test_type_with_its_own_window_is_not_swept_on_the_default(db):
+    # 10 days is past a 5-day default but inside a 14-day type window
+    seed(db, "u1", "ride_request", 2, age_days=10)
+    seed(db, "u1", "announcement", 2, age_days=10)
+    set_counter(db, "u1")
+    db.commit()
+
+    report = asyncio.run(compactor(default_days=5, days_by_type={"ride_request": 14}).compact(now=NOW))
+    assert report["by_type"] == {"announcement": {"deleted": 2, "bytes_reclaimed": report["bytes_reclaimed"]}}
+
+
+def test_cached_heads_of_affected_users_are_dropped(db):
+    seed(db, "u1", "announcement", 1, age_days=40)
+    set_counter(db, "u1")
+    db.commit()
+
+    job = compactor()
+    job.store.heads["u1"] = object()
+    job.store.heads["u2"] = object()
+    asyncio.run(job.compact(now=NOW))
+    assert set(job.store.heads) == {"u2"}
+    assert job.stats["runs"] == 1
+    assert job.last_report["deleted"] == 1
+
+
+def test_row_bytes_counts_text_and_data():
+    class Row:
+        id, user_id, type, title, message, priority = "n1", "u1", "x", "Title", "Message", "normal"
+        data = {"a": 1}
+
+    assert row_bytes(Row) > len("n1u1xTitleMessagenormal")
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.services.notification_store import NotificationStore
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+def notification(n, user_id="u1"):
+    return {"id": f"n{n}", "user_id": user_id, "type": "announcement", "title": "Title", "message": "Message",
+            "data": {}, "priority": "normal", "read": False,
+            "timestamp": (NOW + timedelta(seconds=n)).isoformat()}
+
+
+def slow_writes(store):
+    """Hold every batch write until released; returns (write started, release)"""
+    started, release = threading.Event(), threading.Event()
+    write = store._write
+
+    def held(batch):
+        started.set()
+        release.wait(5)
+        write(batch)
+
+    store._write = held
+    return started, release
+
+
+async def wait_for(event):
+    while not event.is_set():
+        await asyncio.sleep(0.001)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("head", ["n2", "n1"]), ("page", ["n1"]), ("mark_read", True), ("delete", True), ("counts", 2)
+])
+def test_queries_wait_for_a_batch_being_written(db, query, expected):
+    async def scenario():
+        store = NotificationStore(head_size=10)
+        store.add(notification(1))
+        store.add(notification(2))
+        started, release = slow_writes(store)
+        flushing = asyncio.create_task(store.flush())
+        await wait_for(started)
+        # The batch has left the buffer but its rows are not committed yet
+        assert not store.pending_by_user
+
+        async def run():
+            if query == "head":
+                return [entry["id"] for entry in await store.get_page("u1")]
+            if query == "page":
+                return [entry["id"] for entry in await store.get_page("u1", before="n2")]
+            if query == "mark_read":
+                return await store.mark_read("u1", "n1")
+            if query == "delete":
+                return await store.delete("u1", "n1")
+            return (await store.counts("u1"))["total_notifications"]
+
+        answer = asyncio.create_task(run())
+        await asyncio.sleep(0.01)
+        assert not answer.done()
+        release.set()
+        await flushing
+        return await answer
+
+    assert asyncio.run(scenario()) == expected
+
+
+def test_flush_writes_in_batches_and_updates_counters(db):
+    async def scenario():
+        store = NotificationStore(batch_size=2, head_size=10)
+        for n in range(5):
+            store.add(notification(n))
+        store.add(notification(9, user_id="u2"))
+        assert await store.flush() == 6
+        assert store.stats["batches"] == 3
+        store.heads.clear()
+        return await store.counts("u1"), await store.counts("u2")
+
+    u1, u2 = asyncio.run(scenario())
+    assert u1 == {"total_notifications": 5, "unread_notifications": 5, "read_notifications": 0}
+    assert u2["total_notifications"] == 1
+
+
+def test_head_includes_notifications_still_buffered(db):
+    async def scenario():
+        store = NotificationStore(head_size=10)
+        store.add(notification(1))
+        await store.flush()
+        store.heads.clear()
+        store.add(notification(2))
+        # Another user's buffered notification keeps the user's own batch from being forced out
+        store.add(notification(3, user_id="u2"))
+        page = await store.get_page("u1")
+        return [entry["id"] for entry in page], await store.counts("u1")
+
+    ids, counts = asyncio.run(scenario())
+    assert ids == ["n2", "n1"]
+    assert counts["total_notifications"] == 2
+
+
+def test_mark_read_and_delete_keep_counts_in_step(db):
+    async def scenario():
+        store = NotificationStore(head_size=10)
+        for n in range(3):
+            store.add(notification(n))
+        await store.flush()
+        assert await store.mark_read("u1", "n0") is True
+        assert await store.mark_read("u1", "missing") is False
+        assert await store.delete("u1", "n1") is True
+        assert await store.delete("u1", "n1") is False
+        store.heads.clear()
+        return await store.counts("u1")
+
+    assert asyncio.run(scenario()) == {"total_notifications": 2, "unread_notifications": 1, "read_notifications": 1}
@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import update
+
+from app.models.outbox import OutboxEvent
+from app.services.outbox import OutboxDispatcher
+
+
+class RecordingDispatcher(OutboxDispatcher):
+    """Dispatcher whose deliveries are recorded instead of sent"""
+
+    def __init__(self, **kwargs):
+        super().__init__(rescan_seconds=0, **kwargs)
+        self.delivered = []
+
+    async def _deliver(self, event):
+        self.delivered.append(event.id)
+
+
+@pytest.fixture
+def events(db):
+    for n in range(5):
+        db.add(OutboxEvent(event_type="ride_started", ride_id=f"ride-{n}", company_id="acme",
+                           recipient_ids=[f"rider-{n}"], payload={"status": "in_progress"}))
+    db.commit()
+    return [event.id for event in db.query(OutboxEvent).order_by(OutboxEvent.id)]
+
+
+def dispatched(db):
+    db.expire_all()
+    return [event.id for event in db.query(OutboxEvent).filter(OutboxEvent.dispatched_at.isnot(None))]
+
+
+def test_drain_delivers_every_event_in_batches(db, events):
+    dispatcher = RecordingDispatcher(batch_size=2)
+    assert asyncio.run(dispatcher.drain()) == 5
+    assert dispatcher.delivered == events
+    assert dispatcher.stats["batches"] == 3
+    assert dispatched(db) == events
+    # Delivered events are never claimed again
+    assert asyncio.run(dispatcher.drain()) == 0
+
+
+def test_live_claims_are_skipped_by_other_dispatchers(db, events):
+    crashed = RecordingDispatcher(batch_size=2)
+    claimed = [event.id for event in crashed._claim_batch()]
+    assert claimed == events[:2]
+
+    other = RecordingDispatcher(batch_size=10)
+    asyncio.run(other.drain())
+    assert other.delivered == events[2:]
+
+
+def test_expired_claims_are_delivered_again_with_the_same_event_ids(db, events):
+    # A dispatcher delivers a batch and dies before marking it dispatched
+    crashed = RecordingDispatcher(batch_size=2, claim_timeout_seconds=60)
+    for event in crashed._claim_batch():
+        asyncio.run(crashed._deliver(event))
+    assert dispatched(db) == []
+
+    other = RecordingDispatcher(batch_size=10, claim_timeout_seconds=60)
+    asyncio.run(other.drain())
+    assert other.delivered == events[2:]
+
+    # Once the claim times out the batch goes out again, under the ids clients already saw
+    db.execute(update(OutboxEvent).where(OutboxEvent.id.in_(crashed.delivered)).values(
+        claimed_at=datetime.now(timezone.utc) - timedelta(seconds=61)))
+    db.commit()
+    asyncio.run(other.drain())
+    assert other.delivered[3:] == crashed.delivered == events[:2]
+    assert sorted(dispatched(db)) == events
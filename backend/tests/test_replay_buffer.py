@@ -0,0 +1,79 @@
+from app.services.frame_protocol import SharedFrame
+from app.services.replay_buffer import ReplayLog, ReplayRegistry
+
+
+def event(n):
+    return {"type": "notification", "data": {"n": n}}
+
+
+def test_since_returns_events_after_last_seq():
+    log = ReplayLog(max_events=10)
+    for n in range(1, 6):
+        assert log.record(event(n)) == n
+    assert [seq for seq, _ in log.since(2)] == [3, 4, 5]
+    assert log.since(5) == []
+    assert [seq for seq, _ in log.since(0)] == [1, 2, 3, 4, 5]
+
+
+def test_gap_past_the_buffer_needs_a_snapshot():
+    log = ReplayLog(max_events=3)
+    for n in range(1, 8):
+        log.record(event(n))
+    # Events 1-4 were evicted; a client that saw 4 can still resume
+    assert [seq for seq, _ in log.since(4)] == [5, 6, 7]
+    assert log.since(3) is None
+    assert log.since(0) is None
+
+
+def test_sequence_ahead_of_the_server_needs_a_snapshot():
+    log = ReplayLog()
+    log.record(event(1))
+    assert log.since(2) is None
+
+
+def test_resume_checks_stream_id():
+    registry = ReplayRegistry(max_events=10)
+    log = registry.attach("u1")
+    registry.record("u1", event(1))
+    registry.record("u1", event(2))
+
+    assert [seq for seq, _ in registry.resume("u1", log.stream_id, 1)] == [2]
+    # A different stream (server restart, expired log) means the numbers no longer apply
+    assert registry.resume("u1", "other-stream", 1) is None
+    assert registry.resume("u1", log.stream_id, None) is None
+    assert registry.resume("u2", log.stream_id, 0) is None
+    assert registry.stats["resumed"] == 1
+    assert registry.stats["snapshots"] == 3
+
+
+def test_transient_messages_are_not_sequenced():
+    registry = ReplayRegistry()
+    registry.attach("u1")
+    assert registry.record("u1", {"type": "heartbeat"}) is None
+    assert registry.record("u1", SharedFrame({"type": "ride_status", "data": {}})) is None
+    assert registry.record("u1", SharedFrame(event(1))) == 1
+    assert registry.record("unknown", event(2)) is None
+
+
+def test_detached_logs_expire_after_retention():
+    registry = ReplayRegistry(retention_seconds=60)
+    registry.attach("u1")
+    registry.attach("u2")
+    registry.detach("u1")
+    registry.detach("u2")
+    detached_at = registry._detached["u2"]
+
+    registry.prune(now=detached_at + 30)
+    assert set(registry.logs) == {"u1", "u2"}
+    registry.prune(now=detached_at + 60)
+    assert registry.logs == {}
+    assert registry.stats["expired"] == 2
+
+
+def test_reattaching_keeps_the_stream():
+    registry = ReplayRegistry(retention_seconds=60)
+    log = registry.attach("u1")
+    registry.record("u1", event(1))
+    registry.detach("u1")
+    assert registry.attach("u1") is log
+    assert "u1" not in registry._detached
@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.models.outbox import OutboxEvent
+from app.models.ride import Ride, RideRequest
+from app.services import ride_expiry
+from app.services.ride_expiry import StaleRideSweeper
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def notified(monkeypatch):
+    """Bulk notifications sent by the sweeper: (message, {user_id: ride_ids})"""
+    calls = []
+
+    async def send_bulk_notifications(user_ids, notification_type, title, message, data=None, data_by_user=None):
+        calls.append((message, {user_id: data_by_user[user_id]["ride_ids"] for user_id in user_ids}))
+        return {"stored": len(user_ids)}
+
+    monkeypatch.setattr(ride_expiry.notification_service, "send_bulk_notifications", send_bulk_notifications)
+    return calls
+
+
+def add_ride(db, ride_id, scheduled_minutes_ago, status="available", driver_id=None):
+    db.add(Ride(id=ride_id, company_id="acme", driver_id=driver_id or f"driver-{ride_id}",
+                pickup_location="Office", destination="Station",
+                pickup_latitude=37.0, pickup_longitude=-122.0, destination_latitude=37.1, destination_longitude=-122.1,
+                vehicle_capacity=4, status=status, confirmed_passengers=0,
+                scheduled_time=NOW - timedelta(minutes=scheduled_minutes_ago)))
+
+
+def add_request(db, request_id, ride_id, user_id, status="pending"):
+    db.add(RideRequest(id=request_id, ride_id=ride_id, user_id=user_id, status=status))
+
+
+def statuses(db, model):
+    db.expire_all()
+    return {row.id: row.status for row in db.query(model)}
+
+
+def test_cancels_only_stale_available_rides(db, notified):
+    add_ride(db, "stale", 60)
+    add_ride(db, "in-grace", 10)
+    add_ride(db, "future", -30)
+    add_ride(db, "started", 60, status="in_progress")
+    db.commit()
+
+    report = asyncio.run(StaleRideSweeper(grace_minutes=15, pause_ms=0).sweep(now=NOW))
+
+    assert report["rides_expired"] == 1
+    assert statuses(db, Ride) == {"stale": "cancelled", "in-grace": "available",
+                                  "future": "available", "started": "in_progress"}
+
+
+def test_sweeps_in_batches_until_nothing_is_left(db, notified):
+    for i in range(7):
+        add_ride(db, f"ride-{i}", 60 + i)
+    db.commit()
+
+    sweeper = StaleRideSweeper(grace_minutes=15, batch_size=3, pause_ms=0)
+    report = asyncio.run(sweeper.sweep(now=NOW))
+
+    assert report["batches"] == 3
+    assert report["rides_expired"] == 7
+    assert set(statuses(db, Ride).values()) == {"cancelled"}
+    # One ride_expired event per ride, written with the cancellation
+    assert db.query(OutboxEvent).filter(OutboxEvent.event_type == "ride_expired").count() == 7
+    assert sweeper.stats["rides_expired"] == 7
+    assert asyncio.run(sweeper.sweep(now=NOW))["rides_expired"] == 0
+
+
+def test_pending_and_accepted_riders_are_cancelled_and_told(db, notified):
+    add_ride(db, "ride-1", 60, driver_id="driver-1")
+    add_ride(db, "ride-2", 60, driver_id="driver-1")
+    add_request(db, "pending", "ride-1", "rider-a")
+    add_request(db, "accepted", "ride-1", "rider-b", status="accepted")
+    add_request(db, "rejected", "ride-1", "rider-c", status="rejected")
+    add_request(db, "other-ride", "ride-2", "rider-a")
+    db.commit()
+
+    report = asyncio.run(StaleRideSweeper(grace_minutes=15, pause_ms=0).sweep(now=NOW))
+
+    assert report["requests_cancelled"] == 3
+    assert statuses(db, RideRequest) == {"pending": "cancelled", "accepted": "cancelled",
+                                         "rejected": "rejected", "other-ride": "cancelled"}
+    # One bulk notification for drivers and one for riders, each user once with all their rides
+    (_, drivers), (_, riders) = notified
+    assert drivers == {"driver-1": ["ride-1", "ride-2"]}
+    assert {user_id: sorted(ride_ids) for user_id, ride_ids in riders.items()} == {
+        "rider-a": ["ride-1", "ride-2"], "rider-b": ["ride-1"]}
+    event = db.query(OutboxEvent).filter(OutboxEvent.ride_id == "ride-1").one()
+    assert set(event.recipient_ids) == {"driver-1", "rider-a", "rider-b"}
+
+
+def test_failed_notification_does_not_undo_the_sweep(db, monkeypatch):
+    async def broken(*args, **kwargs):
+        raise RuntimeError("push queue down")
+
+    monkeypatch.setattr(ride_expiry.notification_service, "send_bulk_notifications", broken)
+    add_ride(db, "ride-1", 60)
+    db.commit()
+
+    sweeper = StaleRideSweeper(grace_minutes=15, pause_ms=0)
+    assert asyncio.run(sweeper.sweep(now=NOW))["rides_expired"] == 1
+    assert statuses(db, Ride) == {"ride-1": "cancelled"}
+    assert sweeper.stats["errors"] == 1
@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from app.models.ride import Ride, RideRequest
+from app.models.user import User
+from app.services.ride_stats import backfill_ride_stats, record_driver_rating, record_ride_completed
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+def add_user(db, user_id, total_rides=0):
+    db.add(User(id=user_id, name=user_id, email=f"{user_id}@acme.test", phone="555-0100", department="Eng",
+                role="employee", company_id="acme", hashed_password="x", total_rides=total_rides))
+
+
+def add_ride(db, ride_id, driver_id, status="completed", rating=None):
+    db.add(Ride(id=ride_id, company_id="acme", driver_id=driver_id,
+                pickup_location="Office", destination="Station",
+                pickup_latitude=37.0, pickup_longitude=-122.0, destination_latitude=37.1, destination_longitude=-122.1,
+                vehicle_capacity=4, status=status, confirmed_passengers=0, scheduled_time=NOW, ride_rating=rating))
+
+
+def add_request(db, request_id, ride_id, user_id, status="accepted"):
+    db.add(RideRequest(id=request_id, ride_id=ride_id, user_id=user_id, status=status))
+
+
+def stats(db):
+    db.expire_all()
+    return {user.id: (user.total_rides, user.rating_sum, user.rating_count, user.rating) for user in db.query(User)}
+
+
+def test_completion_counts_the_driver_and_every_passenger_once(db):
+    add_user(db, "driver", total_rides=3)
+    add_user(db, "p1")
+    add_user(db, "p2", total_rides=None)
+    add_user(db, "bystander")
+    db.commit()
+
+    # A driver holding a seat on their own ride is still counted once
+    record_ride_completed(db, "driver", ["p1", "p2", "driver"])
+    db.commit()
+
+    assert {user_id: row[0] for user_id, row in stats(db).items()} == {
+        "driver": 4, "p1": 1, "p2": 1, "bystander": 0}
+
+
+def test_rating_updates_sum_count_and_average_together(db):
+    add_user(db, "driver")
+    add_user(db, "other")
+    db.commit()
+
+    record_driver_rating(db, "driver", 4)
+    db.commit()
+    assert stats(db)["driver"][1:] == (4.0, 1, 4.0)
+
+    record_driver_rating(db, "driver", 5)
+    db.commit()
+    assert stats(db)["driver"][1:] == (9.0, 2, 4.5)
+    assert stats(db)["other"][1:] == (0.0, 0, 0.0)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 1000])
+def test_backfill_reproduces_the_incremental_values(db, batch_size):
+    for user_id in ("d1", "d2", "p1", "p2", "p3", "idle"):
+        add_user(db, user_id)
+    db.commit()
+
+    # (ride, driver, status, rating, {rider: request status})
+    history = [
+        ("r1", "d1", "completed", 5, {"p1": "accepted", "p2": "accepted", "p3": "rejected"}),
+        ("r2", "d1", "completed", 3, {"p1": "accepted"}),
+        ("r3", "d1", "completed", None, {"p2": "accepted", "d1": "accepted"}),
+        ("r4", "d2", "completed", 4, {"p3": "accepted", "d1": "accepted"}),
+        ("r5", "d2", "cancelled", None, {"p1": "accepted"}),
+        ("r6", "d2", "in_progress", None, {"p2": "accepted"}),
+    ]
+    for ride_id, driver_id, status, rating, riders in history:
+        add_ride(db, ride_id, driver_id, status=status, rating=rating)
+        for user_id, request_status in riders.items():
+            add_request(db, f"{ride_id}-{user_id}", ride_id, user_id, status=request_status)
+        if status == "completed":
+            passengers = [user_id for user_id, request_status in riders.items() if request_status == "accepted"]
+            record_ride_completed(db, driver_id, passengers)
+            if rating is not None:
+                record_driver_rating(db, driver_id, rating)
+    db.commit()
+    incremental = stats(db)
+    assert incremental["d1"] == (4, 8.0, 2, 4.0)
+    assert incremental["idle"] == (0, 0.0, 0, 0.0)
+
+    # Lose the aggregates, then rebuild them from history alone
+    db.query(User).update({User.total_rides: 0, User.rating_sum: 0.0, User.rating_count: 0, User.rating: 0.0},
+                          synchronize_session=False)
+    db.commit()
+    report = backfill_ride_stats(db, batch_size=batch_size)
+
+    assert stats(db) == incremental
+    assert report == {"users": 6, "rated_drivers": 2, "users_with_rides": 5, "ratings": 3}
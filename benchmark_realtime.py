@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the real-time (WebSocket) layer of the backend
+Runs offline against the service modules - no server or database needed
+
+Usage: python3 benchmark_realtime.py
+"""
+
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+def print_header(title):
+    print("")
+    print(f"📊 {title}")
+    print("-" * 60)
+
+def timed(func, repeat):
+    """Return average microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1_000_000
+
+def simulated_track(points=1000, interval_seconds=2):
+    """Driver moving at ~40 km/h with light GPS noise"""
+    start = datetime.now(timezone.utc)
+    lat, lon = 37.7749, -122.4194
+    messages = []
+    for i in range(points):
+        heading = (i * 0.7) % 360
+        lat += 0.00015 * math.cos(math.radians(heading))
+        lon += 0.00015 * math.sin(math.radians(heading))
+        messages.append({
+            "type": "location_update",
+            "data": {
+                "latitude": round(lat, 7),
+                "longitude": round(lon, 7),
+                "speed": 40.0 + (i % 7),
+                "heading": heading,
+                "is_driver": True,
+                "is_available": True
+            },
+            "timestamp": (start + timedelta(seconds=i * interval_seconds)).isoformat()
+        })
+    return messages
+
+def benchmark_frame_protocol():
+    """Compare the JSON text path with the binary subprotocol"""
+    from app.services.frame_protocol import FrameCodec
+
+    print_header("WebSocket frame protocol: JSON vs binary")
+    track = simulated_track()
+    other = [{
+        "type": "ride_request",
+        "data": {
+            "id": f"ride-{i}",
+            "company_id": "company-1",
+            "pickup_location": "123 Innovation Drive",
+            "destination": "1 Market St",
+            "pickup_latitude": 37.7749,
+            "pickup_longitude": -122.4194
+        },
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    } for i in range(1000)]
+
+    # The same track as pushed to a ride's riders
+    driver_track = [{
+        "type": "driver_location",
+        "data": {
+            "ride_id": "ride-1",
+            "driver_id": "driver-1",
+            **{key: m["data"][key] for key in ("latitude", "longitude", "speed", "heading")}
+        },
+        "timestamp": m["timestamp"]
+    } for m in track]
+
+    for label, messages in (("location_update", track), ("driver_location", driver_track), ("ride_request", other)):
+        json_frames = [json.dumps(m).encode() for m in messages]
+        encoder = FrameCodec()
+        binary_frames = [encoder.encode(m) for m in messages]
+
+        json_bytes = sum(len(f) for f in json_frames) / len(messages)
+        binary_bytes = sum(len(f) for f in binary_frames) / len(messages)
+
+        def json_roundtrip():
+            for m in messages:
+                json.loads(json.dumps(m))
+
+        def binary_roundtrip():
+            enc, dec = FrameCodec(), FrameCodec()
+            for m in messages:
+                dec.decode(enc.encode(m))
+
+        json_us = timed(json_roundtrip, 5) / len(messages)
+        binary_us = timed(binary_roundtrip, 5) / len(messages)
+
+        print(f"   {label}:")
+        print(f"      JSON:   {json_bytes:7.1f} bytes/msg  {json_us:6.2f} µs/msg (encode+decode)")
+        print(f"      Binary: {binary_bytes:7.1f} bytes/msg  {binary_us:6.2f} µs/msg (encode+decode)")
+        print(f"      Size reduction: {100 * (1 - binary_bytes / json_bytes):.1f}%")
+
+def benchmark_broadcast_encoding():
+    """CPU cost of encoding one broadcast, per recipient vs serialize-once"""
+    from app.services.frame_protocol import FrameCodec, SharedFrame
+
+    print_header("Broadcast encoding: per recipient vs serialize-once")
+    message = {
+        "type": "ride_request",
+        "data": {
+            "id": "ride-1",
+            "company_id": "company-1",
+            "pickup_location": "123 Innovation Drive",
+            "destination": "1 Market St",
+            "pickup_latitude": 37.7749,
+            "pickup_longitude": -122.4194,
+            "passenger_count": 1
+        },
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+    for recipients in (10, 100, 500, 2000):
+        # A mix of JSON clients and binary-subprotocol clients
+        codecs = [FrameCodec() if i % 4 == 0 else None for i in range(recipients)]
+
+        def per_recipient():
+            for codec in codecs:
+                codec.encode(message) if codec else json.dumps(message)
+
+        def serialize_once():
+            frame = SharedFrame(message)
+            for codec in codecs:
+                codec.encode(frame) if codec else frame.text()
+
+        before = timed(per_recipient, 20)
+        after = timed(serialize_once, 20)
+        print(f"   {recipients:5d} recipients: {before:9.1f} µs -> {after:8.1f} µs per broadcast "
+              f"({before / after:.1f}x)")
+
+    # Large admin dashboard payload, compressed once above the threshold
+    dashboard = {
+        "type": "company_dashboard",
+        "data": {"rides": [{
+            "id": f"ride-{i}",
+            "status": "in_progress",
+            "driver_id": f"driver-{i % 50}",
+            "origin": "123 Innovation Drive",
+            "destination": "1 Market St",
+            "confirmed_passengers": i % 4
+        } for i in range(200)]},
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    frame = SharedFrame(dashboard)
+    print(f"   Dashboard payload: {len(frame.text().encode())} bytes JSON, "
+          f"{len(frame.binary())} bytes compressed binary frame")
+
+def benchmark_presence_memory(users=100_000):
+    """Memory held for connected users: raw client dicts vs PresenceRecord"""
+    from app.services.presence import PresenceRecord
+
+    print_header(f"Presence state memory: {users:,} connected users")
+    timestamp = datetime.now(timezone.utc).isoformat()
+    payloads = [json.dumps({
+        "latitude": 37.7749 + (i % 1000) * 1e-4,
+        "longitude": -122.4194 - (i % 700) * 1e-4,
+        "speed": 30.0 + i % 20,
+        "heading": float(i % 360),
+        "is_driver": i % 5 == 0,
+        "is_available": i % 10 == 0,
+        "company_id": f"company-{i % 20}",
+        "timestamp": timestamp
+    }) for i in range(users)]
+
+    def measure(build):
+        tracemalloc.start()
+        store = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return store, current
+
+    def dict_store():
+        store = {}
+        for i, payload in enumerate(payloads):
+            data = json.loads(payload)
+            data["user_id"] = f"user-{i}"
+            store[i] = data
+        return store
+
+    def record_store():
+        store = {}
+        for i, payload in enumerate(payloads):
+            record = PresenceRecord()
+            record.apply(json.loads(payload))
+            store[i] = record
+        return store
+
+    for label, build in (("dict (previous)", dict_store), ("PresenceRecord", record_store)):
+        store, current = measure(build)
+        print(f"   {label:16s} {current / 1024 / 1024:8.1f} MB  ({current / users:6.0f} bytes/user)")
+        del store
+
+def benchmark_notification_reads(users=20, per_user=10_000, page=50):
+    """Per-user notification reads: sorted list scans vs ring buffer + id index + counters"""
+    import random
+    from app.services.notification_store import UserNotifications
+
+    print_header(f"Notification reads: {users} users x {per_user:,} notifications")
+    start = datetime.now(timezone.utc)
+    histories = [[{
+        "id": f"notif-{user}-{i}",
+        "user_id": f"user-{user}",
+        "type": "ride_request",
+        "title": "New Ride Request",
+        "message": "You have a new ride request",
+        "data": {},
+        "priority": "high",
+        "timestamp": (start + timedelta(seconds=i)).isoformat(),
+        "read": i % 3 == 0
+    } for i in range(per_user)] for user in range(users)]
+    random.seed(7)
+
+    # Previous NotificationService: one unsorted list per user
+    lists = {f"user-{user}": [dict(n) for n in history] for user, history in enumerate(histories)}
+
+    def list_latest():
+        for notifications in lists.values():
+            sorted(notifications, key=lambda x: x["timestamp"], reverse=True)[:page]
+
+    def list_mark_read():
+        for notifications in lists.values():
+            target = notifications[random.randrange(len(notifications))]["id"]
+            for notification in notifications:
+                if notification["id"] == target:
+                    notification["read"] = True
+                    break
+
+    def list_stats():
+        for notifications in lists.values():
+            len([n for n in notifications if not n["read"]])
+
+    results = {"list (previous)": (timed(list_latest, 5), timed(list_mark_read, 20), timed(list_stats, 20))}
+
+    for label, size in (("ring, 50 cached", 50), (f"ring, {per_user // 1000}k cached", per_user)):
+        rings = {}
+        for user, history in enumerate(histories):
+            ring = UserNotifications(size)
+            for notification in history:
+                ring.add(dict(notification))
+            rings[f"user-{user}"] = ring
+        cached_ids = {user_id: list(ring.index) for user_id, ring in rings.items()}
+
+        def ring_latest():
+            for ring in rings.values():
+                ring.latest(page)
+
+        def ring_mark_read():
+            for user_id, ring in rings.items():
+                ids = cached_ids[user_id]
+                ring.mark_read(ids[random.randrange(len(ids))])
+
+        def ring_stats():
+            for ring in rings.values():
+                ring.counts()
+
+        results[label] = (timed(ring_latest, 20), timed(ring_mark_read, 200), timed(ring_stats, 200))
+
+    print(f"   {'':18s} {'latest ' + str(page):>14s} {'mark read':>12s} {'stats':>12s}   (µs, all users)")
+    for label, (latest, mark_read, stats) in results.items():
+        print(f"   {label:18s} {latest:14.1f} {mark_read:12.1f} {stats:12.1f}")
+
+def benchmark_bulk_notifications(recipients=2000, with_token=0.5, latency_ms=1.0):
+    """Company-wide announcement: sequential per-user loop vs concurrent batched bulk send"""
+    import asyncio
+    from app.services.notification_service import NotificationService, NotificationType, NotificationPriority
+    from app.services.websocket_service import manager
+
+    print_header(f"Bulk notification: {recipients:,} recipients, {latency_ms:g} ms per network call")
+    user_ids = [f"user-{i}" for i in range(recipients)]
+
+    # Every network hop (broker publish, push provider call) costs the same simulated latency
+    async def publish(message, user_id):
+        await asyncio.sleep(latency_ms / 1000)
+
+    async def push_one(user_id, notification):
+        if user_id in service.push_tokens:
+            await asyncio.sleep(latency_ms / 1000)
+            return True
+        return False
+
+    async def previous_loop():
+        # The previous send_bulk_notifications
+        for user_id in user_ids:
+            await service.send_notification(user_id, NotificationType.ANNOUNCEMENT, "Office closed", "Friday", {})
+
+    async def bulk():
+        return await service.send_bulk_notifications(
+            user_ids, NotificationType.ANNOUNCEMENT, "Office closed", "Friday", {}, NotificationPriority.NORMAL
+        )
+
+    original_send = manager.send_personal_message
+    manager.send_personal_message = publish
+    try:
+        results = {}
+        for label, run in (("sequential loop", previous_loop), ("concurrent bulk", bulk)):
+            service = NotificationService()
+            service.push_tokens = {user_id: f"token-{user_id}" for user_id in user_ids[:int(recipients * with_token)]}
+            service.send_push_notification = push_one
+            start = time.perf_counter()
+            report = asyncio.run(run())
+            results[label] = time.perf_counter() - start
+            print(f"   {label:16s} {results[label] * 1000:9.1f} ms  ({recipients / results[label]:9.0f} notifications/s)")
+        print(f"   Speed-up: {results['sequential loop'] / results['concurrent bulk']:.0f}x; "
+              f"report: push_queued={report['push_queued']}, websocket_published={report['websocket_published']}")
+    finally:
+        manager.send_personal_message = original_send
+
+def benchmark_push_delivery(messages=2000, latency_ms=10.0, retry_rate=0.05, invalid_rate=0.01, outage_rate=0.05):
+    """Push worker pool against the local HTTP stub provider, with injected failures"""
+    import asyncio
+    import threading
+    import push_stub_server
+    from app.services import push_delivery
+    from app.services.push_delivery import (PushWorkerPool, InMemoryPushQueue, HttpStubPushProvider,
+                                            push_message)
+
+    print_header(f"Push delivery: {messages:,} messages, {latency_ms:g} ms per provider call, "
+                 f"{retry_rate:.0%} retry / {outage_rate:.0%} outage")
+    server = push_stub_server.create_server(0, latency_ms, retry_rate, invalid_rate, outage_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/send"
+    notification = {"id": "notif_1", "type": "announcement", "title": "Office closed", "message": "Friday", "data": {}}
+
+    # Short backoff so retries finish within the run
+    backoff = (push_delivery.PUSH_BACKOFF_BASE_SECONDS, push_delivery.PUSH_BACKOFF_MAX_SECONDS)
+    push_delivery.PUSH_BACKOFF_BASE_SECONDS, push_delivery.PUSH_BACKOFF_MAX_SECONDS = 0.05, 0.2
+
+    async def run(workers, batch_size):
+        invalid = []
+
+        async def on_invalid_token(user_id, token):
+            invalid.append(user_id)
+
+        pool = PushWorkerPool(InMemoryPushQueue(), HttpStubPushProvider(url), workers=workers,
+                              batch_size=batch_size, on_invalid_token=on_invalid_token, retry_poll_seconds=0.02)
+        await pool.start()
+        start = time.perf_counter()
+        await pool.enqueue([push_message(f"user-{i}", f"token-{i}", notification) for i in range(messages)])
+        while True:
+            stats = await pool.get_stats()
+            if stats["sent"] + stats["invalid_tokens"] + stats["dead_lettered"] >= messages:
+                break
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        await pool.stop()
+        return elapsed, stats
+
+    try:
+        for workers, batch_size in ((8, 1), (8, 100), (8, 500)):
+            elapsed, stats = asyncio.run(run(workers, batch_size))
+            print(f"   {workers} workers x {batch_size:3d}/call {elapsed * 1000:9.1f} ms  "
+                  f"({messages / elapsed:8.0f} msg/s)  sent={stats['sent']} retried={stats['retried']} "
+                  f"invalid={stats['invalid_tokens']} dead={stats['dead_lettered']}")
+    finally:
+        server.shutdown()
+        push_delivery.PUSH_BACKOFF_BASE_SECONDS, push_delivery.PUSH_BACKOFF_MAX_SECONDS = backoff
+
+def benchmark_notification_coalescing(riders=200, updates_each=20):
+    """Burst of driver location updates: one notification each vs coalesced summaries"""
+    import asyncio
+    from app.services.notification_service import NotificationService, NotificationType
+    from app.services.websocket_service import manager
+
+    # Ride requests are high priority and never merged; location updates (normal) are
+    print_header(f"Notification coalescing: {riders} riders x {updates_each} location updates in one window")
+    sent = []
+
+    async def publish(message, user_id):
+        sent.append(user_id)
+
+    async def burst(service):
+        for i in range(updates_each):
+            for r in range(riders):
+                await service.send_ride_notification(f"rider-{r}", f"ride-{r}", NotificationType.LOCATION_UPDATE,
+                                                     {"latitude": 37.77 + i / 1000, "longitude": -122.42})
+        await service.coalescer.stop()
+
+    original_send = manager.send_personal_message
+    manager.send_personal_message = publish
+    try:
+        for label, enabled in (("individual", False), ("coalesced", True)):
+            service = NotificationService()
+            service.coalescer.enabled = enabled
+            service.push_tokens = {f"rider-{r}": f"token-{r}" for r in range(riders)}
+            sent.clear()
+            asyncio.run(burst(service))
+            print(f"   {label:12s} stored={len(service.store.pending):6d}  pushes={service.push.stats['queued']:6d}  "
+                  f"websocket={len(sent):6d}")
+    finally:
+        manager.send_personal_message = original_send
+
+def main():
+    print("🚗 Corporate RideShare - Real-time Layer Benchmarks")
+    print("=" * 60)
+    benchmark_frame_protocol()
+    benchmark_broadcast_encoding()
+    benchmark_presence_memory()
+    benchmark_notification_reads()
+    benchmark_bulk_notifications()
+    benchmark_push_delivery()
+    benchmark_notification_coalescing()
+    print("")
+    print("✅ Benchmarks completed")
+
+if __name__ == "__main__":
+    main()
@@ -93,6 +93,12 @@ class WebSocketService {
       final jsonData = json.decode(data);
       final message = WebSocketMessage.fromJson(jsonData);
       
+      // Answer server pings so an idle connection is not reaped
+      if (message.type == 'heartbeat') {
+        _sendHeartbeatAck();
+        return;
+      }
+      
       print('📥 WebSocket message received: ${message.type}');
       _messageController?.add(message);
       
@@ -101,6 +107,20 @@ class WebSocketService {
     }
   }
   
+  /// Reply to a server heartbeat
+  void _sendHeartbeatAck() {
+    if (!_isConnected || _channel == null) return;
+    
+    try {
+      _channel!.sink.add(json.encode(WebSocketMessage(
+        type: 'heartbeat_ack',
+        data: {},
+      ).toJson()));
+    } catch (e) {
+      print('❌ Failed to send heartbeat ack: $e');
+    }
+  }
+  
   /// Handle WebSocket errors
   void _handleError(dynamic error) {
     print('❌ WebSocket error: $error');
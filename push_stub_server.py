@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a push provider (FCM/APNs) used by the "http_stub" provider
+Accepts batches, simulates latency and failures, and counts what it received
+
+Usage: python3 push_stub_server.py [--port 8099] [--latency-ms 20] [--retry-rate 0.05]
+                                   [--invalid-rate 0.01] [--outage-rate 0.0]
+Then start the backend with PUSH_PROVIDER=http_stub
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class PushStubHandler(BaseHTTPRequestHandler):
+    """POST {"messages": [...]} -> {"results": ["ok" | "retry" | "invalid_token", ...]}"""
+
+    def do_POST(self):
+        config = self.server.config
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        messages = json.loads(body or b"{}").get("messages", [])
+        time.sleep(config["latency_ms"] / 1000)
+
+        with self.server.lock:
+            self.server.counts["batches"] += 1
+        # Whole provider unavailable for this call
+        if random.random() < config["outage_rate"]:
+            with self.server.lock:
+                self.server.counts["outages"] += 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        results = []
+        for _ in messages:
+            roll = random.random()
+            if roll < config["invalid_rate"]:
+                results.append("invalid_token")
+            elif roll < config["invalid_rate"] + config["retry_rate"]:
+                results.append("retry")
+            else:
+                results.append("ok")
+        with self.server.lock:
+            for result in results:
+                self.server.counts[result] += 1
+
+        payload = json.dumps({"results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        """Counters, for checking a run"""
+        with self.server.lock:
+            payload = json.dumps(self.server.counts).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def create_server(port=8099, latency_ms=20.0, retry_rate=0.05, invalid_rate=0.01, outage_rate=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), PushStubHandler)
+    server.daemon_threads = True
+    server.config = {"latency_ms": latency_ms, "retry_rate": retry_rate,
+                     "invalid_rate": invalid_rate, "outage_rate": outage_rate}
+    server.counts = {"batches": 0, "outages": 0, "ok": 0, "retry": 0, "invalid_token": 0}
+    server.lock = threading.Lock()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local push provider stub")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--retry-rate", type=float, default=0.05, help="share of messages answered 'retry'")
+    parser.add_argument("--invalid-rate", type=float, default=0.01, help="share of tokens reported unregistered")
+    parser.add_argument("--outage-rate", type=float, default=0.0, help="share of calls answered 503")
+    args = parser.parse_args()
+
+    server = create_server(args.port, args.latency_ms, args.retry_rate, args.invalid_rate, args.outage_rate)
+    print(f"📨 Push stub listening on http://127.0.0.1:{args.port}/send (GET / for counters)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{server.counts}")
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ class AdminDashboard {
     constructor() {
         this.authToken = null;
         this.currentUser = null;
+        this.rides = [];
+        this.eventSource = null;
         this.init();
     }
 
@@ -89,6 +91,10 @@ class AdminDashboard {
     }
 
     async handleLogout() {
+        if (this.eventSource) {
+            this.eventSource.close();
+            this.eventSource = null;
+        }
         this.authToken = null;
         this.currentUser = null;
         localStorage.removeItem('admin_token');
@@ -119,11 +125,54 @@ class AdminDashboard {
                 this.loadRides(),
                 this.loadStats(),
             ]);
+            this.connectEventStream();
         } catch (error) {
             console.error('Failed to load dashboard data:', error);
         }
     }
 
+    connectEventStream() {
+        // Live ride and request events instead of refetching /rides/; EventSource
+        // reconnects on its own and resumes from the last event id it received
+        if (this.eventSource || !window.EventSource) return;
+
+        const url = `/api/v1/events/company/stream?token=${encodeURIComponent(this.authToken)}`;
+        this.eventSource = new EventSource(url);
+
+        const rideEvents = [
+            'ride_created', 'ride_requested', 'ride_request_accepted', 'ride_request_declined',
+            'ride_request_cancelled', 'ride_started', 'passenger_picked_up', 'ride_completed', 'ride_cancelled',
+            'ride_expired',
+        ];
+        rideEvents.forEach(eventName => {
+            this.eventSource.addEventListener(eventName, (e) => {
+                this.applyRideEvent(eventName, JSON.parse(e.data));
+            });
+        });
+
+        // Events were missed while disconnected; reload once
+        this.eventSource.addEventListener('reset', () => this.loadRides());
+    }
+
+    applyRideEvent(eventName, data) {
+        const ride = this.rides.find(r => r.id === data.ride_id);
+        if (ride) {
+            ride.status = data.status;
+        } else if (eventName === 'ride_created') {
+            this.rides.unshift({
+                id: data.ride_id,
+                pickup_location: data.pickup_location,
+                destination: data.destination,
+                rider_id: data.driver_id,
+                status: data.status,
+                created_at: new Date().toISOString(),
+            });
+        } else {
+            return;
+        }
+        this.updateRidesSection(this.rides);
+    }
+
     async loadCompanies() {
         try {
             const response = await fetch('/api/v1/companies/', {
@@ -168,6 +217,7 @@ class AdminDashboard {
 
             if (response.ok) {
                 const rides = await response.json();
+                this.rides = rides;
                 this.updateRidesSection(rides);
             }
         } catch (error) {